@@ -2,10 +2,49 @@
 
 ; let nasm know we need the main function
 EXTERN ?@main
+; flush from io.ca, if it is linked in (0 otherwise), and the counters
+; of code compiled with --profile, the same way. weak symbols are ELF
+; only: on macho, main has to flush (or exit through io.ca's exit)
+%ifidn __OUTPUT_FORMAT__, elf32
+EXTERN ?@flush:weak
+EXTERN ?@?dump_profile:weak
+%endif
+
+; linux syscalls are made with call [?vsyscall]: __kernel_vsyscall
+; from the vDSO (sysenter or syscall) if the kernel has one, int 80h
+; otherwise
+SECTION .data
+GLOBAL ?vsyscall
+?vsyscall: dd ?int80
 
 SECTION .text
+?int80:
+        int 80h
+        ret
+
 GLOBAL _start
 _start:
+        ; the auxiliary vector is after argv and envp; find AT_SYSINFO
+        ; (32) in it. give up after 64 entries, in case there isn't one
+        mov ecx, [esp] ; argc
+        lea edx, [esp+4*ecx+8] ; envp
+.env:   mov eax, [edx]
+        add edx, 4
+        test eax, eax
+        jnz .env
+        mov ecx, 64
+.aux:   mov eax, [edx]
+        test eax, eax
+        jz .main
+        cmp eax, 32
+        jne .next
+        mov eax, [edx+4]
+        mov [?vsyscall], eax
+        jmp .main
+.next:  add edx, 8
+        dec ecx
+        jnz .aux
+.main:
         ; arguments to main: argc, argv
         ; so we should push argv then argc
         ; but argc is already on stack so pop it first
@@ -16,6 +55,19 @@ _start:
         push eax ; push argc again
         ; then we're ready to call main
         call ?@main
+%ifidn __OUTPUT_FORMAT__, elf32
+        ; write out anything io.ca buffered
+        mov eax, ?@flush
+        test eax, eax
+        jz .dump
+        call eax
+        ; and the --profile counters
+.dump:  mov eax, ?@?dump_profile
+        test eax, eax
+        jz .exit
+        call eax
+.exit:
+%endif
         ; now exit if we returned without exiting
         ; the code below works for both linux and bsd
         ; bsd requires parameters on stack
@@ -0,0 +1,84 @@
+; _start for code from canadacodegen.py --target x86-64
+
+; Canada's ints (and so its pointers) are 32 bits, but linux starts
+; us with the stack and argv way above 4 GiB. So switch to a stack in
+; .bss, which is low as long as we're linked without PIE, and copy
+; the arguments onto it. argv ends up as an array of 32-bit pointers,
+; just like on x86.
+
+EXTERN ?@main
+; from io.ca and code compiled with --profile, 0 if not linked in
+EXTERN ?@flush:weak
+EXTERN ?@?dump_profile:weak
+
+SECTION .bss
+        alignb 16
+?stack: resb 8388608
+?stack_top:
+
+SECTION .text
+GLOBAL _start
+_start:
+        mov rdi, [rsp]          ; argc
+        lea rsi, [rsp+8]        ; argv
+        mov rsp, ?stack_top
+        call ?lower_args
+        ; push argv then argc, in 8 byte slots
+        push rsi
+        push rdi
+        call ?@main
+        ; write out anything io.ca buffered
+        mov eax, ?@flush
+        test eax, eax
+        jz .dump
+        call rax
+        ; and the --profile counters
+.dump:  mov eax, ?@?dump_profile
+        test eax, eax
+        jz .exit
+        call rax
+.exit:
+        ; exit(0) if main returned
+        mov eax, 60
+        xor edi, edi
+        syscall
+
+; argc in rdi, argv in rsi (64-bit pointers, anywhere)
+; copies the strings and a 32-bit argv onto the stack below
+; the return address, and returns with it in rsi
+; the return address is popped, so the stack stays there
+?lower_args:
+        pop r11
+        mov r12, rdi
+        mov r13, rsi
+        xor r14d, r14d
+.copy:  cmp r14, r12
+        jge .table
+        mov rsi, [r13+8*r14]
+        mov rdi, rsi
+        xor eax, eax
+        mov rcx, -1
+        repne scasb
+        sub rdi, rsi            ; length with the 0
+        mov rcx, rdi
+        sub rsp, rcx
+        mov rdi, rsp
+        rep movsb
+        mov [r13+8*r14], rsp    ; the old argv is scratch now
+        inc r14
+        jmp .copy
+.table: and rsp, -16
+        lea rax, [4*r12+4]
+        sub rsp, rax
+        and rsp, -16
+        xor r14d, r14d
+.fill:  cmp r14, r12
+        jge .done
+        mov rax, [r13+8*r14]
+        mov [rsp+4*r14], eax
+        inc r14
+        jmp .fill
+.done:  mov dword [rsp+4*r12], 0
+        mov rdi, r12
+        mov rsi, rsp
+        jmp r11
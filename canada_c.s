@@ -5,3 +5,13 @@ GLOBAL _main
 EXTERN ?@main
 _main:
     jmp ?@main
+
+; where linux syscalls go (see canada.s), always int 80h here
+SECTION .data
+GLOBAL ?vsyscall
+?vsyscall: dd ?int80
+
+SECTION .text
+?int80:
+    int 80h
+    ret
@@ -0,0 +1,73 @@
+; wrapper for linking code from canadacodegen.py --target x86-64
+; with libc, link with -no-pie
+; like canada64.s, main runs on a stack below 4 GiB with a 32-bit argv
+GLOBAL main
+EXTERN ?@main
+
+SECTION .bss
+        alignb 16
+?stack: resb 8388608
+?stack_top:
+?c_rsp: resq 1
+
+SECTION .text
+main:
+        ; Canada code clobbers everything
+        push rbx
+        push rbp
+        push r12
+        push r13
+        push r14
+        push r15
+        mov [?c_rsp], rsp
+        mov rsp, ?stack_top
+        movsxd rdi, edi         ; argc, argv already in rsi
+        call ?lower_args
+        push rsi
+        push rdi
+        call ?@main             ; leaves the return value in eax
+        mov rsp, [?c_rsp]
+        pop r15
+        pop r14
+        pop r13
+        pop r12
+        pop rbp
+        pop rbx
+        ret
+
+; same as in canada64.s
+?lower_args:
+        pop r11
+        mov r12, rdi
+        mov r13, rsi
+        xor r14d, r14d
+.copy:  cmp r14, r12
+        jge .table
+        mov rsi, [r13+8*r14]
+        mov rdi, rsi
+        xor eax, eax
+        mov rcx, -1
+        repne scasb
+        sub rdi, rsi            ; length with the 0
+        mov rcx, rdi
+        sub rsp, rcx
+        mov rdi, rsp
+        rep movsb
+        mov [r13+8*r14], rsp    ; the old argv is scratch now
+        inc r14
+        jmp .copy
+.table: and rsp, -16
+        lea rax, [4*r12+4]
+        sub rsp, rax
+        and rsp, -16
+        xor r14d, r14d
+.fill:  cmp r14, r12
+        jge .done
+        mov rax, [r13+8*r14]
+        mov [rsp+4*r14], eax
+        inc r14
+        jmp .fill
+.done:  mov dword [rsp+4*r12], 0
+        mov rdi, r12
+        mov rsi, rsp
+        jmp r11
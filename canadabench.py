@@ -0,0 +1,214 @@
+"""
+Compiler throughput: generates synthetic Canada programs and times
+tokenizing (canadaparse.tokenize), parsing (canadaparse.parse) and
+code generation (CodeGenerator.generate) on each, separately.
+
+    python3 canadabench.py --save compiler_baseline.json
+    python3 canadabench.py --baseline compiler_baseline.json
+
+The second run fails if any phase of any program got slower than the
+baseline by more than the threshold (20% by default). Times are the
+best of --repeat runs, so they are comparable on the same machine.
+
+    python3 canadabench.py --memory
+
+reports the peak RSS of parsing a large program instead.
+"""
+import gc
+import io
+import json
+import resource
+import sys
+import time
+
+import canadaparse
+
+from canadacodegen import CodeGenerator
+
+def functions(n):
+    "n small functions, each calling the one before"
+    out = ['extern void print_int(n);\n', 'int f0(x) { return x; }\n']
+    for i in range(1, n):
+        out.append('int f%d(x) {\n    int y;\n    y = x * %d + 1;\n'
+                   '    if (y > 100)\n        y = y - 100;\n    return f%d(y);\n}\n' % (i, i, i - 1))
+    out.append('void main(argc, argv) {\n    print_int(f%d(argc));\n}\n' % (n - 1))
+    return ''.join(out)
+
+def nesting(n):
+    "ifs and whiles nested n deep (not indented, that would be mostly spaces)"
+    out = ['void main(argc, argv) {\n    int i;\n    i = argc;\n']
+    for d in range(n):
+        out.append(('while (i < %d) {\n' if d % 2 else 'if (i > %d) {\n') % d)
+    out.append('i = i + 1;\n')
+    out.append('}\n' * n)
+    out.append('}\n')
+    return ''.join(out)
+
+def blocks(n):
+    "blocks nested n deep, each declaring a variable and using the one outside it"
+    out = ['void main(argc, argv) {\n    int v0;\n    v0 = argc;\n']
+    for d in range(1, n):
+        out.append('{\nint v%d;\nv%d = v%d + 1;\n' % (d, d, d - 1))
+    out.append('}\n' * n)
+    return ''.join(out)
+
+def expressions(n):
+    "an assignment of an n term expression, mixing operators and parentheses"
+    ops = ['+', '*', '-', '&', '|', '^', '<<', '%']
+    terms = []
+    for i in range(n):
+        t = ('a', 'b', 'c', '(a + %d)' % i)[i % 4]
+        terms.append(t + ' ' + ops[i % len(ops)] + ' ')
+    return ('void main(argc, argv) {\n    int a;\n    int b;\n    int c;\n'
+            '    a = argc;\n    b = 2;\n    c = 3;\n'
+            '    a = ' + ''.join(terms) + '1;\n}\n')
+
+def arrays(n):
+    "a global int array literal of n elements"
+    return ('int[%d] table = {%s};\n'
+            'void main(argc, argv) {\n    table[0] = argc;\n}\n' % (n, ', '.join(str(i * 7 % 1000) for i in range(n))))
+
+def strings(n):
+    "n string literals"
+    out = ['extern void write(p, n);\n', 'void main(argc, argv) {\n']
+    for i in range(n):
+        out.append('    write("string number %d\\n", %d);\n' % (i, 15 + len(str(i))))
+    out.append('}\n')
+    return ''.join(out)
+
+def large(n):
+    "a global array literal of 2n elements and a main of n statements"
+    return ('int[%d] table = {%s};\n'
+            'void main(argc, argv) {\n%s}\n' % (2 * n, ', '.join(str(i * 7 % 1000) for i in range(2 * n)),
+                                               '    table[0] = table[1] + argc;\n' * n))
+
+# name: (generator, size)
+PROGRAMS = {
+    'functions': (functions, 1000),
+    'nesting': (nesting, 2000),
+    'blocks': (blocks, 2000),
+    'expressions': (expressions, 5000),
+    'arrays': (arrays, 50000),
+    'strings': (strings, 3000),
+}
+
+PHASES = ('tokenize', 'parse', 'generate')
+
+def timed(f):
+    "how long f() takes, without the garbage collector (like timeit)"
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        start = time.perf_counter()
+        f()
+        return time.perf_counter() - start
+    finally:
+        if enabled:
+            gc.enable()
+
+def measure(code, repeat=5):
+    "{phase: seconds} for compiling code"
+    tokens = canadaparse.tokenize(code)
+    def generate():
+        # generate changes the tree (string literals, array lengths)
+        ast = canadaparse.parse(code, tokens)
+        return timed(lambda: CodeGenerator(io.StringIO(), linux=True, c_prefix='').generate(ast))
+    return {
+        'tokenize': min(timed(lambda: canadaparse.tokenize(code)) for _ in range(repeat)),
+        'parse': min(timed(lambda: canadaparse.parse(code, tokens)) for _ in range(repeat)),
+        'generate': min(generate() for _ in range(repeat)),
+    }
+
+def run(names, scale=1.0, repeat=5):
+    "{program: {phase: seconds}}"
+    results = {}
+    for name in names:
+        gen, size = PROGRAMS[name]
+        results[name] = measure(gen(max(1, int(size * scale))), repeat)
+    return results
+
+def max_rss():
+    "the most memory this process has had, in bytes"
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # KiB on linux, bytes on macOS
+    return rss if sys.platform == 'darwin' else rss * 1024
+
+def memory(code):
+    """
+    (before, after): the peak RSS of this process before and after
+    parsing code, while it still has the tree
+    """
+    before = max_rss()
+    ast = canadaparse.parse(code)
+    after = max_rss()
+    del ast
+    return before, after
+
+def regressions(results, baseline, threshold):
+    "[(program, phase, baseline seconds, seconds)] slower than allowed"
+    slow = []
+    for name, phases in results.items():
+        for phase, t in phases.items():
+            base = baseline.get(name, {}).get(phase)
+            if base is not None and t > base * (1 + threshold):
+                slow.append((name, phase, base, t))
+    return slow
+
+def report(results, baseline, out):
+    out.write('%-12s' % 'program' + ''.join('%14s' % p for p in PHASES) + '\n')
+    for name, phases in results.items():
+        line = '%-12s' % name
+        for phase in PHASES:
+            cell = '%.4f' % phases[phase]
+            base = baseline.get(name, {}).get(phase) if baseline else None
+            if base:
+                cell += ' %+d%%' % round((phases[phase] / base - 1) * 100)
+            line += '%14s' % cell
+        out.write(line + '\n')
+
+if __name__ == '__main__':
+    import argparse
+    ap = argparse.ArgumentParser(description='Time the compiler on synthetic programs')
+    ap.add_argument('programs', nargs='*', help='which of ' + ', '.join(PROGRAMS) + ' (default: all)')
+    ap.add_argument('--scale', type=float, default=1.0, help='multiply the size of each program')
+    ap.add_argument('--repeat', type=int, default=5, help='runs per phase, the fastest counts')
+    ap.add_argument('--baseline', help='compare against this file, fail on regressions')
+    ap.add_argument('--threshold', type=float, default=0.2, help='allowed slowdown against the baseline')
+    ap.add_argument('--save', help='write the results to this file')
+    ap.add_argument('--dump', metavar='DIR', help='write the generated programs to DIR instead of timing them')
+    ap.add_argument('--memory', action='store_true',
+                    help='report the peak RSS of parsing a 200000 element array literal and 100000 '
+                         'statements (times --scale) instead of timing')
+    args = ap.parse_args()
+    if args.memory:
+        code = large(max(1, int(100000 * args.scale)))
+        before, after = memory(code)
+        sys.stdout.write('peak RSS %.0f MB, %.0f MB before parsing\n' % (after / 1e6, before / 1e6))
+        sys.exit(0)
+    names = args.programs or list(PROGRAMS)
+    for name in names:
+        if name not in PROGRAMS:
+            ap.error('unknown program ' + name)
+    if args.dump:
+        import os
+        for name in names:
+            gen, size = PROGRAMS[name]
+            with open(os.path.join(args.dump, name + '.ca'), 'w') as f:
+                f.write(gen(max(1, int(size * args.scale))))
+        sys.exit(0)
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    results = run(names, args.scale, args.repeat)
+    report(results, baseline, sys.stdout)
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=4, sort_keys=True)
+            f.write('\n')
+    if baseline:
+        slow = regressions(results, baseline, args.threshold)
+        for name, phase, base, t in slow:
+            sys.stdout.write('REGRESSION: %s %s %.4fs -> %.4fs\n' % (name, phase, base, t))
+        if slow:
+            sys.exit(1)
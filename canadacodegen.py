@@ -1,8 +1,13 @@
 import functools
+import io
+import re
+import canadaopt
 import canadaparse
+import canadareport
+import canadastats
 
-from canadaparse import Program, GlobalDeclaration, GlobalVariable, VariableType, PrimitiveType, Void, ArrayDeclaration, ArrayLiteral, Function, BlockStatement, Statement, EmptyStatement, IfStatement, WhileLoop, BreakStatement, ContinueStatement, ReturnStatement, VariableDeclaration, Block, Expression, ExpressionStatement, Literal, BinaryExpression, FunctionCall, LValue, SimpleLValue, Identifier, Dereference, Address, ArrayAccess, Unary, Export, Extern
-from syscall import syscalls
+from canadaparse import Program, GlobalDeclaration, GlobalVariable, VariableType, PrimitiveType, Void, ArrayDeclaration, ArrayLiteral, Function, BlockStatement, Statement, EmptyStatement, IfStatement, WhileLoop, SwitchStatement, Case, BreakStatement, ContinueStatement, ReturnStatement, VariableDeclaration, Block, Expression, ExpressionStatement, Literal, BinaryExpression, FunctionCall, LValue, SimpleLValue, Identifier, Dereference, Address, ArrayAccess, Unary, Export, Extern, expr_text
+from syscall import syscalls, syscalls_freebsd, syscalls_darwin, syscalls_x86_64
 
 import os
 
@@ -35,12 +40,35 @@ rel_ops_not = {
     '!=': 'e',
 }
 
+# switch dispatch: up to SWITCH_LINEAR cases are compared one by one,
+# a jump table is used if it would be at most SWITCH_DENSITY times the
+# number of cases long, otherwise a binary search
+SWITCH_LINEAR = 3
+SWITCH_DENSITY = 3
+# if/else ladders with at least this many arms are compiled as switches
+LADDER_MIN = 4
+
+# memset(dst, c, n), memcpy(dst, src, n) and memcmp(a, b, n) are inlined
+# unless the program defines or declares its own
+builtins = ('memset', 'memcpy', 'memcmp')
+# memset and memcpy of up to this many constant bytes are unrolled
+UNROLL_MAX = 32
+
+# globals are aligned to their element size, and arrays of at least
+# LARGE_ARRAY bytes to a cache line
+CACHE_LINE = 64
+LARGE_ARRAY = 256
+
+# with profile, main's module writes its counters here when main returns
+PROFILE_FILE = 'canada.prof'
+
 class CompilationError(Exception):
     def __init__(self, message, source):
         super().__init__(message)
         self.source = source
 
 class CFunction(Function):
+    __slots__ = ('varargs',)
     def __init__(self, ext):
         ":type ext: Extern"
         Function.__init__(self, ext.type, ext.name, ext.par_list)
@@ -57,12 +85,15 @@ class StackEntry:
         self.var = var
         self.addr = addr
     def value(self, offset=0, prefix=True):
-        oprefix = '4*' if self.var.type == 'int' else ''
-        if isinstance(offset, str):
-            return self.value(0, prefix)[:-1] + '+' + oprefix + offset + ']'
-        offset += self.addr
+        """
+        the operand for element offset of an array (a constant, or a
+        register holding the index), or for the variable itself
+        """
         pt = self.var.type.type if isinstance(self.var.type, PrimitiveType) else self.var.type.prim_type
-        return (('dword' if pt == 'int' else 'byte') if prefix else '') + '[ebp' + ('+' + oprefix + str(offset) if offset >= 0 else '-' + oprefix + str(-offset)) + ']'
+        if isinstance(offset, str):
+            return self.value(0, prefix)[:-1] + '+' + ('4*' if pt == 'int' else '') + offset + ']'
+        offset = self.addr + PrimitiveType.sizeof(pt) * offset
+        return (('dword' if pt == 'int' else 'byte') if prefix else '') + '[ebp' + ('+' + str(offset) if offset >= 0 else '-' + str(-offset)) + ']'
     def __str__(self):
         return '<' + repr(self.var) + ' at ' + self.value() + '>'
 
@@ -74,88 +105,287 @@ class GlobalStackEntry(StackEntry):
         super().__init__(VariableDeclaration(type, name), name)
         self.name = name
     def value(self, offset=0, prefix=True):
-        oprefix = '4*' if self.var.type == 'int' else ''
         pt = self.var.type.type if isinstance(self.var.type, PrimitiveType) else self.var.type.prim_type
         if isinstance(offset, str):
-            return (('dword' if pt == 'int' else 'byte') if prefix else '') + '[' + self.name + '+' + oprefix + offset + ']'
-        return (('dword' if pt == 'int' else 'byte') if prefix else '') + '[' + self.name + ('+' + oprefix + str(offset) if offset >= 0 else '-' + oprefix + str(-offset)) + ']'
+            return (('dword' if pt == 'int' else 'byte') if prefix else '') + '[' + self.name + '+' + ('4*' if pt == 'int' else '') + offset + ']'
+        offset *= PrimitiveType.sizeof(pt)
+        return (('dword' if pt == 'int' else 'byte') if prefix else '') + '[' + self.name + ('+' + str(offset) if offset >= 0 else '-' + str(-offset)) + ']'
 
 class StackFrame:
-    def __init__(self, parameters):
+    """
+    One scope in a chain of scopes. A frame only holds the names
+    declared in its own block and points at the enclosing frame, so
+    entering a block never copies the enclosing variables. The frames
+    of a function share one map of name -> entries, innermost last:
+    a block pushes its names when it opens and pops them when it is
+    closed, so a lookup is the top of one list instead of a walk
+    outwards through every enclosing block. Globals are the fallback.
+    """
+    def __init__(self, parameters, parent=None, arg_offset=8, slot=4):
+        """
+        :type parent: StackFrame
+
+        parameter i is at arg_offset + slot * i from the frame pointer
+        """
+        self.parent = parent
+        self.table = {}
+        self.last = parent.last if parent is not None else 0
+        self.shadowed = [] # (entry, shadowed entry)
+        if parent is None:
+            self.depth, self.scopes, self.gvars = 0, {}, {}
+        elif parent.depth == 0:
+            # a function's frame starts a new set of local names
+            self.depth, self.scopes, self.gvars = 1, {}, parent.table
+        else:
+            self.depth, self.scopes, self.gvars = parent.depth + 1, parent.scopes, parent.gvars
         if parameters is None: return
-        self.stack = [StackEntry(VariableDeclaration(PrimitiveType('int'), p), 8 + 4 * i) for i, p in reversed(list(enumerate(parameters)))]
-        self.build_table()
+        for i, p in enumerate(parameters):
+            self._add(StackEntry(VariableDeclaration(PrimitiveType('int'), p), arg_offset + slot * i))
     def get_last(self):
         "get last address on stack (not parameter)"
-        if self.stack and self.stack[-1].addr <= 0:
-            return self.stack[-1].addr
-        return 0
-    def build_table(self):
-        "rebuild variable table"
-        self.table = {p.var.name: p for p in self.stack}
-    def _extend(self, variables):
-        old = self.get_last()
-        for v in variables:
-            self.stack.append(StackEntry(v, self.get_last() - v.type.size()))
-        ret = old - self.get_last()
-        self.build_table()
-        assert ret == sum(v.type.size() for v in variables)
-        return ret
-    def extend(self, variables):
+        return self.last
+    def _add(self, entry):
+        name = entry.var.name
+        entries = self.scopes.setdefault(name, [])
+        if name in self.table:
+            # declared twice in one block, the last one counts
+            entries[-1] = (self.depth, entry)
+        else:
+            outer = self.find(name)
+            if outer is not None:
+                self.shadowed.append((entry, outer))
+            entries.append((self.depth, entry))
+        self.table[name] = entry
+    def declare(self, var):
+        """
+        :type var: VariableDeclaration
+        """
+        self.last -= var.type.size()
+        self._add(StackEntry(var, self.last))
+    def extend(self, variables, align=4):
         "returns (StackFrame, int) where int is size of variables"
-        newstack = StackFrame(None)
-        newstack.stack = self.stack[:]
-        newstack.table = None # will be filled in _extend
-        return newstack, newstack._extend(variables)
+        frame = StackFrame(None, self)
+        for v in variables:
+            frame.declare(v)
+        frame.last -= frame.last % align
+        return frame, self.last - frame.last
+    def close(self):
+        "the block is done, its names are no longer visible"
+        for name in self.table:
+            entries = self.scopes[name]
+            entries.pop()
+            if not entries:
+                del self.scopes[name]
     def size(self):
         "in bytes, does not include parameters"
-        if not self.stack:
-            return 0
-        last = self.stack[-1]
-        if last.addr > 0:
-            return 0
-        ret = -last.addr
-        assert ret == sum(a.var.type.size() for a in self.stack if a.addr < 0)
-        return ret
+        return -self.last
+    def find(self, name):
+        "returns the innermost entry for name or None"
+        entries = self.scopes.get(name)
+        if entries:
+            # skip the names of blocks nested in this one that are still open
+            for depth, entry in reversed(entries):
+                if depth <= self.depth:
+                    return entry
+        return self.gvars.get(name)
     def __getitem__(self, key):
-        return self.table[key]
+        entry = self.find(key)
+        if entry is None:
+            raise KeyError(key)
+        return entry
     def __contains__(self, key):
-        return key in self.table
+        return self.find(key) is not None
+
+class GlobalFrame(StackFrame):
+    "root of the scope chain, shares the generator's global table"
+    def __init__(self, gvars):
+        StackFrame.__init__(self, None)
+        self.table = self.gvars = gvars
 
-def generate(fn, out=None, margin=16, iwidth=8, width=40):
+def generate(fn, out=None, margin=16, iwidth=8, width=40, elf=False, target='x86', interface=False, interfaces=None, int80=False, profile=False, stats=None, asm_report=None):
     """
     Generate assembly file (out defaults to fn with the
-    file extension replaced by '.s')
+    file extension replaced by '.s', or '.o' if elf)
+
+    if elf, write an ELF32 object directly instead of NASM source
+    target is 'x86' or 'x86-64'
+    if interface, also write the exports to fn with '.cai'
+    interfaces are the symbols of interface files to check
+    externs against (see canadaiface.resolve)
+    if int80, linux syscalls use int 80h instead of the vDSO
+    if profile, count function calls, loop iterations and if/else arms
+    (see canadaprof.py)
+    stats is a canadastats.Stats to record the phases in
+    asm_report is a canadareport.Report to count the instructions in
     """
     import os
     if not out:
-        out = os.path.splitext(fn)[0] + '.s'
-    with open(fn) as f, open(out, 'w') as outf:
-        ast = canadaparse.parse(f.read())
-        CodeGenerator(outf,
-                      margin=margin,
-                      iwidth=iwidth,
-                      width=width).generate(ast)
+        out = os.path.splitext(fn)[0] + ('.o' if elf else '.s')
+    with canadastats.phase(stats, 'read'):
+        with open(fn) as f:
+            code = f.read()
+    if stats is None:
+        ast = canadaparse.parse(code)
+    else:
+        with stats.phase('lex'):
+            tokens = canadaparse.tokenize(code)
+        stats.tokens = len(tokens)
+        with stats.phase('parse'):
+            ast = canadaparse.parse(code, tokens)
+        stats.count_ast(ast)
+    generate_ast(ast, out, margin, iwidth, width, elf, target, interfaces, int80, profile, stats, asm_report)
+    if interface:
+        import canadaiface
+        canadaiface.write(ast, os.path.splitext(fn)[0] + '.cai')
+
+def generate_ast(ast, out, margin=16, iwidth=8, width=40, elf=False, target='x86', interfaces=None, int80=False, profile=False, stats=None, asm_report=None):
+    """
+    Generate code for an already parsed program into the file out
+    (see generate)
+    """
+    if interfaces:
+        import canadaiface
+        canadaiface.resolve(ast, interfaces)
+    cls = targets[target]
+    if elf and cls is not CodeGenerator:
+        raise Exception("ELF objects can only be written for x86")
+    if elf:
+        import canadaelf
+        asm = canadaelf.Assembler()
+        CodeGenerator(None, asm=asm, int80=int80, profile=profile, stats=stats, asm_report=asm_report).generate(ast)
+        with canadastats.phase(stats, 'write'):
+            with open(out, 'wb') as outf:
+                asm.write(outf)
+        return
+    if stats is not None:
+        # generate into memory, so writing is timed on its own
+        buf = io.StringIO()
+        cls(buf, margin=margin, iwidth=iwidth, width=width, int80=int80, profile=profile, stats=stats,
+            asm_report=asm_report).generate(ast)
+        with stats.phase('write'):
+            with open(out, 'w') as outf:
+                outf.write(buf.getvalue())
+        return
+    with open(out, 'w') as outf:
+        cls(outf,
+            margin=margin,
+            iwidth=iwidth,
+            width=width,
+            int80=int80,
+            profile=profile,
+            asm_report=asm_report).generate(ast)
+
+def string_length(s):
+    "bytes in the string literal s, escapes counting as one"
+    return len(s) - s.count('\\') + s.count('\\\\')
+
+def byte_start(s, i):
+    "whether s[i:] starts at a byte of the string literal s, not inside an escape"
+    # the backslashes before it pair up, unless the last one escapes s[i]
+    return (i - len(s[:i].rstrip('\\'))) % 2 == 0
+
+def data_size(v):
+    "bytes the GlobalVariable v takes"
+    if isinstance(v.var_type, PrimitiveType):
+        return 1 if v.var_type.type == 'char' else 4
+    n = v.var_type.length
+    if not n:
+        if isinstance(v.value, ArrayLiteral):
+            n = len(v.value.elements)
+        elif isinstance(v.value, Literal) and v.value.type == 'STRING_LIT':
+            n = string_length(v.value.value)
+    return n * (1 if v.var_type.prim_type == 'char' else 4)
+
+def zeroed(v):
+    "whether the GlobalVariable v is correctly initialized to all zeros"
+    def zero(e):
+        return isinstance(e, Literal) and e.value in (0, '\0')
+    if isinstance(v.var_type, PrimitiveType):
+        return zero(v.value)
+    if not isinstance(v.value, ArrayLiteral):
+        return False
+    n = v.var_type.length or len(v.value.elements)
+    return n > 0 and len(v.value.elements) <= n and all(zero(e) for e in v.value.elements)
+
+def if_ladder(stmt):
+    """
+    If stmt is an if/else if chain of at least LADDER_MIN arms comparing
+    the same variable against constants, returns (Identifier,
+    [(Literal, Statement)...], the final else or None)
+
+    :type stmt: IfStatement
+    """
+    var = None
+    arms = []
+    while isinstance(stmt, IfStatement):
+        cond = stmt.condition
+        if not isinstance(cond, BinaryExpression) or cond.op != '==':
+            break
+        lhs, rhs = cond.lhs, cond.rhs
+        if isinstance(lhs, Literal):
+            lhs, rhs = rhs, lhs
+        if (not isinstance(lhs, Identifier) or not isinstance(rhs, Literal) or rhs.type == 'STRING_LIT' or
+                (var is not None and lhs.name != var.name)):
+            break
+        var = lhs
+        arms.append((rhs, stmt.statement))
+        stmt = stmt.else_clause
+    if len(arms) < LADDER_MIN:
+        return None
+    return var, arms, stmt
 
 class CodeGenerator:
-    def __init__(self, out, margin=16, iwidth=8, width=40, linux=None, c_prefix=None):
+    # bytes per stack slot, and where the first parameter is from ebp
+    slot = 4
+    arg_offset = 8
+    # whether linux syscalls can go through ?vsyscall
+    vsyscall = True
+    def __init__(self, out, margin=16, iwidth=8, width=40, linux=None, c_prefix=None, asm=None, int80=False, profile=False, stats=None, asm_report=None):
+        """
+        :type asm: canadaelf.Assembler
+
+        if asm is given, instructions are encoded by it
+        and nothing is written to out
+        linux syscalls call ?vsyscall (set up by canada.s)
+        unless int80
+        if profile, the code counts the times it goes through each
+        function, loop body and if/else arm in ?profile, and
+        ?@?dump_profile (called by canada.s) writes them to PROFILE_FILE
+        stats is a canadastats.Stats for the generator's phases and the
+        instructions per function
+        asm_report is a canadareport.Report for the static counts of
+        each function and loop
+        """
         import os
         self.out = out
+        self.int80 = int80
+        self.profile = profile
+        self.sites = [] # (function, kind, source) per profile counter
+        self.stats = stats
+        self.written = 0 # instructions, for stats
+        self.report = asm_report
+        self.asm = asm
         self.margin = margin
         self.iwidth = iwidth
         self.width = width
         self.whilec = 0
         self.ifc = 0
-        self.stringc = 0
+        self.switchc = 0
         self.labelc = 0 # number of generic labels
         # generic labels are usually generated by comparisons
         # and short-circuiting
         self.gvars = {}
+        self.globals = GlobalFrame(self.gvars)
         self.gfuncs = {}
         self.functions = []
         self.variables = []
         self.exports = []
         self.externs = []
+        self.literals = {} # string literal -> label, for each different one
+        self.string_bytes = 0 # in the string literals used, counting every use
+        self.rodata_strings = 0 # bytes of them written
+        self.tables = [] # (name, [label...]) for switches
+        self.function_label = None
         self._label = None
         # autodetect os stuff
         sysname = os.uname()[0]
@@ -179,6 +409,10 @@ class CodeGenerator:
             raise Exception("Unknown if " + sysname + " is linux or not")
         if self.c_prefix is None:
             raise Exception("Unknown if " + sysname + " has prefix for C symbols")
+        if self.linux:
+            self.syscalls = syscalls
+        else:
+            self.syscalls = syscalls_darwin if sysname == 'Darwin' else syscalls_freebsd
     def warn(self, message, source):
         import sys
         sys.stderr.write('WARNING: ' + message + '\n')
@@ -196,10 +430,23 @@ class CodeGenerator:
         """
         if self._label:
             if label:
-                self.out.write(self._label + ':\n')
+                self.emit(self._label)
             else:
                 label = self._label
             self._label = None
+        if inst:
+            self.written += 1
+            if self.report is not None:
+                self.report.instruction(inst, code)
+        self.emit(label, inst, code, comment)
+    def emit(self, label=None, inst=None, code=None, comment=None):
+        """
+        Output one line: formatted as NASM source, or straight
+        to the assembler if there is one
+        """
+        if self.asm is not None:
+            self.asm.line(label, inst, code)
+            return
         if not inst:
             if label:
                 self.out.write(label + ':\n')
@@ -226,23 +473,112 @@ class CodeGenerator:
         Generate the assembly code from the AST
         """
         assert isinstance(ast, Program)
-        self.variables = [d for d in ast.decls if isinstance(d, GlobalVariable)]
-        self.functions = [d for d in ast.decls if isinstance(d, Function)]
-        self.exports = [d for d in ast.decls if isinstance(d, Export)]
-        self.externs = [d for d in ast.decls if isinstance(d, Extern)]
-        assert all(sum((x in self.variables, x in self.functions, x in self.exports, x in self.externs)) == 1 for x in ast.decls)
+        with canadastats.phase(self.stats, 'classify'):
+            self.classify(ast)
+        with canadastats.phase(self.stats, 'constants'):
+            self.propagate_constants()
+            canadaopt.evaluate_calls(self.functions, self.gfuncs)
+        with canadastats.phase(self.stats, 'exports'):
+            self.generate_exports()
+        with canadastats.phase(self.stats, 'externs'):
+            self.generate_externs()
+            if self.linux and self.vsyscall and not self.int80:
+                self.write('EXTERN ?vsyscall')
+        with canadastats.phase(self.stats, 'text'):
+            self.generate_text()
+        with canadastats.phase(self.stats, 'data'):
+            self.generate_data()
+        if self.stats is not None:
+            self.stats.string_literals = len(self.literals)
+            self.stats.string_bytes_saved = self.string_bytes - self.rodata_strings
+    def classify(self, ast):
+        """
+        Sort the declarations of the program by kind
+        """
+        self.variables = []
+        self.functions = []
+        self.exports = []
+        self.externs = []
+        self.literals = {}
+        self.string_bytes = 0
+        self.tables = []
+        self.sites = []
+        # classify in a single pass; each decl goes in exactly one list
+        kinds = ((GlobalVariable, self.variables),
+                 (Function, self.functions),
+                 (Export, self.exports),
+                 (Extern, self.externs))
+        for d in ast.decls:
+            for kind, decls in kinds:
+                if isinstance(d, kind):
+                    decls.append(d)
+                    break
+            else:
+                assert False
         self.gvars = {v.name: GlobalStackEntry(v.var_type, v.name) for v in self.variables}
+        self.globals = GlobalFrame(self.gvars)
         self.gfuncs = {v.name: v for v in self.functions}
-        self.generate_exports()
-        self.generate_externs()
-        self.generate_text()
-        self.generate_data()
+        if self.profile and 'main' not in self.gfuncs:
+            raise CompilationError("Only a module with main can be profiled, "
+                                   "compile the rest with it using canadalink.py", ast)
+    def propagate_constants(self):
+        """
+        Use the value of each scalar global that no function in the
+        module writes or takes the address of instead of loading it
+        (folding the operators that gives constant operands), and leave
+        out the globals nothing uses then. Exported globals can be
+        written by other modules, so they stay.
+        """
+        if not self.variables:
+            return
+        exported = {e.name for e in self.exports}
+        used, written = canadaopt.global_uses(self.functions)
+        values = canadaopt.constant_globals(self.variables, written | exported)
+        if values:
+            for f in self.functions:
+                canadaopt.substitute(f, values)
+        # every read of those is gone
+        used = (used - set(values)) | exported
+        self.variables = [v for v in self.variables if v.name in used]
+        self.gvars = {v.name: GlobalStackEntry(v.var_type, v.name) for v in self.variables}
+        self.globals = GlobalFrame(self.gvars)
     def string(self, s):
-        i = self.stringc
-        self.stringc += 1
-        name = '??sl' + str(i)
-        self.variables.append(GlobalVariable(VariableDeclaration(ArrayDeclaration('char', len(s) - s.count('\\') + s.count('\\\\')), name), Literal('STRING_LIT', s)))
+        "the label of the string literal s, the same one for the same string"
+        self.string_bytes += string_length(s)
+        name = self.literals.get(s)
+        if name is None:
+            name = self.literals[s] = '??sl' + str(len(self.literals))
         return name
+    def generate_strings(self):
+        """
+        Generate the string literals, longest first: one that is the end
+        of another one already written is a label inside that instead
+        of a copy
+        """
+        lengths = {len(s) for s in self.literals}
+        hosts = [] # (s, [(index in s, label)])
+        tails = {} # s[i:] of a host -> (its labels, i)
+        for s in sorted(self.literals, key=len, reverse=True):
+            if s in tails:
+                labels, i = tails[s]
+                labels.append((i, self.literals[s]))
+                continue
+            labels = [(0, self.literals[s])]
+            hosts.append((s, labels))
+            for n in lengths:
+                i = len(s) - n
+                if i >= 0 and byte_start(s, i):
+                    tails.setdefault(s[i:], (labels, i))
+        self.rodata_strings = 0
+        for s, labels in hosts:
+            self.rodata_strings += string_length(s)
+            labels.sort()
+            ends = [i for i, _ in labels[1:]] + [len(s)]
+            for (i, name), end in zip(labels, ends):
+                if i == end:
+                    self.write(label=name)
+                else:
+                    self.write('db', '`' + s[i:end] + '`', label=name)
     def value(self, t, v):
         """
         :type t: str
@@ -271,15 +607,13 @@ class CodeGenerator:
         Generate the instructions for a variable
         :type v: GlobalVariable
         """
-        if v.name == '_start':
-            raise CompilationError('Reserved name', v)
-        prim_type = v.var_type if isinstance(v.var_type, PrimitiveType) else v.var_type.prim_type
+        prim_type = v.var_type.type if isinstance(v.var_type, PrimitiveType) else v.var_type.prim_type
         dd = 'db' if prim_type == 'char' else 'dd'
         if isinstance(v.var_type, ArrayDeclaration):
             arr_size = v.var_type.length
             if not isinstance(v.value, ArrayLiteral):
                 if isinstance(v.value, Literal) and v.value.type == 'STRING_LIT' and prim_type == 'char':
-                    lit_len = len(v.value.value) - v.value.value.count('\\') + v.value.value.count('\\\\')
+                    lit_len = string_length(v.value.value)
                     if not arr_size:
                         arr_size = lit_len
                         v.var_type.length = lit_len
@@ -294,24 +628,83 @@ class CodeGenerator:
                 if not arr_size:
                     arr_size = len(v.value.elements)
                     v.var_type.length = arr_size
-                if len(v.value.elements) != arr_size:
+                if len(v.value.elements) > arr_size:
                     raise CompilationError("Array literal wrong size", v)
-                self.write(dd, ','.join(map(str, map(
-                    functools.partial(self.value, prim_type), v.value.elements))),
-                    label=v.name)
+                label = v.name
+                if v.value.elements:
+                    self.write(dd, ','.join(map(str, map(
+                        functools.partial(self.value, prim_type), v.value.elements))),
+                        label=label)
+                    label = None
+                # the rest is zeros, like C
+                if len(v.value.elements) < arr_size:
+                    self.write('times', str(arr_size - len(v.value.elements)) + ' ' + dd + ' 0', label=label)
         else:
             self.write(dd, str(self.value(prim_type, v.value)), label=v.name)
+    def generate_reserved(self, v):
+        """
+        Reserve the space for a variable that starts as zeros
+        :type v: GlobalVariable
+        """
+        if isinstance(v.var_type, PrimitiveType):
+            n = 1
+            prim_type = v.var_type.type
+        else:
+            if not v.var_type.length:
+                v.var_type.length = len(v.value.elements)
+            n = v.var_type.length
+            prim_type = v.var_type.prim_type
+        self.write('resb' if prim_type == 'char' else 'resd', str(n), label=v.name)
+    def align(self, v, offset, inst='align'):
+        """
+        Write inst (align, or alignb in .bss) if v would not be
+        aligned at offset in its section, returns the offset after v
+        """
+        size = data_size(v)
+        if isinstance(v.var_type, ArrayDeclaration) and size >= LARGE_ARRAY:
+            alignment = CACHE_LINE
+        elif (v.var_type.type if isinstance(v.var_type, PrimitiveType) else v.var_type.prim_type) == 'char':
+            alignment = 1
+        else:
+            alignment = 4
+        pad = -offset % alignment
+        # a cache line is more than the section is aligned to by default,
+        # the directive makes it that aligned
+        if pad or alignment == CACHE_LINE:
+            self.write(inst, str(alignment))
+        return offset + pad + size
     def generate_data(self):
         """
-        Generate the .data section
+        Generate the .data section, .bss for the globals that start as
+        zeros and .rodata for string literals and jump tables
         """
         self.write('SECTION .data')
-        vl = len(self.variables)
-        for v in self.variables[:]:
-            self.generate_variable(v)
-        # second pass, if there were any arrays of string literals
-        for v in self.variables[vl:]:
+        offset = 0
+        bss = []
+        for v in self.variables:
+            if v.name == '_start':
+                raise CompilationError('Reserved name', v)
+            if zeroed(v):
+                bss.append(v)
+                continue
+            offset = self.align(v, offset)
             self.generate_variable(v)
+        if self.profile:
+            self.generate_profile()
+        if bss:
+            self.write('SECTION .bss')
+            offset = 0
+            for v in bss:
+                offset = self.align(v, offset, 'alignb')
+                self.generate_reserved(v)
+        # last, the arrays in .data can add string literals
+        if self.literals or self.tables:
+            self.write('SECTION .rodata')
+        self.generate_strings()
+        if self.tables:
+            self.write('align', '4')
+        for name, labels in self.tables:
+            self.write('dd', ','.join(labels), label=name)
     def generate_text(self):
         """
         Generate the .text section
@@ -319,6 +712,55 @@ class CodeGenerator:
         self.write('SECTION .text')
         for f in self.functions:
             self.generate_function(f)
+        if self.profile:
+            self.generate_dump_profile()
+    def count(self, kind, source=''):
+        """
+        returns the steps that count one pass through a profiled site
+        of the current function (none without profile). source is text
+        or the expression the site is about, only printed with profile.
+        """
+        if not self.profile:
+            return []
+        if isinstance(source, Expression):
+            source = expr_text(source)
+        self.sites.append((self.function_label[2:], kind, source))
+        return [self.later('inc', 'dword [?profile+' + str(4 * len(self.sites)) + ']')]
+    def profile_names(self):
+        "the descriptions of the profile counters, as stored after them"
+        return ''.join('\t'.join(site) + '\n' for site in self.sites).encode()
+    def generate_profile(self):
+        """
+        The profile counters: the number of sites, a dword per site and
+        a line per site with its function, kind and source, tab separated
+        """
+        self.write('align', '4')
+        self.write('dd', str(len(self.sites)), label='?profile')
+        if self.sites:
+            self.write('times', str(len(self.sites)) + ' dd 0')
+        names = self.profile_names()
+        for i in range(0, len(names), 16):
+            self.write('db', ','.join(map(str, names[i:i + 16])))
+    def generate_dump_profile(self):
+        """
+        ?@?dump_profile() writes ?profile to PROFILE_FILE, uncounted
+        """
+        size = 4 + 4 * len(self.sites) + len(self.profile_names())
+        # O_WRONLY | O_CREAT | O_TRUNC
+        flags = 0o1101 if self.linux else 0o3001
+        fd = Identifier('fd')
+        table = Address(ArrayAccess('?profile', Literal('INT_LIT', 0)))
+        self.gvars['?profile'] = GlobalStackEntry(ArrayDeclaration('char', size), '?profile')
+        body = Block([
+            VariableDeclaration(PrimitiveType('int'), 'fd'),
+            ExpressionStatement(BinaryExpression('=', fd, FunctionCall('$open', [
+                Literal('STRING_LIT', PROFILE_FILE + '\\0'), Literal('INT_LIT', flags), Literal('INT_LIT', 0o644)]))),
+            IfStatement(BinaryExpression('>=', fd, Literal('INT_LIT', 0)), Block([
+                ExpressionStatement(FunctionCall('$write', [fd, table, Literal('INT_LIT', size)])),
+                ExpressionStatement(FunctionCall('$close', [fd]))]))])
+        self.profile = False
+        self.generate_function(Function(Void(), '?dump_profile', [], body))
+        self.profile = True
     def generate_function(self, f):
         """
         :type f: Function
@@ -327,10 +769,16 @@ class CodeGenerator:
             if len(f.par_list) != 2:
                 raise CompilationError("Main must have 2 parameters", f)
         self.gfuncs[f.name] = f
-        stack = StackFrame(f.par_list)
-        self.label('?@' + f.name)
+        stack = StackFrame(f.par_list, self.globals, self.arg_offset, self.slot)
+        self.report_shadowing(stack)
+        self.function_label = '?@' + f.name
+        start = self.written
+        if self.report is not None:
+            self.report.function(f.name)
+        self.label(self.function_label)
         self.write('push', 'ebp')
         self.write('mov', 'ebp,esp')
+        self.run(functools.partial(self.count, 'function', f.prototype()))
         # function body
         self.generate_statement(f.statement, stack, function=True)
         # return
@@ -340,10 +788,14 @@ class CodeGenerator:
         self.write('mov', 'esp,ebp')
         self.write('pop','ebp')
         self.write('pop','ebx')
-        self.write('add', 'esp,' + str(4 * len(f.par_list)))
+        self.write('add', 'esp,' + str(self.slot * len(f.par_list)))
         if not isinstance(f.type, Void):
             self.write('push', 'eax')
         self.write('jmp', 'ebx')
+        if self.stats is not None:
+            self.stats.functions[f.name] = self.written - start
+        if self.report is not None:
+            self.report.leave()
     class BlockWrapper:
         def __init__(self, cg, block, stack, function = False):
             """
@@ -359,24 +811,47 @@ class CodeGenerator:
             self.function = function
         def __enter__(self):
             self.vardecs = [v for v in self.block.statements if isinstance(v, VariableDeclaration)]
-            self.stack, self.bsize = self.stack.extend(self.vardecs)
-            assert isinstance(self.stack.size(), int) # make sure this works
+            self.stack, self.bsize = self.stack.extend(self.vardecs, self.cg.slot)
+            self.cg.report_shadowing(self.stack)
+            if self.cg.report is not None:
+                self.cg.report.frame(self.stack.size())
             if self.bsize > 0:
                 self.cg.write('sub', 'esp,' + str(self.bsize))
             return self
         def __exit__(self, *args):
+            self.stack.close()
             if not self.function:
                 if self.bsize > 0:
                     self.cg.write('add', 'esp,' + str(self.bsize))
+    def run(self, step):
+        """
+        Run step and everything it schedules. A step does its own
+        writes and returns the steps that follow it (or None); those
+        run, depth first, before anything scheduled earlier. The
+        traversals are written as steps so that deep expression
+        chains and if/else ladders don't recurse.
+        """
+        work = [step]
+        while work:
+            more = work.pop()()
+            if more:
+                work.extend(reversed(more))
+    def later(self, inst = None, code = None, label=None):
+        "returns a step that writes the instruction"
+        return functools.partial(self.write, inst, code, label)
     def generate_block_body(self, bw, clabel = None, blabel = None):
         """
         :type bw: CodeGenerator.BlockWrapper
         """
+        self.run(functools.partial(self._block_body_steps, bw, clabel, blabel))
+    def _block_body_steps(self, bw, clabel = None, blabel = None):
+        steps = []
         for s in bw.block.statements:
             if isinstance(s, Statement):
-                self.generate_statement(s, bw.stack, False, clabel, blabel)
+                steps.append(functools.partial(self._statement_steps, s, bw.stack, False, clabel, blabel))
             else:
                 assert isinstance(s, VariableDeclaration)
+        return steps
     def generate_block(self, block, stack, function = False, clabel = None, blabel = None):
         """
         :type block: Block
@@ -386,8 +861,11 @@ class CodeGenerator:
 
         clabel and blabel are for continue and break
         """
-        with CodeGenerator.BlockWrapper(self, block, stack, function) as bw:
-            self.generate_block_body(bw, clabel, blabel)
+        self.run(functools.partial(self._block_steps, block, stack, function, clabel, blabel))
+    def _block_steps(self, block, stack, function = False, clabel = None, blabel = None):
+        bw = CodeGenerator.BlockWrapper(self, block, stack, function)
+        bw.__enter__()
+        return self._block_body_steps(bw, clabel, blabel) + [functools.partial(bw.__exit__, None, None, None)]
     def generate_statement(self, stmt, stack, function = False, clabel = None, blabel = None):
         """
         :type stmt: Statement
@@ -395,44 +873,44 @@ class CodeGenerator:
 
         function is only passed to generate_block
         """
+        self.run(functools.partial(self._statement_steps, stmt, stack, function, clabel, blabel))
+    def _statement_steps(self, stmt, stack, function = False, clabel = None, blabel = None):
         if isinstance(stmt, Block):
-            return self.generate_block(stmt, stack, function)
+            return self._block_steps(stmt, stack, function, clabel, blabel)
         if isinstance(stmt, IfStatement):
+            ladder = if_ladder(stmt)
+            if ladder:
+                var, arms, else_clause = ladder
+                arms = [(value, [s]) for value, s in arms]
+                if else_clause:
+                    arms.append((None, [else_clause]))
+                return self._switch_steps(var, arms, stack, clabel, blabel, True)
             l_if = '.if' + str(self.ifc)
             l_else = '.ifelse' + str(self.ifc)
             l_end = '.ifend' + str(self.ifc)
             self.ifc += 1
             self.label(l_if)
-            self.generate_condition(stmt.condition, stack, false=l_else if stmt.else_clause else l_end)
-            self.generate_statement(stmt.statement, stack, False, clabel, blabel)
+            steps = ([functools.partial(self._condition_steps, stmt.condition, stack, None, l_else if stmt.else_clause else l_end)] +
+                     self.count('if', stmt.condition) +
+                     [functools.partial(self._statement_steps, stmt.statement, stack, False, clabel, blabel)])
             if stmt.else_clause:
-                self.write('jmp', l_end)
-                self.label(l_else)
-                self.generate_statement(stmt.else_clause, stack, False, clabel, blabel)
-            self.label(l_end)
+                steps += [self.later('jmp', l_end),
+                          functools.partial(self.label, l_else)]
+                steps += self.count('else', stmt.condition)
+                steps.append(functools.partial(self._statement_steps, stmt.else_clause, stack, False, clabel, blabel))
+            steps.append(functools.partial(self.label, l_end))
+            return steps
         elif isinstance(stmt, WhileLoop):
-            l_begin = '.while' + str(self.whilec)
-            l_end = '.endwhile' + str(self.whilec)
-            self.whilec += 1
-            if isinstance(stmt.statement, Block):
-                with CodeGenerator.BlockWrapper(self, stmt.statement, stack) as bw:
-                    self.label(l_begin)
-                    self.generate_condition(stmt.condition, bw.stack, false=l_end)
-                    self.generate_block_body(bw, l_begin, l_end)
-                    self.write('jmp', l_begin)
-                    self.label(l_end)
-            elif isinstance(stmt.statement, BreakStatement):
-                self.generate_statement(ExpressionStatement(stmt.condition), stack)
-            elif isinstance(stmt.statement, ContinueStatement) or isinstance(stmt.statement, EmptyStatement):
-                # busy loop
-                self.label(l_begin)
-                self.generate_condition(stmt.condition, stack, true=l_begin)
-            else:
-                self.label(l_begin)
-                self.generate_condition(stmt.condition, stack, false=l_end)
-                self.generate_block_body(bw, l_begin, l_end)
-                self.write('jmp', l_begin)
-                self.label(l_end)
+            bulk = self.loop_builtin(stmt, stack)
+            if bulk is not None:
+                return self._statement_steps(bulk, stack, function, clabel, blabel)
+            if self.report is None:
+                return self._while_steps(stmt, stack)
+            self.report.loop('while (' + expr_text(stmt.condition) + ')')
+            return (self._while_steps(stmt, stack) or []) + [self.report.leave]
+        elif isinstance(stmt, SwitchStatement):
+            return self._switch_steps(stmt.expr, [(c.value, c.statements) for c in stmt.cases],
+                                      stack, clabel, blabel)
         elif isinstance(stmt, BreakStatement):
             if not blabel:
                 raise CompilationError("Nowhere to break", stmt)
@@ -442,22 +920,213 @@ class CodeGenerator:
                 raise CompilationError("Nowhere to continue", stmt)
             self.write('jmp', clabel)
         elif isinstance(stmt, ReturnStatement):
+            steps = []
             if stmt.expr is not None:
-                self.push_expr(stmt.expr, stack)
-            self.write('jmp', '.return')
+                steps.append(functools.partial(self._push_expr_steps, stmt.expr, stack))
+            steps.append(self.later('jmp', '.return'))
+            return steps
         elif isinstance(stmt, ExpressionStatement):
-            self.push_expr(stmt.expr, stack, False)
+            return self._push_expr_steps(stmt.expr, stack, False)
         elif isinstance(stmt, EmptyStatement):
             pass
         else:
             assert False
+    def _while_steps(self, stmt, stack):
+        ":type stmt: WhileLoop"
+        l_begin = '.while' + str(self.whilec)
+        l_end = '.endwhile' + str(self.whilec)
+        self.whilec += 1
+        if isinstance(stmt.statement, Block):
+            bw = CodeGenerator.BlockWrapper(self, stmt.statement, stack)
+            bw.__enter__()
+            self.label(l_begin)
+            return ([functools.partial(self._condition_steps, stmt.condition, bw.stack, None, l_end)] +
+                    self.count('while', stmt.condition) +
+                    self._block_body_steps(bw, l_begin, l_end) +
+                    [self.later('jmp', l_begin),
+                     functools.partial(self.label, l_end),
+                     functools.partial(bw.__exit__, None, None, None)])
+        elif isinstance(stmt.statement, BreakStatement):
+            return self._statement_steps(ExpressionStatement(stmt.condition), stack)
+        elif isinstance(stmt.statement, ContinueStatement) or isinstance(stmt.statement, EmptyStatement):
+            # busy loop
+            if self.profile:
+                # with a body to count
+                return self._while_steps(WhileLoop(stmt.condition, Block([])), stack)
+            self.label(l_begin)
+            return self._condition_steps(stmt.condition, stack, true=l_begin)
+        else:
+            self.label(l_begin)
+            return ([functools.partial(self._condition_steps, stmt.condition, stack, None, l_end)] +
+                    self.count('while', stmt.condition) +
+                    [functools.partial(self._statement_steps, stmt.statement, stack, False, l_begin, l_end),
+                    self.later('jmp', l_begin),
+                    functools.partial(self.label, l_end)])
+    def _switch_steps(self, expr, arms, stack, clabel, blabel, ladder=False):
+        """
+        arms is [(Literal, [Statement...])] in order, the Literal is None
+        for default. Arms fall through and break leaves the switch,
+        unless it is an if/else ladder: then each arm ends by jumping
+        past the others and break is the enclosing loop's.
+        """
+        n = self.switchc
+        self.switchc += 1
+        l_end = '.endswitch' + str(n)
+        labels = ['.switch' + str(n) + '_' + str(i) for i in range(len(arms))]
+        cases = {}
+        default = None
+        for (value, _), label in zip(arms, labels):
+            if value is None:
+                if default:
+                    raise CompilationError("More than one default", value)
+                default = label
+                continue
+            v = self.value('int', value)
+            if v in cases:
+                if not ladder:
+                    raise CompilationError("Duplicate case " + repr(value), value)
+                # the first one wins in a ladder
+                continue
+            cases[v] = label
+        steps = [functools.partial(self._reg_expr_steps, expr, 'eax', stack),
+                 functools.partial(self._dispatch, sorted(cases.items()), default or l_end)]
+        for i, ((value, stmts), label) in enumerate(zip(arms, labels)):
+            steps.append(functools.partial(self.label, label))
+            if not ladder:
+                steps += self.count('case', value if value is not None else 'default')
+            elif value is not None:
+                steps += self.count('if', BinaryExpression('==', expr, value))
+            else:
+                steps += self.count('else', '')
+            steps += [functools.partial(self._statement_steps, s, stack, False, clabel, blabel if ladder else l_end)
+                      for s in stmts]
+            if ladder and i < len(arms) - 1:
+                steps.append(self.later('jmp', l_end))
+        steps.append(functools.partial(self.label, l_end))
+        return steps
+    def loop_builtin(self, loop, stack):
+        """
+        If loop fills or copies a char array element by element, as in
+
+            while (i < n) { a[i] = v; i = i + 1; }
+            while (i < n) { a[i] = b[i]; i = i + 1; }
+
+        with n and v not changed by the loop, returns the equivalent
+
+            if (i < n) { memset(&a[i], v, n - i); i = n; }
+
+        (or memcpy) to generate instead. <= works too.
+
+        :type loop: WhileLoop
+        """
+        body, cond = loop.statement, loop.condition
+        if not isinstance(body, Block) or len(body.statements) != 2 or not isinstance(cond, BinaryExpression):
+            return None
+        op, i, n = cond.op, cond.lhs, cond.rhs
+        if op in ('>', '>='):
+            op, i, n = {'>': '<', '>=': '<='}[op], n, i
+        if op not in ('<', '<=') or not isinstance(i, Identifier):
+            return None
+        store, step = body.statements
+        if not isinstance(store, ExpressionStatement) or not isinstance(step, ExpressionStatement):
+            return None
+        store, step = store.expr, step.expr
+        is_i = lambda e: isinstance(e, Identifier) and e.name == i.name
+        one = lambda e: isinstance(e, Literal) and e.type == 'INT_LIT' and e.value == 1
+        # i = i + 1
+        if (not isinstance(step, BinaryExpression) or step.op != '=' or not is_i(step.lhs) or
+                not isinstance(step.rhs, BinaryExpression) or step.rhs.op != '+' or
+                not (is_i(step.rhs.lhs) and one(step.rhs.rhs) or one(step.rhs.lhs) and is_i(step.rhs.rhs))):
+            return None
+        if (not isinstance(store, BinaryExpression) or store.op != '=' or
+                not isinstance(store.lhs, ArrayAccess) or not is_i(store.lhs.index)):
+            return None
+        def char_array(name):
+            entry = stack.find(name)
+            return entry is not None and isinstance(entry.var.type, ArrayDeclaration) and entry.var.type.prim_type == 'char'
+        def invariant(e, byte=False):
+            if isinstance(e, Literal):
+                return e.type == 'CHAR_LIT' or e.type == 'INT_LIT' and (not byte or 0 <= e.value <= 255)
+            return isinstance(e, Identifier) and not is_i(e) and not char_array(e.name)
+        a, v = store.lhs.array, store.rhs
+        entry = stack.find(i.name)
+        if (not char_array(a) or entry is None or not isinstance(entry.var.type, PrimitiveType) or
+                entry.var.type.type != 'int' or not invariant(n)):
+            return None
+        if isinstance(v, ArrayAccess) and is_i(v.index) and v.array != a and char_array(v.array):
+            call = FunctionCall('memcpy', [Address(store.lhs), Address(v), None])
+        elif invariant(v, True):
+            call = FunctionCall('memset', [Address(store.lhs), v, None])
+        else:
+            return None
+        if call.name in self.gfuncs:
+            return None
+        end = n if op == '<' else BinaryExpression('+', n, Literal('INT_LIT', 1))
+        call.args[2] = BinaryExpression('-', end, i)
+        return IfStatement(cond, Block([ExpressionStatement(call),
+                                        ExpressionStatement(BinaryExpression('=', i, end))]), None)
+    def full_label(self, label):
+        "local labels are in the current function"
+        return self.function_label + label if label.startswith('.') else label
+    def _dispatch(self, cases, default):
+        """
+        jump to the label for the value in eax, or default
+
+        :type cases: list
+        cases is [(value, label)] sorted by value
+        """
+        if len(cases) > SWITCH_LINEAR:
+            lo, hi = cases[0][0], cases[-1][0]
+            span = hi - lo + 1
+            if span <= SWITCH_DENSITY * len(cases):
+                table = '??jt' + str(len(self.tables))
+                labels = dict(cases)
+                self.tables.append((table, [self.full_label(labels.get(v, default)) for v in range(lo, hi + 1)]))
+                if lo:
+                    self.write('sub', 'eax,' + str(lo))
+                self.write('cmp', 'eax,' + str(span - 1))
+                self.write('ja', default)
+                self.write('mov', 'eax,dword[' + table + '+4*eax]')
+                self.write('jmp', 'eax')
+                return
+        # binary search, the left half falls through
+        work = [(0, len(cases), None)]
+        while work:
+            lo, hi, label = work.pop()
+            self.label(label)
+            if hi - lo <= SWITCH_LINEAR:
+                for v, l in cases[lo:hi]:
+                    self.write('cmp', 'eax,' + str(v))
+                    self.write('je', l)
+                self.write('jmp', default)
+                continue
+            mid = (lo + hi) // 2
+            v, l = cases[mid]
+            right = '.l' + str(self.labelc)
+            self.labelc += 1
+            self.write('cmp', 'eax,' + str(v))
+            self.write('je', l)
+            self.write('jg', right)
+            work.append((mid + 1, hi, right))
+            work.append((lo, mid, None))
     def generate_condition(self, cond, stack, true=None, false=None):
         """
         :type cond: Expression
         """
+        self.run(functools.partial(self._condition_steps, cond, stack, true, false))
+    def _jump_steps(self, jcc, jncc, true, false):
+        "jcc jumps to true, jncc to false"
+        if true and false:
+            return [self.later(jcc, true), self.later('jmp', false)]
+        elif true:
+            return [self.later(jcc, true)]
+        elif false:
+            return [self.later(jncc, false)]
+        return []
+    def _condition_steps(self, cond, stack, true=None, false=None):
         # some easy conditions
         if isinstance(cond, Unary) and cond.op == '!':
-            return self.generate_condition(cond.expr, stack, false, true)
+            return [functools.partial(self._condition_steps, cond.expr, stack, false, true)]
         elif isinstance(cond, Literal):
             if cond.type == 'INT_LIT':
                 if cond.value == 0:
@@ -492,56 +1161,39 @@ class CodeGenerator:
                         other = cond.lhs
                     else:
                         # neither is literal, but can still be optimized
-                        self.push_expr(cond.lhs, stack)
-                        self.reg_expr(cond.rhs, 'ebx', stack)
-                        self.write('pop', 'eax')
-                        self.write('test', 'eax,ebx')
-                        if true and false:
-                            self.write('je', true)
-                            self.write('jmp', false)
-                        elif true:
-                            self.write('je', true)
-                        elif false:
-                            self.write('jne', false)
-                if lit and other:
-                    self.reg_expr(other, 'eax', stack)
-                    self.write('test', 'eax,' + str(self.value('int', lit)))
-                    if true and false:
-                        self.write('je', true)
-                        self.write('jmp', false)
-                    elif true:
-                        self.write('je', true)
-                    elif false:
-                        self.write('jne', false)
+                        return self._binary_steps(cond, 'eax', 'ebx', stack,
+                                                  ('test', 'eax,ebx')) + self._jump_steps('jne', 'je', true, false)
+                return [functools.partial(self._reg_expr_steps, other, 'eax', stack),
+                        lambda: self.write('test', 'eax,' + str(self.value('int', lit)))] + self._jump_steps('jne', 'je', true, false)
             elif cond.op in rel_ops:
-                self.push_expr(cond.lhs, stack)
-                self.reg_expr(cond.rhs, 'ebx', stack)
-                self.write('pop', 'eax')
-                self.write('cmp', 'eax,ebx')
-                if true and false:
-                    self.write('j' + rel_ops[cond.op], true)
-                    self.write('jmp', false)
-                elif true:
-                    self.write('j' + rel_ops[cond.op], true)
-                elif false:
-                    self.write('j' + rel_ops_not[cond.op], false)
+                return self._binary_steps(cond, 'eax', 'ebx', stack,
+                                          ('cmp', 'eax,ebx')) + self._jump_steps('j' + rel_ops[cond.op], 'j' + rel_ops_not[cond.op], true, false)
             else:
-                # short-circuit
+                # short-circuit, to just after the condition if there's
+                # nowhere to go
+                skip = None
+                if (false if cond.op == '&&' else true) is None:
+                    skip = '.l' + str(self.labelc)
+                    self.labelc += 1
                 if cond.op == '&&':
-                    self.generate_condition(cond.lhs, stack, None, false)
-                    self.generate_condition(cond.rhs, stack, true, false)
+                    steps = [functools.partial(self._condition_steps, cond.lhs, stack, None, false or skip),
+                             functools.partial(self._condition_steps, cond.rhs, stack, true, false)]
                 else:
                     assert cond.op == '||'
-                    self.generate_condition(cond.lhs, stack, true, None)
-                    self.generate_condition(cond.rhs, stack, true, false)
+                    steps = [functools.partial(self._condition_steps, cond.lhs, stack, true or skip, None),
+                             functools.partial(self._condition_steps, cond.rhs, stack, true, false)]
+                if skip:
+                    steps.append(functools.partial(self.label, skip))
+                return steps
         else:
             # otherwise use a cmp
-            self.reg_expr(cond, 'eax', stack)
-            self.write('cmp', 'eax,0')
+            steps = [functools.partial(self._reg_expr_steps, cond, 'eax', stack),
+                     self.later('cmp', 'eax,0')]
             if true:
-                self.write('jne', true)
+                steps.append(self.later('jne', true))
             if false:
-                self.write('je', false)
+                steps.append(self.later('je', false))
+            return steps
     def simple_lvalue(self, lvalue, reg, stack, prefix=True):
         """
         :type lvalue: SimpleLValue
@@ -549,19 +1201,26 @@ class CodeGenerator:
         it is OK to change any registers that aren't
         reg or ebp before dereferencing
         """
-        ident = None
-        offset = 0
+        result = []
+        self.run(functools.partial(self._simple_lvalue_steps, lvalue, reg, stack, prefix, result.append))
+        return result[0]
+    def _simple_lvalue_steps(self, lvalue, reg, stack, prefix, then):
+        """
+        then is called with the operand once any index is in reg
+        and returns the steps that use it
+        """
         if isinstance(lvalue, Identifier):
-            ident = lvalue.name
-        else:
-            assert isinstance(lvalue, ArrayAccess)
-            ident = lvalue.array
-            if isinstance(lvalue.index, Literal):
-                offset = self.value('int', lvalue.index)
-            else:
-                self.reg_expr(lvalue.index, reg, stack)
-                offset = reg
-        return self.lookup(stack, ident).value(offset, prefix)
+            return then(self.lookup(stack, lvalue.name).value(0, prefix))
+        assert isinstance(lvalue, ArrayAccess)
+        if isinstance(lvalue.index, Literal):
+            offset = self.value('int', lvalue.index)
+            return then(self.lookup(stack, lvalue.array).value(offset, prefix))
+        return ([functools.partial(self._reg_expr_steps, lvalue.index, reg, stack)] +
+                self._index_steps(reg) +
+                [lambda: then(self.lookup(stack, lvalue.array).value(reg, prefix))])
+    def _index_steps(self, reg):
+        "steps to make the int in reg usable as an index"
+        return []
     def reg_expr(self, expr, reg, stack):
         """
         :type expr: Expression
@@ -570,221 +1229,333 @@ class CodeGenerator:
 
         Warning: may clobber every register but reg
         """
+        self.run(functools.partial(self._reg_expr_steps, expr, reg, stack))
+    def _load_steps(self, reg, val):
+        "load the operand val into reg, sign extending bytes"
+        if val.startswith('byte'):
+            creg = int_to_char.get(reg, 'al')
+            return [self.later('mov', creg + ',' + val),
+                    self.later('movsx', reg + ',' + creg)]
+        return [self.later('mov', reg + ',' + val)]
+    def _store_steps(self, reg, lval):
+        "pop into reg and store it to the operand lval"
+        steps = [self.later('pop', reg)]
+        if lval.startswith('byte'):
+            if reg in int_to_char:
+                creg = int_to_char[reg]
+                steps.append(self.later('movsx', reg + ',' + creg))
+            else:
+                creg = 'al'
+                steps.append(self.later('mov', 'eax,' + reg))
+                steps.append(self.later('movsx', reg + ',al'))
+            steps.append(self.later('mov', lval + ',' + creg))
+        else:
+            steps.append(self.later('mov', lval + ',' + reg))
+        return steps
+    def _binary_steps(self, expr, reg, ireg, stack, *insts):
+        "push lhs, load rhs into ireg, pop lhs into reg, then insts"
+        return [functools.partial(self._push_expr_steps, expr.lhs, stack),
+                functools.partial(self._reg_expr_steps, expr.rhs, ireg, stack),
+                self.later('pop', reg)] + [self.later(*i) for i in insts]
+    def _reg_expr_steps(self, expr, reg, stack):
         if isinstance(expr, Literal):
             self.write('mov', reg + ',' + str(self.value('int', expr)))
         elif isinstance(expr, Address):
             if isinstance(expr.lvalue, SimpleLValue):
-                self.write('lea', reg + ',' + self.simple_lvalue(expr.lvalue, reg, stack, False))
+                return self._simple_lvalue_steps(expr.lvalue, reg, stack, False,
+                    lambda val: self.write('lea', reg + ',' + val))
             else:
                 assert isinstance(expr.lvalue, Dereference)
                 self.warn('Will not attempt to dereference', expr)
-                self.reg_expr(expr.lvalue.expr, reg, stack)
+                return [functools.partial(self._reg_expr_steps, expr.lvalue.expr, reg, stack)]
         elif isinstance(expr, LValue):
             if isinstance(expr, SimpleLValue):
-                val = self.simple_lvalue(expr, reg, stack)
-                if val.startswith('byte'):
-                    creg = int_to_char.get(reg, 'al')
-                    self.write('mov', creg + ',' + val)
-                    self.write('movsx', reg + ',' + creg)
-                else:
-                    self.write('mov', reg + ',' + val)
+                return self._simple_lvalue_steps(expr, reg, stack, True,
+                    functools.partial(self._load_steps, reg))
             else:
                 assert isinstance(expr, Dereference)
-                self.reg_expr(expr.expr, reg, stack)
+                steps = [functools.partial(self._reg_expr_steps, expr.expr, reg, stack)]
                 if not expr.char:
-                    self.write('mov', reg + ',dword[' + reg + ']')
+                    steps.append(self.later('mov', reg + ',dword[' + reg + ']'))
                 else:
                     creg = int_to_char.get(reg, 'al')
-                    self.write('mov', creg + ',byte[' + reg + ']')
-                    self.write('movsx', reg + ',' + creg)
+                    steps.append(self.later('mov', creg + ',byte[' + reg + ']'))
+                    steps.append(self.later('movsx', reg + ',' + creg))
+                return steps
         elif isinstance(expr, Unary):
-            self.reg_expr(expr.expr, reg, stack)
+            steps = [functools.partial(self._reg_expr_steps, expr.expr, reg, stack)]
             if expr.op == '!':
-                self.write('cmp', reg + ',0')
                 breg = int_to_char.get(reg, 'al')
-                self.write('sete', breg)
-                self.write('movzx', reg + ',' + breg)
+                steps += [self.later('cmp', reg + ',0'),
+                          self.later('sete', breg),
+                          self.later('movzx', reg + ',' + breg)]
             elif expr.op == '~':
-                self.write('not', reg)
+                steps.append(self.later('not', reg))
             elif expr.op == '-':
-                self.write('neg', reg)
+                steps.append(self.later('neg', reg))
+            return steps
         elif isinstance(expr, BinaryExpression):
             # lhs, op, rhs
             ireg = 'eax' if reg != 'eax' else 'ebx'
             if expr.op == '*': # signed
-                self.push_expr(expr.lhs, stack)
-                self.reg_expr(expr.rhs, ireg, stack)
-                self.write('pop', reg)
-                self.write('imul', reg + ',' + ireg)
+                return self._binary_steps(expr, reg, ireg, stack,
+                                          ('imul', reg + ',' + ireg))
             elif expr.op == '#': # unsigned
-                self.push_expr(expr.lhs, stack)
-                self.reg_expr(expr.rhs, 'ebx', stack)
-                self.write('pop', 'eax')
-                self.write('mul', 'ebx')
-                self.write('mov', reg + ',' + 'eax')
+                return self._binary_steps(expr, 'eax', 'ebx', stack,
+                                          ('mul', 'ebx'),
+                                          ('mov', reg + ',' + 'eax'))
             elif expr.op in '/\\%@':
-                self.push_expr(expr.lhs, stack)
-                self.reg_expr(expr.rhs, 'ebx', stack)
-                self.write('pop', 'eax')
-                self.write('cdq')
-                self.write('idiv' if expr.op in '/%' else 'div', 'ebx')
-                self.write('mov', reg + ',' + ('eax' if expr.op in '/\\' else 'edx'))
+                return self._binary_steps(expr, 'eax', 'ebx', stack,
+                                          ('cdq',) if expr.op in '/%' else ('xor', 'edx,edx'),
+                                          ('idiv' if expr.op in '/%' else 'div', 'ebx'),
+                                          ('mov', reg + ',' + ('eax' if expr.op in '/\\' else 'edx')))
             elif expr.op in '+-':
-                self.push_expr(expr.lhs, stack)
-                self.reg_expr(expr.rhs, ireg, stack)
-                self.write('pop', reg)
-                self.write('add' if expr.op == '+' else 'sub', reg + ',' + ireg)
+                return self._binary_steps(expr, reg, ireg, stack,
+                                          ('add' if expr.op == '+' else 'sub', reg + ',' + ireg))
             elif expr.op in ('<<', '>>', '>>>'):
-                inst = 'sar' if expr.op == '>>>' else ('shl' if expr.op == '<<' else 'shr')
-                self.push_expr(expr.lhs, stack)
-                self.reg_expr(expr.rhs, ireg, stack)
-                self.write('pop', reg)
-                self.write(inst, reg + ',' + ireg)
+                # >>> is unsigned
+                inst = 'shr' if expr.op == '>>>' else ('shl' if expr.op == '<<' else 'sar')
+                # the count has to be in cl
+                if reg == 'ecx':
+                    return self._binary_steps(expr, 'eax', 'ecx', stack,
+                                              (inst, 'eax,cl'),
+                                              ('mov', 'ecx,eax'))
+                return self._binary_steps(expr, reg, 'ecx', stack,
+                                          (inst, reg + ',cl'))
             elif expr.op in '&|^':
                 inst = 'xor' if expr.op == '^' else ('and' if expr.op == '&' else 'or')
-                self.push_expr(expr.lhs, stack)
-                self.reg_expr(expr.rhs, ireg, stack)
-                self.write('pop', reg)
-                self.write(inst, reg + ',' + ireg)
+                return self._binary_steps(expr, reg, ireg, stack,
+                                          (inst, reg + ',' + ireg))
             elif expr.op in rel_ops:
-                inst = 'set' + rel_ops[expr.op]
-                self.push_expr(expr.lhs, stack)
-                self.reg_expr(expr.rhs, ireg, stack)
-                self.write('pop', reg)
-                self.write('cmp', reg + ',' + ireg)
                 creg = int_to_char.get(reg, 'al')
-                self.write(inst, creg)
-                self.write('movzx', reg + ',' + creg)
+                return self._binary_steps(expr, reg, ireg, stack,
+                                          ('cmp', reg + ',' + ireg),
+                                          ('set' + rel_ops[expr.op], creg),
+                                          ('movzx', reg + ',' + creg))
             elif expr.op in ('&&', '||'):
                 # use a condition
                 l_false = '.l' + str(self.labelc)
                 l_end = '.l' + str(self.labelc + 1)
                 self.labelc += 2
-                self.generate_condition(expr, stack, None, l_false)
-                self.write('mov', reg +',1')
-                self.write('jmp', l_end)
-                self.write('mov', reg + ',0', l_false)
-                self.label(l_end)
+                return [functools.partial(self._condition_steps, expr, stack, None, l_false),
+                        self.later('mov', reg +',1'),
+                        self.later('jmp', l_end),
+                        self.later('mov', reg + ',0', l_false),
+                        functools.partial(self.label, l_end)]
             else:
                 assert expr.op == '='
                 assert isinstance(expr.lhs, LValue)
-                self.push_expr(expr.rhs, stack)
+                steps = [functools.partial(self._push_expr_steps, expr.rhs, stack)]
                 if isinstance(expr.lhs, SimpleLValue):
-                    lval = self.simple_lvalue(expr.lhs, ireg, stack)
-                    self.write('pop', reg)
-                    if lval.startswith('byte'):
-                        if reg in int_to_char:
-                            creg = int_to_char[reg]
-                            self.write('movsx', reg + ',' + creg)
-                        else:
-                            creg = 'al'
-                            self.write('mov', 'eax', + reg)
-                            self.write('movsx', reg + ',al')
-                        self.write('mov', lval + ',' + creg)
-                    else:
-                        self.write('mov', lval + ',' + reg)
+                    steps.append(functools.partial(self._simple_lvalue_steps, expr.lhs, ireg, stack, True,
+                                                   functools.partial(self._store_steps, reg)))
                 else:
                     assert isinstance(expr.lhs, Dereference)
-                    self.reg_expr(expr.lhs.expr, ireg, stack)
-                    self.write('pop', reg)
+                    steps += [functools.partial(self._reg_expr_steps, expr.lhs.expr, ireg, stack),
+                              self.later('pop', reg)]
                     if not expr.lhs.char:
-                        self.write('mov', 'dword[' + ireg + '],' + reg)
+                        steps.append(self.later('mov', 'dword[' + ireg + '],' + reg))
                     else:
                         if reg not in int_to_char:
                             creg = 'al'
-                            self.write('mov', 'eax,' + reg)
-                            self.write('movsx', reg + ',al')
+                            steps.append(self.later('mov', 'eax,' + reg))
+                            steps.append(self.later('movsx', reg + ',al'))
                         else:
                             creg = int_to_char[reg]
-                            self.write('movsx', reg + ',' + creg)
-                        self.write('mov', 'byte[' + ireg + '],' + creg)
+                            steps.append(self.later('movsx', reg + ',' + creg))
+                        steps.append(self.later('mov', 'byte[' + ireg + '],' + creg))
+                return steps
         else:
             assert isinstance(expr, FunctionCall)
-            self.push_expr(expr, stack, stack)
-            self.write('pop', reg)
+            return [functools.partial(self._push_expr_steps, expr, stack, True),
+                    self.later('pop', reg)]
     def push_expr(self, expr, stack, push = True):
         """
         :type expr: Expression
 
         Warning: may clobber every register
         """
+        self.run(functools.partial(self._push_expr_steps, expr, stack, push))
+    def _push_expr_steps(self, expr, stack, push = True):
         if isinstance(expr, FunctionCall):
             fname = expr.name
             if fname.startswith('$'):
-                try:
-                    sysc = syscalls[fname]
-                except KeyError:
-                    raise CompilationError("Unknown syscall: " + fname, expr)
-                # on linux, prevent clobbering
-                for arg in reversed(expr.args):
-                    self.push_expr(arg, stack)
-                if self.linux:
-                    if len(expr.args) == 6:
-                        self.write('push', 'ebp')
-                    if len(expr.args) > 6:
-                        raise CompilationError("More than 6 arguments to linux syscall", expr)
-                    for arg, reg in zip(expr.args, ('ebx', 'ecx', 'edx', 'esi', 'edi', 'ebp')):
-                        self.write('pop', reg)
-                else:
-                    self.write('push', 'dword 0')
-                self.write('mov', 'eax,' + str(sysc))
-                self.write('int', '80h')
-                if self.linux:
-                    if len(expr.args) == 6:
-                        self.write('pop', 'ebp')
-                else:
-                    self.write('add', 'esp,' + str(4 * len(expr.args) + 4))
-                if push:
-                    self.write('push', 'eax')
+                return self._syscall_steps(expr, stack, push)
+            if fname in builtins and fname not in self.gfuncs:
+                return self._builtin_steps(expr, stack, push)
+            try:
+                func = self.gfuncs[fname]
+            except KeyError:
+                raise CompilationError("Function does not exist: " + fname, expr)
+            if isinstance(func.type, Void) and push:
+                raise CompilationError(repr(func) + " does not return a value", expr)
+            if not isinstance(func, CFunction) or not func.varargs:
+                if len(func.par_list) != len(expr.args):
+                    raise CompilationError("Incorrect number of arguments to " + func.prototype(), expr)
             else:
-                try:
-                    func = self.gfuncs[fname]
-                except KeyError:
-                    raise CompilationError("Function does not exist: " + fname, expr)
-                if isinstance(func.type, Void) and push:
-                    raise CompilationError(repr(func) + " does not return a value", expr)
-                if isinstance(func, CFunction):
-                    self.write('mov', 'eax,esp')
-                    self.write('and', 'esp,0fffffff0h')
-                    pn = len(expr.args)
-                    if (pn & 3) != 3:
-                        self.write('sub', 'esp,' + str(4 * (3 - (pn & 3))))
-                    self.write('push', 'eax')
-                if not isinstance(func, CFunction) or not func.varargs:
-                    if len(func.par_list) != len(expr.args):
-                        raise CompilationError("Incorrect number of arguments to " + func.prototype(), expr)
-                else:
-                    if len(expr.args) < len(func.par_list):
-                        raise CompilationError("Not enough arguments to " + func.prototype(), expr)
-                for arg in reversed(expr.args):
-                    self.push_expr(arg, stack)
-                if isinstance(func, CFunction):
-                    # ebx is callee-save
-                    self.write('call', '_' + fname)
-                    self.write('mov', 'esp,[esp+' + str(4*pn) + ']')
-                    if push:
-                        self.write('push', 'eax')
-                else:
-                    self.write('call', '?@' + fname)
-                    if not isinstance(func.type, Void) and not push:
-                        self.write('add', 'esp,4')
+                if len(expr.args) < len(func.par_list):
+                    raise CompilationError("Not enough arguments to " + func.prototype(), expr)
+            if isinstance(func, CFunction):
+                return self._c_call_steps(expr, stack, push)
+            steps = [functools.partial(self._push_expr_steps, arg, stack) for arg in reversed(expr.args)]
+            steps.append(self.later('call', '?@' + fname))
+            if not isinstance(func.type, Void) and not push:
+                steps.append(self.later('add', 'esp,' + str(self.slot)))
+            return steps
         elif isinstance(expr, Literal):
             self.write('push', str(self.value('int', expr)))
         else:
-            self.reg_expr(expr, 'eax', stack)
+            steps = [functools.partial(self._reg_expr_steps, expr, 'eax', stack)]
             if push:
-                self.write('push', 'eax')
+                steps.append(self.later('push', 'eax'))
+            return steps
+    def _builtin_steps(self, expr, stack, push):
+        """
+        memset and memcpy return dst, memcmp the difference of the first
+        bytes that differ, like C. Sizes are in bytes.
+        """
+        name = expr.name
+        if len(expr.args) != 3:
+            raise CompilationError(name + " takes 3 arguments", expr)
+        const = lambda e: self.value('int', e) if isinstance(e, Literal) and e.type != 'STRING_LIT' else None
+        size = const(expr.args[2])
+        fill = const(expr.args[1]) if name == 'memset' else None
+        # constants are used as immediates instead of being pushed
+        known = (None, fill, size)
+        regs = {'memset': ('edi', 'eax', 'ecx'), 'memcpy': ('edi', 'esi', 'ecx'), 'memcmp': ('esi', 'edi', 'ecx')}[name]
+        steps = [functools.partial(self._push_expr_steps, arg, stack)
+                 for arg, c in reversed(list(zip(expr.args, known))) if c is None]
+        steps += [self.later('pop', reg) for reg, c in zip(regs, known) if c is None]
+        if name == 'memcmp':
+            l_end = '.l' + str(self.labelc)
+            self.labelc += 1
+            if size is not None:
+                steps.append(self.later('mov', 'ecx,' + str(size)))
+            # sets ZF for n == 0
+            steps += [self.later('xor', 'eax,eax'),
+                      self.later('repe', 'cmpsb'),
+                      self.later('je', l_end),
+                      self.later('mov', 'al,byte[esi-1]'),
+                      self.later('mov', 'bl,byte[edi-1]'),
+                      self.later('movzx', 'ebx,bl'),
+                      self.later('sub', 'eax,ebx'),
+                      functools.partial(self.label, l_end)]
+            if push:
+                steps.append(self.later('push', 'eax'))
+            return steps
+        if name == 'memset':
+            if fill is not None:
+                pattern = (fill & 0xff) * 0x01010101
+                fill = pattern - (1 << 32) if pattern & 0x80000000 else pattern
+            else:
+                steps += [self.later('and', 'eax,0ffh'),
+                          self.later('mov', 'edx,01010101h'),
+                          self.later('imul', 'eax,edx')]
+        if size is not None and size <= UNROLL_MAX:
+            dwords = size & ~3
+            for off in list(range(0, dwords, 4)) + list(range(dwords, size)):
+                size_prefix, reg = ('dword', 'eax') if off < dwords else ('byte', 'al')
+                if name == 'memcpy':
+                    steps.append(self.later('mov', reg + ',' + size_prefix + '[esi+' + str(off) + ']'))
+                elif fill is not None:
+                    reg = str(fill if off < dwords else fill & 0xff)
+                steps.append(self.later('mov', size_prefix + '[edi+' + str(off) + '],' + reg))
+            if push:
+                steps.append(self.later('push', 'edi'))
+            return steps
+        op = 'stos' if name == 'memset' else 'movs'
+        if fill is not None:
+            steps.append(self.later('mov', 'eax,' + str(fill)))
+        steps.append(self.later('mov', 'ebx,edi'))
+        if size is None:
+            steps += [self.later('mov', 'edx,ecx'),
+                      self.later('shr', 'ecx,2'),
+                      self.later('rep', op + 'd'),
+                      self.later('mov', 'ecx,edx'),
+                      self.later('and', 'ecx,3'),
+                      self.later('rep', op + 'b')]
+        else:
+            steps += [self.later('mov', 'ecx,' + str(size >> 2)),
+                      self.later('rep', op + 'd')]
+            steps += [self.later(op + 'b') for i in range(size & 3)]
+        if push:
+            steps.append(self.later('push', 'ebx'))
+        return steps
+    def _syscall_steps(self, expr, stack, push):
+        try:
+            sysc = self.syscalls[expr.name]
+        except KeyError:
+            raise CompilationError("Unknown syscall: " + expr.name, expr)
+        if expr.name == '$mmap' and len(expr.args) != 6:
+            raise CompilationError("$mmap takes 6 arguments", expr)
+        # on linux, prevent clobbering
+        steps = [functools.partial(self._push_expr_steps, arg, stack) for arg in reversed(expr.args)]
+        slots = len(expr.args) + 1
+        if self.linux:
+            if len(expr.args) > 6:
+                raise CompilationError("More than 6 arguments to linux syscall", expr)
+            for arg, reg in zip(expr.args, ('ebx', 'ecx', 'edx', 'esi', 'edi')):
+                steps.append(self.later('pop', reg))
+            if len(expr.args) == 6:
+                # the last one goes in ebp, which is saved in its place
+                steps += [self.later('mov', 'eax,[esp]'),
+                          self.later('mov', '[esp],ebp'),
+                          self.later('mov', 'ebp,eax')]
+                if expr.name == '$mmap':
+                    # mmap2 counts the offset in pages
+                    steps.append(self.later('shr', 'ebp,12'))
+        else:
+            if expr.name == '$mmap':
+                # the offset is an off_t, 64 bits
+                steps.insert(0, self.later('push', 'dword 0'))
+                slots += 1
+            steps.append(self.later('push', 'dword 0'))
+        steps.append(self.later('mov', 'eax,' + str(sysc)))
+        if self.linux and not self.int80:
+            steps.append(self.later('call', '[?vsyscall]'))
+        else:
+            steps.append(self.later('int', '80h'))
+        if self.linux:
+            if len(expr.args) == 6:
+                steps.append(self.later('pop', 'ebp'))
+        else:
+            steps.append(self.later('add', 'esp,' + str(4 * slots)))
+        if push:
+            steps.append(self.later('push', 'eax'))
+        return steps
+    def _c_call_steps(self, expr, stack, push):
+        "cdecl, with the stack 16 byte aligned at the call"
+        self.write('mov', 'eax,esp')
+        self.write('and', 'esp,0fffffff0h')
+        pn = len(expr.args)
+        if (pn & 3) != 3:
+            self.write('sub', 'esp,' + str(4 * (3 - (pn & 3))))
+        self.write('push', 'eax')
+        steps = [functools.partial(self._push_expr_steps, arg, stack) for arg in reversed(expr.args)]
+        # ebx is callee-save
+        steps.append(self.later('call', self.c_prefix + expr.name))
+        steps.append(self.later('mov', 'esp,[esp+' + str(4*pn) + ']'))
+        if push:
+            steps.append(self.later('push', 'eax'))
+        return steps
     def generate_exports(self):
         for exp in self.exports:
             self.write('GLOBAL ' + ('?@' if exp.function else '') + exp.name)
         if 'main' in self.gfuncs:
             self.write('GLOBAL ?@main')
+        if self.profile:
+            self.write('GLOBAL ?@?dump_profile')
     def lookup(self, stack, name):
-        if name in stack:
-            return stack[name]
-        if name in self.gvars:
-            return self.gvars[name]
-        raise CompilationError("No such variable: " + name, None)
+        entry = stack.find(name)
+        if entry is None:
+            raise CompilationError("No such variable: " + name, None)
+        return entry
+    def report_shadowing(self, stack):
+        """
+        :type stack: StackFrame
+        """
+        for entry, outer in stack.shadowed:
+            self.warn(entry.var.name + ' shadows ' + str(outer), entry.var)
     def generate_externs(self):
         for ext in self.externs:
             ename = ext.name
@@ -804,13 +1575,217 @@ class CodeGenerator:
                     self.gfuncs[ext.name] = Function(ext.type, ext.name, ext.par_list)
             self.write('EXTERN ' + ename)
 
-if __name__ == '__main__':
+# for x86-64
+reg_to_64 = {
+    'eax': 'rax', 'ebx': 'rbx', 'ecx': 'rcx', 'edx': 'rdx',
+    'esi': 'rsi', 'edi': 'rdi', 'esp': 'rsp', 'ebp': 'rbp',
+}
+reg_to_64.update(('r%dd' % i, 'r%d' % i) for i in range(8, 16))
+_reg32 = re.compile(r'\b(e[abcd]x|e[sd]i|e[sb]p|r[0-9]+d)\b')
+_memory = re.compile(r'\[[^\]]*\]')
+
+def widen(inst, code):
+    """
+    Rewrite the operands of a 32-bit instruction for x86-64: registers
+    holding addresses (in memory operands, the stack and frame pointers,
+    push, pop and jumps) become 64 bits, everything else stays 32 bits
+    """
+    if not code:
+        return code
+    full = lambda m: reg_to_64[m.group(0)]
+    if inst in ('push', 'pop', 'jmp', 'call') or re.search(r'\be[sb]p\b', _memory.sub('', code)):
+        return _reg32.sub(full, code)
+    return _memory.sub(lambda m: _reg32.sub(full, m.group(0)), code)
+
+def operands(expr):
+    "the subexpressions evaluated with expr"
+    if isinstance(expr, BinaryExpression):
+        return (expr.lhs, expr.rhs)
+    elif isinstance(expr, (Unary, Dereference)):
+        return (expr.expr,)
+    elif isinstance(expr, Address):
+        return (expr.lvalue,)
+    elif isinstance(expr, ArrayAccess):
+        return (expr.index,)
+    return ()
+
+class CodeGenerator64(CodeGenerator):
+    """
+    x86-64 code for linux. Ints are still 32 bits (arithmetic wraps
+    the same way), and since pointers are ints everything must be
+    addressable with 32 bits: canada64.s moves the stack and argv
+    below 4 GiB and objects are linked without PIE. Stack slots are
+    8 bytes, so parameters start at [rbp+16].
+
+    Most instructions are the same as for x86 and go through widen.
+    The extra registers hold the left operand of a binary expression
+    while the right one is evaluated, instead of the stack, unless the
+    right one calls something.
+    """
+    slot = 8
+    arg_offset = 16
+    vsyscall = False # syscall is already fast
+    temps = ('r8d', 'r9d', 'r10d', 'r11d', 'r12d', 'r13d', 'r14d', 'r15d', 'esi', 'edi')
+    def __init__(self, out, **kwargs):
+        CodeGenerator.__init__(self, out, **kwargs)
+        if not self.linux:
+            raise Exception("x86-64 code can only be generated for linux")
+        self.tempc = 0 # temps in use
+        self.calls = {} # id(expr) -> whether it calls anything
+    def generate(self, ast):
+        self.tempc = 0
+        self.calls = {}
+        CodeGenerator.generate(self, ast)
+    def emit(self, label=None, inst=None, code=None, comment=None):
+        if inst not in ('db', 'dw', 'dd'):
+            code = widen(inst, code)
+        CodeGenerator.emit(self, label, inst, code, comment)
+    def value(self, t, v):
+        val = CodeGenerator.value(self, t, v)
+        if t == 'int' and isinstance(val, int):
+            # push and most immediates are sign extended from 32 bits
+            val = (val + 0x80000000) % 0x100000000 - 0x80000000
+        return val
+    def has_call(self, expr):
+        "whether evaluating expr calls a function or makes a syscall"
+        calls = self.calls
+        work = [expr]
+        while work:
+            e = work[-1]
+            if id(e) in calls:
+                work.pop()
+                continue
+            if isinstance(e, FunctionCall):
+                calls[id(e)] = True
+                work.pop()
+                continue
+            ops = operands(e)
+            pending = [o for o in ops if id(o) not in calls]
+            if pending:
+                work.extend(pending)
+                continue
+            calls[id(e)] = any(calls[id(o)] for o in ops)
+            work.pop()
+        return calls[id(expr)]
+    def _hold(self, n):
+        self.tempc += n
+    def _binary_steps(self, expr, reg, ireg, stack, *insts):
+        if self.tempc == len(self.temps) or self.has_call(expr.rhs):
+            return CodeGenerator._binary_steps(self, expr, reg, ireg, stack, *insts)
+        # nothing the rhs does touches temps from tempc up, once held
+        temp = self.temps[self.tempc]
+        steps = [functools.partial(self._reg_expr_steps, expr.lhs, temp, stack),
+                 functools.partial(self._hold, 1),
+                 functools.partial(self._reg_expr_steps, expr.rhs, ireg, stack),
+                 functools.partial(self._hold, -1)]
+        if temp != reg:
+            steps.append(self.later('mov', reg + ',' + temp))
+        return steps + [self.later(*i) for i in insts]
+    def _index_steps(self, reg):
+        # indices can be negative
+        return [self.later('movsxd', reg_to_64[reg] + ',' + reg)]
+    def _syscall_steps(self, expr, stack, push):
+        try:
+            sysc = syscalls_x86_64[expr.name]
+        except KeyError:
+            raise CompilationError("Unknown syscall: " + expr.name, expr)
+        if len(expr.args) > 6:
+            raise CompilationError("More than 6 arguments to linux syscall", expr)
+        steps = [functools.partial(self._push_expr_steps, arg, stack) for arg in reversed(expr.args)]
+        for arg, reg in zip(expr.args, ('rdi', 'rsi', 'rdx', 'r10', 'r8', 'r9')):
+            steps.append(self.later('pop', reg))
+        if expr.name == '$mmap':
+            if len(expr.args) != 6:
+                raise CompilationError("$mmap takes 6 arguments", expr)
+            # MAP_32BIT, the address has to fit in an int
+            steps.append(self.later('or', 'r10d,40h'))
+        # clobbers rcx and r11
+        steps.append(self.later('mov', 'eax,' + str(sysc)))
+        steps.append(self.later('syscall'))
+        if push:
+            steps.append(self.later('push', 'rax'))
+        return steps
+    def _c_call_steps(self, expr, stack, push):
+        "System V: six arguments in registers, the rest on the stack 16 byte aligned"
+        sn = max(0, len(expr.args) - 6)
+        self.write('mov', 'rax,rsp')
+        self.write('and', 'rsp,-16')
+        if sn % 2 == 0:
+            self.write('sub', 'rsp,8')
+        self.write('push', 'rax')
+        steps = [functools.partial(self._push_expr_steps, arg, stack) for arg in reversed(expr.args)]
+        for arg, reg in zip(expr.args, ('rdi', 'rsi', 'rdx', 'rcx', 'r8', 'r9')):
+            steps.append(self.later('pop', reg))
+        # al is the number of vector registers used by varargs
+        steps.append(self.later('xor', 'eax,eax'))
+        steps.append(self.later('call', self.c_prefix + expr.name))
+        steps.append(self.later('mov', 'rsp,[rsp+' + str(8 * sn) + ']'))
+        if push:
+            # only eax is the int, clear the top half
+            steps.append(self.later('mov', 'eax,eax'))
+            steps.append(self.later('push', 'rax'))
+        return steps
+
+targets = {'x86': CodeGenerator, 'x86-64': CodeGenerator64}
+
+def main(argv):
     import sys
-    for fn in sys.argv[1:]:
+    import argparse
+    ap = argparse.ArgumentParser(description='Compile Canada sources to NASM assembly')
+    ap.add_argument('files', nargs='+')
+    ap.add_argument('-o', dest='out', help='output file (with only one input)')
+    ap.add_argument('--elf', action='store_true', help='write ELF32 objects directly instead of assembly')
+    ap.add_argument('--target', choices=sorted(targets), default='x86', help='instruction set to generate code for')
+    ap.add_argument('--interface', action='store_true', help='also write the exports of each file to a .cai file')
+    ap.add_argument('-I', dest='interfaces', action='append', default=[], metavar='CAI',
+                    help='check externs against (and declare what is missing from) this interface file')
+    ap.add_argument('--int80', action='store_true', help='make linux syscalls with int 80h instead of through the vDSO')
+    ap.add_argument('--stats', action='store_true',
+                    help='print the time, memory and counts of each phase as a line of JSON per file')
+    ap.add_argument('--asm-report', action='store_true',
+                    help='also write the static counts of each function and loop to a .asm.json file (see canadareport.py)')
+    ap.add_argument('--profile', action='store_true',
+                    help='count calls, loop iterations and if/else arms into ' + PROFILE_FILE + ' (see canadaprof.py)')
+    args = ap.parse_args(argv)
+    if args.elf and args.target != 'x86':
+        ap.error('--elf is only supported for x86')
+    if args.int80 and args.target != 'x86':
+        ap.error('--int80 is only supported for x86')
+    if args.out and len(args.files) > 1:
+        ap.error('-o needs a single input file')
+    interfaces = None
+    if args.interfaces:
+        import canadaiface
+        try:
+            interfaces = canadaiface.load(args.interfaces)
+        except (OSError, canadaiface.InterfaceError) as err:
+            sys.stdout.write("ERROR: " + str(err) + '\n')
+            sys.exit(1)
+    for fn in args.files:
+        stats = canadastats.Stats(fn) if args.stats else None
+        report = canadareport.Report(fn) if args.asm_report else None
         try:
-            generate(fn)
+            generate(fn, args.out, elf=args.elf, target=args.target,
+                     interface=args.interface, interfaces=interfaces, int80=args.int80, profile=args.profile,
+                     stats=stats, asm_report=report)
         except CompilationError as err:
             sys.stdout.write("ERROR in " + fn + ": ")
             sys.stdout.write(str(err))
             sys.stdout.write('\n')
             sys.exit(1)
+        if stats is not None:
+            import json
+            sys.stdout.write(json.dumps(stats.report()) + '\n')
+        if report is not None:
+            import json
+            import os
+            with open(os.path.splitext(fn)[0] + '.asm.json', 'w') as f:
+                json.dump(report.to_dict(), f, indent=4)
+                f.write('\n')
+
+if __name__ == '__main__':
+    import sys
+    # canadaiface and canadalink import this module again, use that
+    # one so there is only one CompilationError
+    import canadacodegen
+    canadacodegen.main(sys.argv[1:])
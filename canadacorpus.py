@@ -0,0 +1,170 @@
+"""
+Benchmarks of the code the compiler generates: builds each program in
+bench/ with make, checks its output against bench/NAME.out and records
+how long it runs, how big it is and how many instructions it has.
+
+    python3 canadacorpus.py --save before.json
+    ... change the code generator ...
+    python3 canadacorpus.py --baseline before.json
+
+Anything after -- goes to make, e.g. -- DIRECT_ELF=1 or TARGET=x86-64.
+Each result has:
+
+    seconds        the fastest of --repeat runs, wall clock
+    cpu            user + system time of that run
+    size           bytes of the executable
+    text           bytes of its code (ELF executables only)
+    instructions   emitted for the program itself, not print.ca or
+                   the runtime, and per function in functions
+"""
+import io
+import os
+import resource
+import struct
+import subprocess
+import time
+
+import canadaparse
+import canadastats
+
+from canadacodegen import targets
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+CORPUS = os.path.join(HERE, 'bench')
+
+SHF_EXECINSTR = 4
+
+class CorpusError(Exception):
+    pass
+
+def programs():
+    return sorted(fn[:-3] for fn in os.listdir(CORPUS) if fn.endswith('.ca'))
+
+def text_size(path):
+    "bytes in the executable sections of an ELF file, or None"
+    with open(path, 'rb') as f:
+        data = f.read()
+    if data[:4] != b'\x7fELF':
+        return None
+    if data[4] == 1:
+        shoff, = struct.unpack_from('<I', data, 0x20)
+        shentsize, shnum = struct.unpack_from('<HH', data, 0x2e)
+        header = struct.Struct('<IIIIIIIIII') # name type flags addr offset size ...
+    else:
+        shoff, = struct.unpack_from('<Q', data, 0x28)
+        shentsize, shnum = struct.unpack_from('<HH', data, 0x3a)
+        header = struct.Struct('<IIQQQQIIQQ')
+    size = 0
+    for i in range(shnum):
+        sh = header.unpack_from(data, shoff + i * shentsize)
+        if sh[2] & SHF_EXECINSTR:
+            size += sh[5]
+    return size
+
+def instructions(name, target):
+    "{function: instructions} as canadastats counts them"
+    stats = canadastats.Stats(trace_memory=False)
+    with open(os.path.join(CORPUS, name + '.ca')) as f:
+        ast = canadaparse.parse(f.read())
+    targets[target](io.StringIO(), stats=stats).generate(ast)
+    return stats.functions
+
+def build(names, make_args):
+    cmd = ['make', '-C', HERE] + make_args + [os.path.join('bench', n) for n in names]
+    if subprocess.call(cmd, stdout=subprocess.DEVNULL) != 0:
+        raise CorpusError(' '.join(cmd) + ' failed')
+
+def run(name, repeat):
+    "(seconds, cpu seconds) of the fastest run, checking the output"
+    exe = os.path.join(CORPUS, name)
+    with open(os.path.join(CORPUS, name + '.out'), 'rb') as f:
+        expected = f.read()
+    best = None
+    for _ in range(repeat):
+        before = resource.getrusage(resource.RUSAGE_CHILDREN)
+        start = time.perf_counter()
+        proc = subprocess.run([exe], stdout=subprocess.PIPE)
+        seconds = time.perf_counter() - start
+        after = resource.getrusage(resource.RUSAGE_CHILDREN)
+        if proc.returncode != 0:
+            raise CorpusError('%s exited with %d' % (name, proc.returncode))
+        if proc.stdout != expected:
+            raise CorpusError(name + ': wrong output')
+        cpu = after.ru_utime - before.ru_utime + after.ru_stime - before.ru_stime
+        if best is None or seconds < best[0]:
+            best = (seconds, cpu)
+    return best
+
+def measure(names, make_args=(), repeat=3):
+    "{program: results}"
+    target = 'x86'
+    for arg in make_args:
+        if arg.startswith('TARGET='):
+            target = arg[len('TARGET='):]
+    build(names, list(make_args))
+    results = {}
+    for name in names:
+        seconds, cpu = run(name, repeat)
+        exe = os.path.join(CORPUS, name)
+        functions = instructions(name, target)
+        results[name] = {
+            'seconds': seconds,
+            'cpu': cpu,
+            'size': os.path.getsize(exe),
+            'text': text_size(exe),
+            'instructions': sum(functions.values()),
+            'functions': functions,
+        }
+    return results
+
+COLUMNS = (('seconds', '%.3f'), ('cpu', '%.3f'), ('size', '%d'), ('text', '%d'), ('instructions', '%d'))
+
+def report(results, baseline, out):
+    out.write('%-12s' % 'program' + ''.join('%18s' % c for c, _ in COLUMNS) + '\n')
+    for name, r in results.items():
+        line = '%-12s' % name
+        for c, fmt in COLUMNS:
+            if r[c] is None:
+                line += '%18s' % '-'
+                continue
+            cell = fmt % r[c]
+            base = baseline.get(name, {}).get(c) if baseline else None
+            if base:
+                cell += ' %+.1f%%' % ((r[c] / base - 1) * 100)
+            line += '%18s' % cell
+        out.write(line + '\n')
+
+if __name__ == '__main__':
+    import sys
+    import json
+    import argparse
+    ap = argparse.ArgumentParser(description='Build, check and time the benchmarks in bench/',
+                                 epilog='arguments after -- are passed to make')
+    ap.add_argument('programs', nargs='*', help='which of ' + ', '.join(programs()) + ' (default: all)')
+    ap.add_argument('--repeat', type=int, default=3, help='runs per program, the fastest counts')
+    ap.add_argument('--baseline', help='show the change from the results in this file')
+    ap.add_argument('--save', help='write the results to this file')
+    argv = sys.argv[1:]
+    make_args = []
+    if '--' in argv:
+        make_args = argv[argv.index('--') + 1:]
+        argv = argv[:argv.index('--')]
+    args = ap.parse_args(argv)
+    names = args.programs or programs()
+    for name in names:
+        if name not in programs():
+            ap.error('unknown program ' + name)
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    try:
+        results = measure(names, make_args, args.repeat)
+    except CorpusError as err:
+        sys.stdout.write("ERROR: " + str(err) + '\n')
+        sys.exit(1)
+    report(results, baseline, sys.stdout)
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=4, sort_keys=True)
+            f.write('\n')
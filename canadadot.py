@@ -0,0 +1,155 @@
+import itertools
+import canadaparse
+
+from canadaparse import FakeTuple
+
+_end = object()
+
+class Elided:
+    "stands in for children cut off by max_children"
+    def __init__(self, count):
+        self.count = count
+    def __str__(self):
+        return '... ' + str(self.count) + ' more'
+
+def children(n):
+    """
+    returns (label, children) for an interior node,
+    or None if n should be drawn as a leaf
+    """
+    if isinstance(n, tuple):
+        return n
+    if isinstance(n, FakeTuple):
+        t = n._tuple()
+        if t:
+            return t
+    return None
+
+def subtree_size(n):
+    "number of nodes under (and including) n"
+    count = 0
+    work = [n]
+    while work:
+        n = work.pop()
+        count += 1
+        t = children(n)
+        if t:
+            work.extend(t[1])
+    return count
+
+def escape(label):
+    return str(label).replace('\\', '\\\\').replace('"', '\\"')
+
+class DotWriter:
+    def __init__(self, out, max_depth=None, max_children=None, collapse=(), bufsize=1 << 16):
+        """
+        :type out: file
+        :type max_depth: int
+        :type max_children: int
+        :type collapse: set
+
+        Subtrees below max_depth or whose tag is in collapse are drawn
+        as a single node. Nodes with more than max_children children
+        only show the first max_children. Output is buffered and
+        written to out in chunks of about bufsize characters.
+        """
+        self.out = out
+        self.max_depth = max_depth
+        self.max_children = max_children
+        self.collapse = frozenset(collapse)
+        self.bufsize = bufsize
+        self.buf = []
+        self.buffered = 0
+        self.nodes = 0
+    def write(self, s):
+        self.buf.append(s)
+        self.buffered += len(s)
+        if self.buffered >= self.bufsize:
+            self.flush()
+    def flush(self):
+        self.out.write(''.join(self.buf))
+        self.buf = []
+        self.buffered = 0
+    def node(self, label, shape=None):
+        "write a node, returns its name"
+        name = 'node' + str(self.nodes)
+        self.nodes += 1
+        self.write('    ' + name + ' [label = "' + escape(label) + '"' +
+                   (', shape = "' + shape + '"' if shape else '') + ']\n')
+        return name
+    def visit(self, n, parent, depth, work):
+        """
+        write n and the edge from parent; if n's children should be
+        drawn, push them onto work
+        """
+        t = children(n)
+        if isinstance(n, Elided):
+            name = self.node(n, 'plaintext')
+        elif t is None:
+            name = self.node(n, 'diamond')
+        elif t[0] in self.collapse or (self.max_depth is not None and depth >= self.max_depth):
+            name = self.node(t[0] + ' (' + str(subtree_size(n)) + ' nodes)', 'ellipse')
+        else:
+            name = self.node(t[0])
+            kids = t[1]
+            if self.max_children is not None and len(kids) > self.max_children:
+                kids = itertools.chain(itertools.islice(kids, self.max_children),
+                                       (Elided(len(kids) - self.max_children),))
+            work.append((name, iter(kids), depth + 1))
+        if parent:
+            self.write('    ' + parent + ' -> ' + name + '\n')
+    def export(self, ast, graph='parse_tree'):
+        """
+        Write the whole graph for ast. Only the current path from the
+        root is kept, so memory does not grow with the size of the tree.
+        """
+        self.write('digraph ' + graph + ' {\n')
+        self.write('    node [shape = box];\n')
+        work = []
+        self.visit(ast, None, 0, work)
+        while work:
+            parent, kids, depth = work[-1]
+            child = next(kids, _end)
+            if child is _end:
+                work.pop()
+            else:
+                self.visit(child, parent, depth, work)
+        self.write('}\n')
+        self.flush()
+        return self.nodes
+
+def export(ast, out, **kwargs):
+    """
+    Write ast to out as a Graphviz digraph, returns the number of nodes
+    (see DotWriter for the options)
+    """
+    return DotWriter(out, **kwargs).export(ast)
+
+def generate(fn, out=None, **kwargs):
+    """
+    Generate dot file (out defaults to fn with the
+    file extension replaced by '.dot')
+    """
+    import os
+    if not out:
+        out = os.path.splitext(fn)[0] + '.dot'
+    with open(fn) as f:
+        ast = canadaparse.parse(f.read())
+    with open(out, 'w') as outf:
+        return export(ast, outf, **kwargs)
+
+def main(argv):
+    import argparse
+    ap = argparse.ArgumentParser(description='Write the AST of Canada sources as Graphviz dot files')
+    ap.add_argument('files', nargs='+')
+    ap.add_argument('--max-depth', type=int, help='collapse subtrees below this depth')
+    ap.add_argument('--max-children', type=int, help='only draw this many children per node')
+    ap.add_argument('--collapse', default='', help='comma separated node tags to draw collapsed, e.g. block,array_lit')
+    args = ap.parse_args(argv)
+    collapse = [t for t in args.collapse.split(',') if t]
+    for fn in args.files:
+        generate(fn, max_depth=args.max_depth, max_children=args.max_children, collapse=collapse)
+
+if __name__ == '__main__':
+    import sys
+    main(sys.argv[1:])
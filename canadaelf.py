@@ -0,0 +1,825 @@
+import functools
+import re
+import struct
+
+REG32 = {'eax': 0, 'ecx': 1, 'edx': 2, 'ebx': 3, 'esp': 4, 'ebp': 5, 'esi': 6, 'edi': 7}
+REG8 = {'al': 0, 'cl': 1, 'dl': 2, 'bl': 3, 'ah': 4, 'ch': 5, 'dh': 6, 'bh': 7}
+
+# condition codes for j_ and set_
+conditions = {
+    'o': 0, 'no': 1,
+    'b': 2, 'c': 2, 'nae': 2,
+    'ae': 3, 'nb': 3, 'nc': 3,
+    'e': 4, 'z': 4,
+    'ne': 5, 'nz': 5,
+    'be': 6, 'na': 6,
+    'a': 7, 'nbe': 7,
+    's': 8, 'ns': 9,
+    'p': 10, 'pe': 10,
+    'np': 11, 'po': 11,
+    'l': 12, 'nge': 12,
+    'ge': 13, 'nl': 13,
+    'le': 14, 'ng': 14,
+    'g': 15, 'nle': 15,
+}
+
+# /digit of the 80/81/83 group, the r/m,reg opcode is digit * 8 + 1
+arith_ops = {'add': 0, 'or': 1, 'adc': 2, 'sbb': 3, 'and': 4, 'sub': 5, 'xor': 6, 'cmp': 7}
+# /digit of the F6/F7 group
+unary_ops = {'not': 2, 'neg': 3, 'mul': 4, 'imul': 5, 'div': 6, 'idiv': 7}
+# /digit of the D1/D3/C1 group
+shift_ops = {'rol': 0, 'ror': 1, 'shl': 4, 'sal': 4, 'shr': 5, 'sar': 7}
+# string instruction prefixes
+prefixes = {'rep': 0xf3, 'repe': 0xf3, 'repz': 0xf3, 'repne': 0xf2, 'repnz': 0xf2}
+# instructions without operands
+plain_ops = {
+    'cdq': b'\x99',
+    'ret': b'\xc3',
+    'nop': b'\x90',
+    'leave': b'\xc9',
+    'movsb': b'\xa4',
+    'movsd': b'\xa5',
+    'stosb': b'\xaa',
+    'stosd': b'\xab',
+    'cmpsb': b'\xa6',
+    'cmpsd': b'\xa7',
+    'cld': b'\xfc',
+}
+scales = {1: 0, 2: 1, 4: 2, 8: 3}
+
+escapes = {'n': 10, 't': 9, 'r': 13, 'a': 7, 'b': 8, 'f': 12, 'v': 11,
+           'e': 27, '\\': 92, '`': 96, "'": 39, '"': 34, '?': 63}
+
+# ELF constants
+R_386_32 = 1
+R_386_PC32 = 2
+SHT_PROGBITS = 1
+SHT_SYMTAB = 2
+SHT_STRTAB = 3
+SHT_NOBITS = 8
+SHT_REL = 9
+SHF_WRITE = 1
+SHF_ALLOC = 2
+SHF_EXECINSTR = 4
+STB_LOCAL = 0
+STB_GLOBAL = 1
+STB_WEAK = 2
+STT_NOTYPE = 0
+STT_SECTION = 3
+
+class AssemblyError(Exception):
+    pass
+
+class Reg:
+    __slots__ = ('size', 'num')
+    def __init__(self, size, num):
+        self.size = size
+        self.num = num
+
+class Mem:
+    __slots__ = ('size', 'base', 'index', 'scale', 'disp', 'sym')
+    def __init__(self, size, base, index, scale, disp, sym):
+        self.size = size
+        self.base = base
+        self.index = index
+        self.scale = scale
+        self.disp = disp
+        self.sym = sym
+
+class Imm:
+    __slots__ = ('value', 'sym')
+    def __init__(self, value, sym):
+        self.value = value
+        self.sym = sym
+
+def parse_number(s):
+    "NASM style integer: decimal, 0x.. or ..h hex; None if s isn't one"
+    neg = s.startswith('-')
+    if neg:
+        s = s[1:]
+    if re.fullmatch(r'\d+', s):
+        v = int(s)
+    elif re.fullmatch(r'\d[0-9a-fA-F]*[hH]', s):
+        v = int(s[:-1], 16)
+    elif re.fullmatch(r'0[xX][0-9a-fA-F]+', s):
+        v = int(s, 16)
+    else:
+        return None
+    return -v if neg else v
+
+def split_size(s):
+    "returns (size in bytes or None, rest)"
+    for name, size in (('dword', 4), ('byte', 1), ('word', 2)):
+        if s.startswith(name) and (len(s) == len(name) or s[len(name)] in ' ['):
+            return size, s[len(name):].strip()
+    return None, s
+
+@functools.lru_cache(maxsize=None)
+def parse_operand(s):
+    """
+    :type s: str
+    returns Reg, Mem or Imm; operand strings repeat a lot so this is cached
+    """
+    s = s.strip()
+    if s in REG32:
+        return Reg(4, REG32[s])
+    if s in REG8:
+        return Reg(1, REG8[s])
+    size, s = split_size(s)
+    if s.startswith('['):
+        if not s.endswith(']'):
+            raise AssemblyError('Bad memory operand: ' + s)
+        base = index = sym = None
+        scale = 1
+        disp = 0
+        for term in re.findall(r'[+-]?[^+-]+', s[1:-1].replace(' ', '')):
+            sign = -1 if term[0] == '-' else 1
+            term = term.lstrip('+-')
+            if '*' in term:
+                a, b = term.split('*')
+                if a in REG32:
+                    a, b = b, a
+                index, scale = REG32[b], parse_number(a)
+            elif term in REG32:
+                if base is None:
+                    base = REG32[term]
+                else:
+                    index = REG32[term]
+            else:
+                n = parse_number(term)
+                if n is not None:
+                    disp += sign * n
+                elif sign > 0 and sym is None:
+                    sym = term
+                else:
+                    raise AssemblyError('Bad memory operand: ' + s)
+        return Mem(size, base, index, scale, disp, sym)
+    n = parse_number(s.replace(' ', ''))
+    if n is not None:
+        return Imm(n, None)
+    m = re.fullmatch(r'([^+-]+)(([+-])(.+))?', s.replace(' ', ''))
+    if not m:
+        raise AssemblyError('Bad operand: ' + s)
+    disp = 0
+    if m.group(2):
+        disp = parse_number(m.group(4))
+        if disp is None:
+            raise AssemblyError('Bad operand: ' + s)
+        if m.group(3) == '-':
+            disp = -disp
+    return Imm(disp, m.group(1))
+
+def split_operands(code):
+    "split on commas outside of quotes"
+    ops = []
+    cur = ''
+    quote = None
+    i = 0
+    while i < len(code):
+        c = code[i]
+        if quote:
+            if c == '\\' and quote == '`':
+                cur += code[i:i + 2]
+                i += 2
+                continue
+            if c == quote:
+                quote = None
+        elif c in '`\'"':
+            quote = c
+        elif c == ',':
+            ops.append(cur.strip())
+            cur = ''
+            i += 1
+            continue
+        cur += c
+        i += 1
+    if cur.strip():
+        ops.append(cur.strip())
+    return ops
+
+def unquote(s):
+    "bytes of a NASM string constant; backquoted strings support escapes"
+    q = s[0]
+    s = s[1:-1]
+    if q != '`':
+        return s.encode('latin-1')
+    out = bytearray()
+    i = 0
+    while i < len(s):
+        c = s[i]
+        i += 1
+        if c != '\\':
+            out += c.encode('latin-1')
+            continue
+        c = s[i]
+        i += 1
+        if c in escapes:
+            out.append(escapes[c])
+        elif c in '01234567':
+            j = i
+            while j < len(s) and j < i + 2 and s[j] in '01234567':
+                j += 1
+            out.append(int(s[i - 1:j], 8) & 0xff)
+            i = j
+        elif c == 'x':
+            j = i
+            while j < len(s) and j < i + 2 and s[j] in '0123456789abcdefABCDEF':
+                j += 1
+            out.append(int(s[i:j], 16))
+            i = j
+        else:
+            raise AssemblyError('Unknown escape: \\' + c)
+    return bytes(out)
+
+def fits8(v):
+    return -128 <= v <= 127
+
+class Chunk:
+    """
+    A piece of a section: either fixed bytes with relocations,
+    a branch whose size is decided at layout time, padding up to
+    align or reserve bytes of zeros (all a .bss section has).
+    """
+    __slots__ = ('data', 'relocs', 'branch', 'short', 'offset', 'align', 'reserve')
+    def __init__(self, data=b'', relocs=(), branch=None, align=None, reserve=0):
+        """
+        relocs is a list of (offset, symbol, type, addend)
+        branch is (op, condition code, target)
+        """
+        self.data = data
+        self.relocs = relocs
+        self.branch = branch
+        self.short = False
+        self.offset = 0
+        self.align = align
+        self.reserve = reserve
+    def size(self):
+        if self.align:
+            return -self.offset % self.align
+        if self.reserve:
+            return self.reserve
+        if not self.branch:
+            return len(self.data)
+        if self.short:
+            return 2
+        return 6 if self.branch[1] is not None else 5
+
+class Section:
+    def __init__(self, name, type, flags, align):
+        self.name = name
+        self.type = type
+        self.flags = flags
+        self.align = align
+        self.chunks = []
+        self.size = 0
+        self.index = None
+
+class Assembler:
+    """
+    Encodes the NASM lines the code generator writes into a
+    relocatable ELF32 object, without going through nasm.
+    """
+    def __init__(self):
+        self.sections = {
+            '.text': Section('.text', SHT_PROGBITS, SHF_ALLOC | SHF_EXECINSTR, 16),
+            '.data': Section('.data', SHT_PROGBITS, SHF_ALLOC | SHF_WRITE, 4),
+            '.bss': Section('.bss', SHT_NOBITS, SHF_ALLOC | SHF_WRITE, 4),
+            '.rodata': Section('.rodata', SHT_PROGBITS, SHF_ALLOC, 4),
+        }
+        self.section = self.sections['.text']
+        self.labels = {} # name: (section, chunk index)
+        self.globals = set()
+        self.externs = []
+        self.weak = set() # externs declared name:weak, 0 if never defined
+        self.scope = ''
+    def full_name(self, label):
+        "NASM local labels (.name) belong to the last normal label"
+        if label.startswith('.'):
+            return self.scope + label
+        return label
+    def define(self, label):
+        if not label.startswith('.'):
+            self.scope = label
+        name = self.full_name(label)
+        if name in self.labels:
+            raise AssemblyError('Label redefined: ' + name)
+        self.labels[name] = (self.section, len(self.section.chunks))
+    def line(self, label=None, inst=None, code=None):
+        """
+        Assemble one line. inst may carry its operands
+        (as in 'GLOBAL ?@main') if code is None.
+        """
+        if label:
+            self.define(label)
+        if not inst:
+            return
+        if code is None and ' ' in inst:
+            inst, code = inst.split(None, 1)
+        op = inst.lower()
+        if op == 'global':
+            self.globals.update(s.strip() for s in code.split(','))
+        elif op == 'extern':
+            for name in code.split(','):
+                name = name.strip()
+                if name.endswith(':weak'):
+                    name = name[:-5]
+                    self.weak.add(name)
+                self.externs.append(name)
+        elif op == 'section':
+            name = code.split()[0]
+            if name not in self.sections:
+                raise AssemblyError('Unknown section: ' + name)
+            self.section = self.sections[name]
+        elif op in ('align', 'alignb'):
+            self.section.chunks.append(Chunk(align=parse_number(code)))
+        elif op in ('resb', 'resw', 'resd'):
+            size = {'resb': 1, 'resw': 2, 'resd': 4}[op]
+            self.section.chunks.append(Chunk(reserve=size * parse_number(code)))
+        elif op in ('db', 'dw', 'dd'):
+            self.section.chunks.append(self.data(op, code))
+        elif op == 'times':
+            count, op, code = (code.split(None, 2) + [None])[:3]
+            if op.lower() not in ('db', 'dw', 'dd'):
+                raise AssemblyError('times only repeats data: ' + code)
+            c = self.data(op.lower(), code)
+            n = parse_number(count)
+            self.section.chunks.append(Chunk(c.data * n, [(off + i * len(c.data), sym, t, a)
+                                                          for i in range(n) for off, sym, t, a in c.relocs]))
+        else:
+            self.section.chunks.append(self.instruction(op, code))
+    def data(self, op, code):
+        size = {'db': 1, 'dw': 2, 'dd': 4}[op]
+        fmt = {1: '<B', 2: '<H', 4: '<I'}[size]
+        out = bytearray()
+        relocs = []
+        for item in split_operands(code):
+            if item[0] in '`\'"':
+                s = unquote(item)
+                out += s
+                if len(s) % size:
+                    out += bytes(size - len(s) % size)
+                continue
+            v = parse_operand(item)
+            if not isinstance(v, Imm):
+                raise AssemblyError('Bad data: ' + item)
+            if v.sym:
+                if size != 4:
+                    raise AssemblyError('Address does not fit: ' + item)
+                relocs.append((len(out), v.sym, R_386_32, v.value))
+            out += struct.pack(fmt, v.value & (1 << 8 * size) - 1)
+        return Chunk(bytes(out), relocs)
+    def modrm(self, out, relocs, reg, rm):
+        "append ModRM, SIB and displacement for reg field reg and operand rm"
+        if isinstance(rm, Reg):
+            out.append(0xc0 | reg << 3 | rm.num)
+            return
+        if rm.base is None and rm.index is None:
+            out.append(reg << 3 | 5)
+            self.disp32(out, relocs, rm)
+            return
+        if rm.sym is None and rm.disp == 0 and rm.base is not None and rm.base != 5:
+            mod = 0
+        elif rm.sym is None and fits8(rm.disp) and rm.base is not None:
+            mod = 1
+        else:
+            mod = 2
+        if rm.index is None and rm.base != 4:
+            out.append(mod << 6 | reg << 3 | rm.base)
+        else:
+            index = 4 if rm.index is None else rm.index
+            if index == 4 and rm.index is not None:
+                raise AssemblyError('esp cannot be an index')
+            base = rm.base
+            if base is None:
+                base = 5
+                mod = 0
+            out.append(mod << 6 | reg << 3 | 4)
+            out.append(scales[rm.scale] << 6 | index << 3 | base)
+            if rm.base is None:
+                self.disp32(out, relocs, rm)
+                return
+        if mod == 1:
+            out += struct.pack('<b', rm.disp)
+        elif mod == 2:
+            self.disp32(out, relocs, rm)
+    def disp32(self, out, relocs, v):
+        "append a 32 bit displacement or immediate, which may be an address"
+        value = v.disp if isinstance(v, Mem) else v.value
+        if v.sym:
+            relocs.append((len(out), v.sym, R_386_32, value))
+        out += struct.pack('<I', value & 0xffffffff)
+    def instruction(self, op, code):
+        ops = [parse_operand(o) for o in split_operands(code)] if code else []
+        out = bytearray()
+        relocs = []
+        if op in prefixes:
+            # rep movsd etc.
+            out.append(prefixes[op])
+            op, code = (code.split(None, 1) + [None])[:2]
+            op = op.lower()
+            ops = [parse_operand(o) for o in split_operands(code)] if code else []
+        if op in plain_ops and not ops:
+            out += plain_ops[op]
+        elif op in ('jmp', 'call') or (op[0] == 'j' and op[1:] in conditions):
+            target = ops[0] if ops else None
+            if isinstance(target, Imm) and target.sym and not target.value:
+                cc = conditions[op[1:]] if op not in ('jmp', 'call') else None
+                if op == 'call':
+                    # calls are never short
+                    return Chunk(branch=(op, None, self.full_name(target.sym)))
+                return Chunk(branch=(op, cc, self.full_name(target.sym)))
+            if op in ('jmp', 'call') and isinstance(target, (Reg, Mem)):
+                out.append(0xff)
+                self.modrm(out, relocs, 4 if op == 'jmp' else 2, target)
+            else:
+                raise AssemblyError('Bad operand for ' + op + ': ' + code)
+        elif op in ('push', 'pop'):
+            a = ops[0]
+            if isinstance(a, Reg) and a.size == 4:
+                out.append((0x50 if op == 'push' else 0x58) + a.num)
+            elif isinstance(a, Mem):
+                out.append(0xff if op == 'push' else 0x8f)
+                self.modrm(out, relocs, 6 if op == 'push' else 0, a)
+            elif isinstance(a, Imm) and op == 'push':
+                if a.sym is None and fits8(a.value):
+                    out += struct.pack('<Bb', 0x6a, a.value)
+                else:
+                    out.append(0x68)
+                    self.disp32(out, relocs, a)
+            else:
+                raise AssemblyError('Bad operand for ' + op + ': ' + code)
+        elif op == 'mov':
+            a, b = ops
+            size = self.size(a, b)
+            if isinstance(b, Imm):
+                if isinstance(a, Reg):
+                    out.append((0xb8 if size == 4 else 0xb0) + a.num)
+                else:
+                    out.append(0xc7 if size == 4 else 0xc6)
+                    self.modrm(out, relocs, 0, a)
+                if size == 4:
+                    self.disp32(out, relocs, b)
+                else:
+                    out.append(b.value & 0xff)
+            elif isinstance(b, Reg):
+                if b.num == 0 and self.absolute(a):
+                    out.append(0xa3 if size == 4 else 0xa2)
+                    self.disp32(out, relocs, a)
+                else:
+                    out.append(0x89 if size == 4 else 0x88)
+                    self.modrm(out, relocs, b.num, a)
+            elif a.num == 0 and self.absolute(b):
+                out.append(0xa1 if size == 4 else 0xa0)
+                self.disp32(out, relocs, b)
+            else:
+                out.append(0x8b if size == 4 else 0x8a)
+                self.modrm(out, relocs, a.num, b)
+        elif op in ('movsx', 'movzx'):
+            a, b = ops
+            if not isinstance(a, Reg) or a.size != 4 or (b.size or 1) != 1:
+                raise AssemblyError('Bad operands for ' + op + ': ' + code)
+            out += b'\x0f' + (b'\xbe' if op == 'movsx' else b'\xb6')
+            self.modrm(out, relocs, a.num, b)
+        elif op == 'lea':
+            a, b = ops
+            out.append(0x8d)
+            self.modrm(out, relocs, a.num, b)
+        elif op in arith_ops or op == 'test':
+            a, b = ops
+            size = self.size(a, b)
+            short_eax = isinstance(a, Reg) and a.num == 0
+            if isinstance(b, Imm):
+                if op == 'test':
+                    if short_eax:
+                        out.append(0xa9 if size == 4 else 0xa8)
+                    else:
+                        out.append(0xf7 if size == 4 else 0xf6)
+                        self.modrm(out, relocs, 0, a)
+                    if size == 4:
+                        self.disp32(out, relocs, b)
+                    else:
+                        out.append(b.value & 0xff)
+                elif size == 1:
+                    out.append(0x80)
+                    self.modrm(out, relocs, arith_ops[op], a)
+                    out.append(b.value & 0xff)
+                elif b.sym is None and fits8(b.value) or (b.sym is None and 0xffffff80 <= b.value <= 0xffffffff):
+                    out.append(0x83)
+                    self.modrm(out, relocs, arith_ops[op], a)
+                    out += struct.pack('<b', b.value if fits8(b.value) else b.value - (1 << 32))
+                elif short_eax:
+                    out.append(arith_ops[op] * 8 + 5)
+                    self.disp32(out, relocs, b)
+                else:
+                    out.append(0x81)
+                    self.modrm(out, relocs, arith_ops[op], a)
+                    self.disp32(out, relocs, b)
+            elif isinstance(b, Reg):
+                if op == 'test':
+                    out.append(0x85 if size == 4 else 0x84)
+                else:
+                    out.append(arith_ops[op] * 8 + (1 if size == 4 else 0))
+                self.modrm(out, relocs, b.num, a)
+            else:
+                if op == 'test':
+                    raise AssemblyError('Bad operands for test: ' + code)
+                out.append(arith_ops[op] * 8 + (3 if size == 4 else 2))
+                self.modrm(out, relocs, a.num, b)
+        elif op == 'imul' and len(ops) == 2:
+            a, b = ops
+            out += b'\x0f\xaf'
+            self.modrm(out, relocs, a.num, b)
+        elif op in unary_ops:
+            a = ops[0]
+            out.append(0xf7 if self.size(a) == 4 else 0xf6)
+            self.modrm(out, relocs, unary_ops[op], a)
+        elif op in ('inc', 'dec'):
+            a = ops[0]
+            if isinstance(a, Reg) and a.size == 4:
+                out.append((0x40 if op == 'inc' else 0x48) + a.num)
+            else:
+                out.append(0xff if self.size(a) == 4 else 0xfe)
+                self.modrm(out, relocs, 0 if op == 'inc' else 1, a)
+        elif op in shift_ops:
+            a, b = ops
+            size = self.size(a)
+            if isinstance(b, Reg) and b.size == 1 and b.num == REG8['cl']:
+                out.append(0xd3 if size == 4 else 0xd2)
+                self.modrm(out, relocs, shift_ops[op], a)
+            elif isinstance(b, Imm) and b.sym is None:
+                if b.value == 1:
+                    out.append(0xd1 if size == 4 else 0xd0)
+                    self.modrm(out, relocs, shift_ops[op], a)
+                else:
+                    out.append(0xc1 if size == 4 else 0xc0)
+                    self.modrm(out, relocs, shift_ops[op], a)
+                    out.append(b.value & 0xff)
+            else:
+                raise AssemblyError('Shift count must be cl or an immediate: ' + code)
+        elif op.startswith('set') and op[3:] in conditions:
+            out += bytes((0x0f, 0x90 + conditions[op[3:]]))
+            self.modrm(out, relocs, 0, ops[0])
+        elif op == 'int':
+            out += bytes((0xcd, ops[0].value & 0xff))
+        else:
+            raise AssemblyError('Unknown instruction: ' + op + (' ' + code if code else ''))
+        return Chunk(bytes(out), relocs)
+    def absolute(self, m):
+        "memory operand with only a displacement (eax has short forms for these)"
+        return isinstance(m, Mem) and m.base is None and m.index is None
+    def size(self, a, b=None):
+        "operand size in bytes, from a register or a size prefix"
+        for o in (a, b):
+            if isinstance(o, Reg):
+                return o.size
+        for o in (a, b):
+            if isinstance(o, Mem) and o.size:
+                return o.size
+        return 4
+    def layout(self):
+        """
+        Assign offsets to every chunk. Branches to labels in the same
+        section start short and are made near when they don't reach.
+        A section is aligned like its most aligned chunk.
+        """
+        for s in self.sections.values():
+            s.align = max([s.align] + [c.align for c in s.chunks if c.align])
+        text = self.sections['.text']
+        for c in text.chunks:
+            if c.branch:
+                c.short = c.branch[0] != 'call' and self.labels.get(c.branch[2], (None,))[0] is text
+        changed = True
+        while changed:
+            changed = False
+            for s in self.sections.values():
+                off = 0
+                for c in s.chunks:
+                    c.offset = off
+                    off += c.size()
+                s.size = off
+            for c in text.chunks:
+                if c.short and not fits8(self.address(c.branch[2])[1] - c.offset - 2):
+                    c.short = False
+                    changed = True
+    def address(self, name):
+        "returns (section, offset) of a defined label"
+        section, i = self.labels[name]
+        if i < len(section.chunks):
+            return section, section.chunks[i].offset
+        return section, section.size
+    def write(self, f):
+        """
+        Write the relocatable ELF32 object to the binary file f
+        """
+        self.layout()
+        for name in self.globals:
+            if name not in self.labels and name not in self.externs:
+                self.externs.append(name)
+        # only the sections something is in (.text and .data always, like nasm)
+        used = {section for section, _ in self.labels.values()}
+        sections = [s for s in self.sections.values()
+                    if s.name in ('.text', '.data') or s.chunks or s in used]
+        # symbols: null, sections, locals, then globals
+        strtab = bytearray(b'\0')
+        def string(s):
+            off = len(strtab)
+            strtab.extend(s.encode() + b'\0')
+            return off
+        for i, s in enumerate(sections):
+            s.index = i + 1
+        symbols = [(0, 0, 0, 0)]
+        section_sym = {}
+        for s in sections:
+            section_sym[s.name] = len(symbols)
+            symbols.append((0, 0, STB_LOCAL << 4 | STT_SECTION, s.index))
+        named = [n for n in self.labels if not self.is_local(n)]
+        for n in named:
+            if n not in self.globals:
+                section, off = self.address(n)
+                symbols.append((string(n), off, STB_LOCAL << 4 | STT_NOTYPE, section.index))
+        first_global = len(symbols)
+        extern_sym = {}
+        for n in named:
+            if n in self.globals:
+                section, off = self.address(n)
+                symbols.append((string(n), off, STB_GLOBAL << 4 | STT_NOTYPE, section.index))
+        for n in self.externs:
+            if n in self.labels:
+                continue
+            extern_sym[n] = len(symbols)
+            symbols.append((string(n), 0, (STB_WEAK if n in self.weak else STB_GLOBAL) << 4 | STT_NOTYPE, 0))
+        # section contents and relocations
+        contents = {}
+        rels = {}
+        for s in sections:
+            out = bytearray()
+            rel = []
+            for c in s.chunks:
+                if s.type == SHT_NOBITS:
+                    if c.data or c.branch:
+                        raise AssemblyError('Only space can be reserved in ' + s.name)
+                    continue
+                assert len(out) == c.offset
+                if c.align:
+                    out += (b'\x90' if s.name == '.text' else b'\0') * c.size()
+                    continue
+                if c.reserve:
+                    out += bytes(c.reserve)
+                    continue
+                if c.branch:
+                    out += self.branch(s, c, rel, extern_sym, section_sym)
+                    continue
+                data = bytearray(c.data)
+                for off, sym, type, addend in c.relocs:
+                    if sym in self.labels:
+                        section, target = self.address(sym)
+                        addend += target
+                        index = section_sym[section.name]
+                    elif sym in extern_sym:
+                        index = extern_sym[sym]
+                    else:
+                        raise AssemblyError('Undefined symbol: ' + sym)
+                    struct.pack_into('<I', data, off, addend & 0xffffffff)
+                    rel.append((c.offset + off, index << 8 | type))
+                out += data
+            contents[s.name] = bytes(out)
+            rels[s.name] = rel
+        # file layout
+        shstrtab = bytearray(b'\0')
+        def shstring(s):
+            off = len(shstrtab)
+            shstrtab.extend(s.encode() + b'\0')
+            return off
+        headers = [(0,) * 10]
+        body = bytearray()
+        offset = 52
+        def add(data, align):
+            nonlocal offset
+            pad = -(offset + len(body)) % align
+            body.extend(bytes(pad))
+            start = offset + len(body)
+            body.extend(data)
+            return start
+        for s in sections:
+            data = contents[s.name]
+            start = add(data if s.type != SHT_NOBITS else b'', s.align)
+            headers.append((shstring(s.name), s.type, s.flags, 0, start, len(data) if s.type != SHT_NOBITS else s.size, 0, 0, s.align, 0))
+        symtab_index = len(headers)
+        strtab_index = symtab_index + 1
+        symdata = b''.join(struct.pack('<IIIBBH', name, value, 0, info, 0, shndx) for name, value, info, shndx in symbols)
+        headers.append((shstring('.symtab'), SHT_SYMTAB, 0, 0, add(symdata, 4), len(symdata), strtab_index, first_global, 4, 16))
+        headers.append((shstring('.strtab'), SHT_STRTAB, 0, 0, add(bytes(strtab), 1), len(strtab), 0, 0, 1, 0))
+        for s in sections:
+            if rels[s.name]:
+                reldata = b''.join(struct.pack('<II', off, info) for off, info in rels[s.name])
+                headers.append((shstring('.rel' + s.name), SHT_REL, 0, 0, add(reldata, 4), len(reldata), symtab_index, s.index, 4, 8))
+        shstrndx = len(headers)
+        name = shstring('.shstrtab')
+        headers.append((name, SHT_STRTAB, 0, 0, add(bytes(shstrtab), 1), len(shstrtab), 0, 0, 1, 0))
+        shoff = add(b'', 4)
+        ident = b'\x7fELF' + bytes((1, 1, 1, 0)) + bytes(8)
+        f.write(ident + struct.pack('<HHIIIIIHHHHHH', 1, 3, 1, 0, 0, shoff, 0, 52, 0, 0, 40, len(headers), shstrndx))
+        f.write(body)
+        for h in headers:
+            f.write(struct.pack('<IIIIIIIIII', *h))
+    def is_local(self, name):
+        "labels like ?@main.while0 are NASM local labels"
+        return '.' in name[1:] and name[:name.index('.', 1)] in self.labels
+    def branch(self, section, c, rel, extern_sym, section_sym):
+        op, cc, target = c.branch
+        end = c.offset + c.size()
+        if c.short:
+            disp = self.address(target)[1] - end
+            return struct.pack('<Bb', 0xeb if op == 'jmp' else 0x70 + cc, disp)
+        out = bytearray({'jmp': b'\xe9', 'call': b'\xe8'}.get(op) or bytes((0x0f, 0x80 + cc)))
+        if target in self.labels:
+            tsection, toff = self.address(target)
+            if tsection is section:
+                return out + struct.pack('<i', toff - end)
+            index = section_sym[tsection.name]
+            addend = toff - 4
+        elif target in extern_sym:
+            index = extern_sym[target]
+            addend = -4
+        else:
+            raise AssemblyError('Undefined symbol: ' + target)
+        rel.append((end - 4, index << 8 | R_386_PC32))
+        return out + struct.pack('<i', addend)
+
+def assemble(lines, out):
+    """
+    Assemble NASM source lines (the subset the code generator and
+    canada.s use) and write the object to the binary file out
+    """
+    asm = Assembler()
+    live = [] # for each enclosing %ifidn, whether its lines are assembled
+    for l in lines:
+        l = split_comment(l).strip()
+        if not l:
+            continue
+        if l.startswith('%'):
+            directive, _, arg = l.partition(' ')
+            if directive == '%ifidn' and ',' in arg:
+                a, b = (s.strip() for s in arg.split(',', 1))
+                live.append(a.replace('__OUTPUT_FORMAT__', 'elf32') == b)
+            elif directive == '%else' and live:
+                live[-1] = not live[-1]
+            elif directive == '%endif' and live:
+                live.pop()
+            else:
+                raise AssemblyError('Unsupported directive: ' + l)
+            continue
+        if not all(live):
+            continue
+        label = None
+        m = re.match(r'([.?@\w$]+):\s*', l)
+        if m:
+            label = m.group(1)
+            l = l[m.end():]
+        if not l:
+            asm.line(label)
+            continue
+        inst, code = (l.split(None, 1) + [None])[:2]
+        asm.line(label, inst, code)
+    if live:
+        raise AssemblyError('%ifidn without %endif')
+    asm.write(out)
+
+def split_comment(l):
+    "strip a ; comment that isn't inside a string"
+    quote = None
+    escaped = False
+    for i, c in enumerate(l):
+        if escaped:
+            escaped = False
+        elif quote:
+            if c == '\\' and quote == '`':
+                escaped = True
+            elif c == quote:
+                quote = None
+        elif c in '`\'"':
+            quote = c
+        elif c == ';':
+            return l[:i]
+    return l
+
+if __name__ == '__main__':
+    import os
+    import sys
+    import argparse
+    ap = argparse.ArgumentParser(description='Assemble the NASM subset the code generator writes into ELF32 objects')
+    ap.add_argument('files', nargs='+')
+    ap.add_argument('-o', dest='out', help='output file (with only one input, default: the input with .o)')
+    args = ap.parse_args()
+    if args.out and len(args.files) > 1:
+        ap.error('-o can only be used with one input file')
+    for fn in args.files:
+        obj = args.out or os.path.splitext(fn)[0] + '.o'
+        try:
+            with open(fn) as f, open(obj, 'wb') as out:
+                assemble(f, out)
+        except AssemblyError as err:
+            # don't leave half an object for make to find
+            os.remove(obj)
+            sys.stdout.write("ERROR: " + fn + ": " + str(err) + '\n')
+            sys.exit(1)
@@ -0,0 +1,199 @@
+"""
+Module interface files (.cai): what a module exports, so other modules
+can check their externs against it (or get them declared) without
+parsing its source.
+
+Layout, little endian:
+    header   magic 'CAI\\0', u16 version, u16 0, u32 number of records
+    records  u32 name offset, u8 kind, u8 type, u16 0, u32 count
+    names    NUL terminated, the offsets are into here
+
+count is the number of parameters of a function and the length of
+an array (0 if unknown), and 0 for plain variables.
+"""
+import struct
+
+import canadaparse
+
+from canadaparse import GlobalVariable, PrimitiveType, Void, ArrayDeclaration, Function, VariableDeclaration, Export, Extern
+from canadacodegen import CompilationError
+
+MAGIC = b'CAI\0'
+VERSION = 1
+
+HEADER = struct.Struct('<4sHHI')
+RECORD = struct.Struct('<IBBHI')
+
+# kinds
+FUNCTION = 0
+VARIABLE = 1
+ARRAY = 2
+
+types = ['void', 'int', 'char']
+
+class InterfaceError(Exception):
+    pass
+
+class Symbol:
+    "one export"
+    __slots__ = ('name', 'kind', 'type', 'count')
+    def __init__(self, name, kind, type, count=0):
+        """
+        :type kind: int
+        :type type: str
+        """
+        self.name = name
+        self.kind = kind
+        self.type = type
+        self.count = count
+    def __repr__(self):
+        if self.kind == FUNCTION:
+            return self.type + ' ' + self.name + '(' + ', '.join('a' + str(i) for i in range(self.count)) + ')'
+        elif self.kind == ARRAY:
+            return self.type + '[' + (str(self.count) if self.count else '') + '] ' + self.name
+        return self.type + ' ' + self.name
+
+def symbol(d):
+    "the Symbol for the definition d"
+    if isinstance(d, Function):
+        return Symbol(d.name, FUNCTION, 'void' if isinstance(d.type, Void) else d.type.type, len(d.par_list))
+    assert isinstance(d, GlobalVariable)
+    if isinstance(d.var_type, ArrayDeclaration):
+        return Symbol(d.name, ARRAY, d.var_type.prim_type, d.var_type.length or 0)
+    return Symbol(d.name, VARIABLE, d.var_type.type)
+
+def exports(ast):
+    """
+    The Symbols exported by the program ast
+
+    :type ast: Program
+    """
+    defs = {d.name: d for d in ast.decls if isinstance(d, (Function, GlobalVariable))}
+    symbols = []
+    for d in ast.decls:
+        if isinstance(d, Export):
+            if d.name not in defs:
+                raise CompilationError("Exported " + d.name + " is not defined", d)
+            symbols.append(symbol(defs[d.name]))
+    return symbols
+
+def dumps(symbols):
+    names = bytearray()
+    records = []
+    for s in symbols:
+        records.append(RECORD.pack(len(names), s.kind, types.index(s.type), 0, s.count))
+        names += s.name.encode() + b'\0'
+    return HEADER.pack(MAGIC, VERSION, 0, len(records)) + b''.join(records) + bytes(names)
+
+def loads(data):
+    "returns {name: Symbol}"
+    if len(data) < HEADER.size:
+        raise InterfaceError("Not an interface file")
+    magic, version, _, count = HEADER.unpack_from(data)
+    if magic != MAGIC:
+        raise InterfaceError("Not an interface file")
+    if version != VERSION:
+        raise InterfaceError("Interface file version %d, expected %d" % (version, VERSION))
+    start = HEADER.size + count * RECORD.size
+    if len(data) < start:
+        raise InterfaceError("Truncated interface file")
+    symbols = {}
+    for off, kind, type, _, n in RECORD.iter_unpack(data[HEADER.size:start]):
+        if kind not in (FUNCTION, VARIABLE, ARRAY) or type >= len(types):
+            raise InterfaceError("Corrupt interface file")
+        off += start
+        end = data.find(b'\0', off)
+        if end < 0:
+            raise InterfaceError("Truncated interface file")
+        try:
+            name = data[off:end].decode()
+        except UnicodeDecodeError:
+            raise InterfaceError("Corrupt interface file")
+        if not name:
+            raise InterfaceError("Corrupt interface file")
+        symbols[name] = Symbol(name, kind, types[type], n)
+    return symbols
+
+def write(ast, fn):
+    with open(fn, 'wb') as f:
+        f.write(dumps(exports(ast)))
+
+def read(fn):
+    "returns {name: Symbol}"
+    with open(fn, 'rb') as f:
+        return loads(f.read())
+
+def load(filenames):
+    "all the symbols of the interface files"
+    symbols = {}
+    for fn in filenames:
+        symbols.update(read(fn))
+    return symbols
+
+def matches(ext, s):
+    ":type ext: Extern"
+    if ext.is_var:
+        if s.kind == FUNCTION:
+            return False
+        if isinstance(ext.type, ArrayDeclaration):
+            return (s.kind == ARRAY and ext.type.prim_type == s.type and
+                    (not ext.type.length or not s.count or ext.type.length == s.count))
+        return s.kind == VARIABLE and ext.type.type == s.type
+    if s.kind != FUNCTION or len(ext.par_list) != s.count:
+        return False
+    return s.type == ('void' if isinstance(ext.type, Void) else ext.type.type)
+
+def extern(s):
+    "an Extern declaring the Symbol s"
+    if s.kind == FUNCTION:
+        params = ['a' + str(i) for i in range(s.count)]
+        return Extern((s.name if s.type == 'void' else VariableDeclaration(PrimitiveType(s.type), s.name), (False, params)))
+    elif s.kind == ARRAY:
+        return Extern(VariableDeclaration(ArrayDeclaration(s.type, s.count or None), s.name))
+    return Extern(VariableDeclaration(PrimitiveType(s.type), s.name))
+
+def resolve(ast, symbols):
+    """
+    Check the externs of ast against symbols, and declare the
+    symbols ast uses without declaring them
+
+    :type symbols: dict
+    """
+    import canadalink
+    declared = set()
+    for d in ast.decls:
+        if isinstance(d, Extern):
+            declared.add(d.name)
+            s = symbols.get(d.name)
+            if d.c is None and s is not None and not matches(d, s):
+                raise CompilationError(repr(d) + " does not match " + repr(s), d)
+        elif isinstance(d, (Function, GlobalVariable)):
+            declared.add(d.name)
+    used = set()
+    for d in ast.decls:
+        if isinstance(d, Function):
+            used |= canadalink.references(d)
+    for name in sorted(used - declared):
+        if name in symbols:
+            ast.append(extern(symbols[name]))
+
+if __name__ == '__main__':
+    import os
+    import sys
+    import argparse
+    ap = argparse.ArgumentParser(description='Write interface files for Canada sources, or print the externs in interface files')
+    ap.add_argument('files', nargs='+', help='.ca files to write .cai files for, or .cai files to print')
+    args = ap.parse_args()
+    for fn in args.files:
+        try:
+            if fn.endswith('.cai'):
+                for s in read(fn).values():
+                    sys.stdout.write('extern ' + repr(s) + ';\n')
+            else:
+                with open(fn) as f:
+                    write(canadaparse.parse(f.read()), os.path.splitext(fn)[0] + '.cai')
+        except (CompilationError, InterfaceError) as err:
+            sys.stdout.write("ERROR in " + fn + ": ")
+            sys.stdout.write(str(err))
+            sys.stdout.write('\n')
+            sys.exit(1)
@@ -13,6 +13,9 @@ reserved = (
     'return',
     'export',
     'extern',
+    'switch',
+    'case',
+    'default',
 )
 
 types = (
@@ -40,7 +43,7 @@ tokens = [
 # \ is unsigned /
 # # is unsigned * (mul)
 # # is * for char (deref)
-literals = "()[]+-!~*&|/^,%@#{};\\"
+literals = "()[]+-!~*&|/^,%@#{};:\\"
 
 def t_INT_LIT(t):
     r'-?\d+'
@@ -72,8 +75,12 @@ def t_ELLIPSIS(t):
     t.value = Ellipsis
     return t
 
+# function so it is tried before RELOP, which would match a single < or >
+def t_SHIFT(t):
+    r'<<|>>>?' # >>> is unsigned
+    return t
+
 t_SYSCALL = '|'.join(map(re.escape, syscalls.keys()))
-t_SHIFT = r'<<|>>>?' # >>> is unsigned
 t_RELOP = r'[<>]\|?=?|[=!]=' # >|, <|, >|=, <|= is unsigned
 t_EQ = r'='
 t_AND = r'&&'
@@ -0,0 +1,359 @@
+"""
+Whole-program compilation: parse several modules, resolve their
+export/extern declarations against each other in memory and compile
+them as one program, so calls and globals are optimized across module
+boundaries. The result can still be split into one file per module.
+"""
+import copy
+import os
+import re
+
+import canadaparse
+import canadacodegen
+
+from canadaparse import Program, GlobalVariable, Void, Function, Block, EmptyStatement, ReturnStatement, VariableDeclaration, Literal, BinaryExpression, FunctionCall, Identifier, Address, ArrayAccess, Export, Extern
+from canadacodegen import CompilationError
+from canadaopt import slots, get_slot, set_slot, rewrite, nodes, global_names, global_uses, constant_globals, substitute, evaluate_calls
+
+# functions returning an expression with at most this many nodes are inlined
+INLINE_SIZE = 24
+# exports that _start calls if they are linked in (io.ca's flush),
+# so they stay visible like main
+RUNTIME_HOOKS = ('flush',)
+
+class Module:
+    def __init__(self, name, program):
+        """
+        :type name: str
+        :type program: Program
+        """
+        self.name = name
+        self.program = program
+        self.defs = {} # name -> Function or GlobalVariable
+        self.exports = set()
+        self.externs = []
+        for d in program.decls:
+            if isinstance(d, (Function, GlobalVariable)):
+                if d.name in self.defs:
+                    raise CompilationError(d.name + " defined twice in " + name, d)
+                self.defs[d.name] = d
+            elif isinstance(d, Export):
+                self.exports.add(d.name)
+            else:
+                assert isinstance(d, Extern)
+                self.externs.append(d)
+
+def copy_expr(expr, replace=None):
+    """
+    Deep copy of an expression. replace(node) can return
+    something to use instead of copying node.
+    """
+    root = [expr]
+    work = [(root, 0)]
+    while work:
+        container, key = work.pop()
+        node = get_slot(container, key)
+        new = replace(node) if replace else None
+        if new is None:
+            new = copy.copy(node)
+            if isinstance(new, FunctionCall):
+                new.args = list(new.args)
+            work.extend(slots(new))
+        set_slot(container, key, new)
+    return root[0]
+
+def references(f):
+    "the set of global names used by f"
+    refs = set()
+    rewrite(f, lambda node, scope: refs.update(global_names(node, scope)))
+    return refs
+
+def pure(expr):
+    "no calls and no assignments"
+    return not any(isinstance(n, FunctionCall) or (isinstance(n, BinaryExpression) and n.op == '=')
+                   for n in nodes(expr))
+
+def load(filenames):
+    "parse each file into a Module named after it"
+    modules = []
+    for fn in filenames:
+        with open(fn) as f:
+            name = re.sub(r'\W', '_', os.path.splitext(os.path.basename(fn))[0])
+            modules.append(Module(name, canadaparse.parse(f.read())))
+    return modules
+
+class WholeProgram:
+    """
+    Modules linked together: every definition has a name that is
+    unique in the program (private ones are renamed if they clash),
+    and externs between the modules are gone.
+    """
+    def __init__(self, modules, keep_exports=False):
+        """
+        :type modules: list
+
+        main is the only thing that has to stay visible outside the
+        program, unless there is no main (then it's a library and all
+        exports do) or keep_exports
+        """
+        self.modules = modules
+        self.defs = {} # name -> Function or GlobalVariable
+        self.origin = {} # name -> Module
+        self.externs = {} # name -> Extern for things outside the program
+        exported = {}
+        for m in modules:
+            for name in m.exports:
+                if name not in m.defs:
+                    raise CompilationError("Exported " + name + " is not defined in " + m.name, None)
+                if name in exported:
+                    raise CompilationError(name + " is exported by both " + exported[name].name + " and " + m.name, None)
+                exported[name] = m
+        mains = [m for m in modules if 'main' in m.defs]
+        if len(mains) > 1:
+            raise CompilationError("main is defined in both " + mains[0].name + " and " + mains[1].name, None)
+        # every name some module defines or declares
+        declared = {}
+        for m in modules:
+            for name in list(m.defs) + [e.name for e in m.externs]:
+                declared.setdefault(name, set()).add(m)
+        private = {}
+        for m in modules:
+            renames = {}
+            for name in m.defs:
+                if name not in m.exports:
+                    private.setdefault(name, m)
+                if name not in m.exports and name != 'main' and len(declared[name]) > 1:
+                    renames[name] = name + '?' + m.name
+            self.rename(m, renames)
+            for name, d in m.defs.items():
+                self.defs[name] = d
+                self.origin[name] = m
+        for m in modules:
+            for ext in m.externs:
+                if ext.c is None and ext.name in exported:
+                    self.check_extern(ext, exported[ext.name].defs[ext.name])
+                elif ext.c is None and private.get(ext.name, m) is not m:
+                    raise CompilationError(ext.name + " is not exported by " + private[ext.name].name, ext)
+                else:
+                    old = self.externs.setdefault(ext.name, ext)
+                    if (old.c is None) != (ext.c is None) or old.is_var != ext.is_var:
+                        raise CompilationError("Conflicting externs for " + ext.name, ext)
+        if mains:
+            self.roots = {'main'} | (set(exported) if keep_exports else set(exported) & set(RUNTIME_HOOKS))
+        else:
+            self.roots = set(exported)
+    def rename(self, m, renames):
+        "rename private definitions of m"
+        if not renames:
+            return
+        defs = {}
+        for name, d in m.defs.items():
+            d.name = renames.get(name, name)
+            defs[d.name] = d
+        m.defs = defs
+        def fn(node, scope):
+            if isinstance(node, FunctionCall):
+                node.name = renames.get(node.name, node.name)
+            elif isinstance(node, Identifier) and node.name not in scope:
+                node.name = renames.get(node.name, node.name)
+            elif isinstance(node, ArrayAccess) and node.array not in scope:
+                node.array = renames.get(node.array, node.array)
+        for d in m.defs.values():
+            if isinstance(d, Function):
+                rewrite(d, fn)
+    def check_extern(self, ext, d):
+        "ext is resolved to the definition d"
+        if ext.is_var != isinstance(d, GlobalVariable):
+            raise CompilationError(repr(ext) + " does not match " + d.name + " in " + self.origin[d.name].name, ext)
+        if ext.is_var:
+            return
+        if isinstance(ext.type, Void) != isinstance(d.type, Void):
+            raise CompilationError(repr(ext) + " does not match " + d.prototype(), ext)
+        if not ext.varargs and len(ext.par_list) != len(d.par_list):
+            raise CompilationError(repr(ext) + " does not match " + d.prototype(), ext)
+    def functions(self):
+        return [d for d in self.defs.values() if isinstance(d, Function)]
+    def inline(self):
+        """
+        Replace calls to functions that only return a small pure
+        expression of their parameters and globals by that expression
+        """
+        bodies = {}
+        for f in self.functions():
+            expr = inline_body(f)
+            if expr is not None:
+                bodies[f.name] = (f, expr)
+        if not bodies:
+            return
+        def fn(node, scope):
+            if not isinstance(node, FunctionCall) or node.name not in bodies:
+                return None
+            f, expr = bodies[node.name]
+            if len(node.args) != len(f.par_list) or not all(pure(a) for a in node.args):
+                return None
+            args = dict(zip(f.par_list, node.args))
+            uses = dict.fromkeys(f.par_list, 0)
+            for n in nodes(expr):
+                if isinstance(n, Identifier) and n.name in args:
+                    uses[n.name] += 1
+                elif isinstance(n, (Identifier, ArrayAccess)):
+                    # the caller must see the same globals
+                    if (n.name if isinstance(n, Identifier) else n.array) in scope:
+                        return None
+            for p, arg in args.items():
+                if uses[p] > 1 and not (isinstance(arg, Identifier) or
+                                        (isinstance(arg, Literal) and arg.type != 'STRING_LIT')):
+                    return None
+            return copy_expr(expr, lambda n: copy_expr(args[n.name])
+                             if isinstance(n, Identifier) and n.name in args else None)
+        for f in self.functions():
+            rewrite(f, fn)
+    def propagate_constants(self):
+        """
+        Replace reads of scalar globals that are never written
+        (and whose address is never taken) by their value, and fold
+        the operators that leaves with constant operands
+        """
+        functions = self.functions()
+        written = global_uses(functions)[1]
+        values = constant_globals(self.defs.values(), written | self.roots)
+        for f in functions:
+            substitute(f, values)
+    def evaluate_calls(self):
+        "replace calls to pure functions with constant arguments by their result"
+        evaluate_calls(self.functions(), self.defs)
+    def remove_dead(self):
+        "drop definitions and externs that can't be reached from the roots"
+        live = set()
+        work = [name for name in self.roots if name in self.defs]
+        while work:
+            name = work.pop()
+            if name in live:
+                continue
+            live.add(name)
+            d = self.defs.get(name)
+            if isinstance(d, Function):
+                work.extend(n for n in references(d) if n not in live)
+        self.defs = {name: d for name, d in self.defs.items() if name in live}
+        self.externs = {name: e for name, e in self.externs.items() if name in live}
+    def optimize(self, inline=True):
+        if inline:
+            self.inline()
+        # dead code doesn't count as writing a global
+        self.remove_dead()
+        self.propagate_constants()
+        self.evaluate_calls()
+        self.remove_dead()
+    def program(self):
+        "everything as one Program"
+        program = Program()
+        for ext in self.externs.values():
+            program.append(ext)
+        for name in sorted(self.roots):
+            if name != 'main' and name in self.defs:
+                program.append(Export(name, isinstance(self.defs[name], Function)))
+        for d in self.defs.values():
+            program.append(d)
+        return program
+    def split(self):
+        "returns [(Module, Program)], each module with just its own definitions"
+        used = {} # name -> modules using it
+        for d in self.defs.values():
+            if isinstance(d, Function):
+                for name in references(d):
+                    used.setdefault(name, set()).add(self.origin[d.name])
+        programs = []
+        for m in self.modules:
+            program = Program()
+            mine = [d for name, d in self.defs.items() if self.origin[name] is m]
+            for name, users in sorted(used.items()):
+                if m not in users or (name in self.defs and self.origin[name] is m):
+                    continue
+                if name in self.defs:
+                    program.append(extern_for(self.defs[name]))
+                elif name in self.externs:
+                    program.append(self.externs[name])
+            for d in mine:
+                if d.name != 'main' and (d.name in self.roots or used.get(d.name, {m}) - {m}):
+                    program.append(Export(d.name, isinstance(d, Function)))
+            for d in mine:
+                program.append(d)
+            programs.append((m, program))
+        return programs
+
+def inline_body(f):
+    """
+    the expression f returns if f is only 'return expr;' and
+    expr is small and doesn't depend on f having a stack frame
+    """
+    s = f.statement
+    if isinstance(s, Block):
+        stmts = [x for x in s.statements if not isinstance(x, EmptyStatement)]
+        if len(stmts) != 1:
+            return None
+        s = stmts[0]
+    if not isinstance(s, ReturnStatement) or s.expr is None or isinstance(f.type, Void):
+        return None
+    count = 0
+    for n in nodes(s.expr):
+        count += 1
+        if count > INLINE_SIZE or isinstance(n, FunctionCall):
+            return None
+        if isinstance(n, BinaryExpression) and n.op == '=':
+            return None
+        if isinstance(n, ArrayAccess) and n.array in f.par_list:
+            return None
+        if isinstance(n, Address) and isinstance(n.lvalue, Identifier) and n.lvalue.name in f.par_list:
+            return None
+    return s.expr
+
+def extern_for(d):
+    "an Extern declaring the definition d"
+    if isinstance(d, GlobalVariable):
+        return Extern(VariableDeclaration(d.var_type, d.name))
+    return Extern((d.name if isinstance(d.type, Void) else VariableDeclaration(d.type, d.name),
+                   (False, list(d.par_list))))
+
+def generate(filenames, out=None, split=False, inline=True, keep_exports=False, **kwargs):
+    """
+    Compile the files as one program into out (defaults to the first
+    file with its extension replaced), or with split, into one file
+    per module like canadacodegen.generate does. kwargs are passed on
+    to canadacodegen.generate_ast.
+    """
+    whole = WholeProgram(load(filenames), keep_exports)
+    whole.optimize(inline)
+    ext = '.o' if kwargs.get('elf') else '.s'
+    if split:
+        for fn, (m, program) in zip(filenames, whole.split()):
+            canadacodegen.generate_ast(program, os.path.splitext(fn)[0] + ext, **kwargs)
+    else:
+        if not out:
+            out = os.path.splitext(filenames[0])[0] + ext
+        canadacodegen.generate_ast(whole.program(), out, **kwargs)
+
+if __name__ == '__main__':
+    import sys
+    import argparse
+    ap = argparse.ArgumentParser(description='Compile Canada modules together as one program')
+    ap.add_argument('files', nargs='+')
+    ap.add_argument('-o', dest='out', help='output file (default: first file with .s or .o)')
+    ap.add_argument('--split', action='store_true', help='write one file per module')
+    ap.add_argument('--no-inline', dest='inline', action='store_false', help="don't inline small functions")
+    ap.add_argument('--keep-exports', action='store_true', help='keep exported symbols visible even with a main')
+    ap.add_argument('--elf', action='store_true', help='write ELF32 objects directly instead of assembly')
+    ap.add_argument('--target', choices=sorted(canadacodegen.targets), default='x86', help='instruction set to generate code for')
+    ap.add_argument('--profile', action='store_true', help='count calls, loop iterations and if/else arms (see canadaprof.py)')
+    args = ap.parse_args()
+    if args.elf and args.target != 'x86':
+        ap.error('--elf is only supported for x86')
+    if args.split and args.out:
+        ap.error('-o can not be used with --split')
+    try:
+        generate(args.files, args.out, args.split, args.inline, args.keep_exports,
+                elf=args.elf, target=args.target, profile=args.profile)
+    except CompilationError as err:
+        sys.stdout.write("ERROR: ")
+        sys.stdout.write(str(err))
+        sys.stdout.write('\n')
+        sys.exit(1)
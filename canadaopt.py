@@ -0,0 +1,356 @@
+"""
+What the code generator (one module at a time) and canadalink (whole
+programs) both optimize: walking function bodies, finding the globals
+nothing writes, replacing their reads and the operators on constants
+by values, and calls to pure functions with constant arguments by
+their result. The arithmetic is the machine's, and canadavm runs
+programs with the same operators. This only needs canadaparse, so the
+code generator can use it without loading the linker or the VM (which
+evaluate_calls only loads if there is a call to work out).
+"""
+from canadaparse import Program, GlobalVariable, PrimitiveType, Void, Function, Block, IfStatement, WhileLoop, SwitchStatement, Case, ReturnStatement, VariableDeclaration, Expression, ExpressionStatement, Literal, BinaryExpression, FunctionCall, Identifier, Dereference, Address, ArrayAccess, Unary
+
+# calls to pure functions with constant arguments are replaced by their
+# result if working it out takes at most this many steps (expressions
+# and statements evaluated)
+FOLD_STEPS = 100000
+
+class Scope:
+    """
+    the local names visible at some point in a function, with how many
+    of the enclosing blocks declare each; a block adds its names when
+    the walk enters it and removes them when it leaves
+    """
+    __slots__ = ('counts',)
+    def __init__(self, names):
+        self.counts = {}
+        self.add(names)
+    def add(self, names):
+        for name in names:
+            self.counts[name] = self.counts.get(name, 0) + 1
+    def remove(self, names):
+        for name in names:
+            if self.counts[name] == 1:
+                del self.counts[name]
+            else:
+                self.counts[name] -= 1
+    def __contains__(self, name):
+        return name in self.counts
+
+def slots(node):
+    "(container, key) of each statement or expression directly under node"
+    if isinstance(node, Block):
+        return [(node.statements, i) for i in range(len(node.statements))]
+    elif isinstance(node, IfStatement):
+        return [(node, 'condition'), (node, 'statement')] + ([(node, 'else_clause')] if node.else_clause else [])
+    elif isinstance(node, WhileLoop):
+        return [(node, 'condition'), (node, 'statement')]
+    elif isinstance(node, SwitchStatement):
+        return [(node, 'expr')] + [(node.cases, i) for i in range(len(node.cases))]
+    elif isinstance(node, Case):
+        return [(node.statements, i) for i in range(len(node.statements))]
+    elif isinstance(node, ReturnStatement):
+        return [(node, 'expr')] if node.expr is not None else []
+    elif isinstance(node, (ExpressionStatement, Unary, Dereference)):
+        return [(node, 'expr')]
+    elif isinstance(node, BinaryExpression):
+        return [(node, 'lhs'), (node, 'rhs')]
+    elif isinstance(node, FunctionCall):
+        return [(node.args, i) for i in range(len(node.args))]
+    elif isinstance(node, Address):
+        return [(node, 'lvalue')]
+    elif isinstance(node, ArrayAccess):
+        return [(node, 'index')]
+    return []
+
+def get_slot(container, key):
+    "the node in one of the slots of slots()"
+    return container[key] if isinstance(key, int) else getattr(container, key)
+
+def set_slot(container, key, value):
+    "put value in one of the slots of slots()"
+    if isinstance(key, int):
+        container[key] = value
+    else:
+        setattr(container, key, value)
+
+def declared(block):
+    "names of the variables block declares"
+    return [s.name for s in block.statements if isinstance(s, VariableDeclaration)]
+
+def rewrite(f, fn):
+    """
+    Call fn(expr, scope) on every expression in the body of f, children
+    before parents. If it returns something, that replaces expr. scope
+    changes as the walk goes on, so fn can only test it right away.
+
+    :type f: Function
+    """
+    root = [f.statement]
+    scope = Scope(f.par_list)
+    # (container, key, node, whether its children are done)
+    work = [(root, 0, root[0], False)]
+    while work:
+        container, key, node, done = work.pop()
+        if not done:
+            if isinstance(node, Block):
+                scope.add(declared(node))
+            work.append((container, key, node, True))
+            for c, k in slots(node):
+                work.append((c, k, get_slot(c, k), False))
+        elif isinstance(node, Expression):
+            new = fn(node, scope)
+            if new is not None:
+                set_slot(container, key, new)
+        elif isinstance(node, Block):
+            scope.remove(declared(node))
+    f.statement = root[0]
+
+def nodes(expr):
+    "every node of an expression"
+    work = [expr]
+    while work:
+        node = work.pop()
+        yield node
+        work.extend(get_slot(c, k) for c, k in slots(node))
+
+def global_names(node, scope):
+    "names of globals node refers to directly"
+    if isinstance(node, FunctionCall):
+        if not node.name.startswith('$'):
+            yield node.name
+    elif isinstance(node, Identifier):
+        if node.name not in scope:
+            yield node.name
+    elif isinstance(node, ArrayAccess):
+        if node.array not in scope:
+            yield node.array
+
+class Fault(Exception):
+    "what the program did would kill it with a signal"
+    pass
+
+def wrap(n):
+    "n as a signed 32 bit int"
+    return ((n + 0x80000000) & 0xffffffff) - 0x80000000
+
+def _check_divide(a, b):
+    if b == 0 or (b == -1 and a == -0x80000000):
+        raise Fault('division error')
+
+def div(a, b):
+    "idiv: rounds towards 0"
+    _check_divide(a, b)
+    q = abs(a) // abs(b)
+    return q if (a < 0) == (b < 0) else -q
+
+def mod(a, b):
+    "idiv's remainder, with the sign of a"
+    _check_divide(a, b)
+    r = abs(a) % abs(b)
+    return -r if a < 0 else r
+
+def udiv(a, b):
+    if b == 0:
+        raise Fault('division error')
+    return wrap((a & 0xffffffff) // (b & 0xffffffff))
+
+def umod(a, b):
+    if b == 0:
+        raise Fault('division error')
+    return wrap((a & 0xffffffff) % (b & 0xffffffff))
+
+def _wrap(s):
+    return '((' + s + ' + 2147483648 & 4294967295) - 2147483648)'
+
+# Python for each operator, {0} and {1} being its operands
+BINARY = {
+    '+': _wrap('{0} + {1}'),
+    '-': _wrap('{0} - {1}'),
+    '*': _wrap('{0} * {1}'),
+    '#': _wrap('{0} * {1}'),
+    '/': '_div({0}, {1})',
+    '%': '_mod({0}, {1})',
+    '\\': '_udiv({0}, {1})',
+    '@': '_umod({0}, {1})',
+    '<<': _wrap('({0} << ({1} & 31))'),
+    '>>': '({0} >> ({1} & 31))',
+    '>>>': _wrap('(({0} & 4294967295) >> ({1} & 31))'),
+    '&': '({0} & {1})',
+    '|': '({0} | {1})',
+    '^': '({0} ^ {1})',
+}
+# true or false rather than 1 or 0
+COMPARE = {op: '({0} ' + op + ' {1})' for op in ('==', '!=', '<', '<=', '>', '>=')}
+COMPARE.update({op: '(({0} & 4294967295) ' + op.replace('|', '') + ' ({1} & 4294967295))'
+                for op in ('<|', '<|=', '>|', '>|=')})
+UNARY = {
+    '-': _wrap('-{0}'),
+    '~': '(~{0})',
+    '!': '(0 if {0} else 1)',
+}
+HELPERS = {'_div': div, '_mod': mod, '_udiv': udiv, '_umod': umod}
+
+def _operator(template, n):
+    "template as a function of n operands"
+    names = ('a', 'b')[:n]
+    return eval('lambda ' + ', '.join(names) + ': ' + template.format(*names), HELPERS)
+
+# the operators as functions of ints (comparisons give 1 or 0)
+BINARY_OPERATORS = {op: _operator(t, 2) for op, t in BINARY.items()}
+BINARY_OPERATORS.update({op: _operator('(1 if ' + t + ' else 0)', 2) for op, t in COMPARE.items()})
+UNARY_OPERATORS = {op: _operator(t, 1) for op, t in UNARY.items()}
+
+def fold(op, args):
+    "the value of op applied to the ints args, or None if it faults or isn't arithmetic"
+    f = (UNARY_OPERATORS if len(args) == 1 else BINARY_OPERATORS).get(op)
+    if f is None:
+        return None
+    try:
+        return f(*(wrap(a) for a in args))
+    except Fault:
+        return None
+
+def global_uses(functions):
+    """
+    (used, written): the global names the functions use, and those
+    of them they assign, index or take the address of
+    """
+    used = set()
+    written = set()
+    def fn(node, scope):
+        used.update(global_names(node, scope))
+        target = None
+        if isinstance(node, BinaryExpression) and node.op == '=':
+            target = node.lhs
+        elif isinstance(node, Address):
+            target = node.lvalue
+        if isinstance(target, Identifier) and target.name not in scope:
+            written.add(target.name)
+        elif isinstance(node, ArrayAccess) and node.array not in scope:
+            written.add(node.array)
+    for f in functions:
+        rewrite(f, fn)
+    return used, written
+
+def constant_globals(variables, written):
+    "{name: value} of the scalar GlobalVariables not in written"
+    values = {}
+    for d in variables:
+        if (isinstance(d, GlobalVariable) and d.name not in written and isinstance(d.var_type, PrimitiveType) and
+                isinstance(d.value, Literal) and d.value.type != 'STRING_LIT'):
+            v = d.value.value if d.value.type == 'INT_LIT' else ord(d.value.value)
+            if d.var_type.type == 'char':
+                if v > 255:
+                    # left for the code generator to complain about
+                    continue
+                # loads sign extend
+                v = (v + 128) % 256 - 128
+            values[d.name] = v
+    return values
+
+def substitute(f, values):
+    """
+    Replace reads of the globals in values by their value in f,
+    and operators on constants by the result
+    """
+    def constant(node):
+        return isinstance(node, Literal) and node.type != 'STRING_LIT'
+    def value(node):
+        return node.value if node.type == 'INT_LIT' else ord(node.value)
+    def fn(node, scope):
+        if isinstance(node, Identifier) and node.name in values and node.name not in scope:
+            v = values[node.name]
+        elif isinstance(node, Unary) and constant(node.expr):
+            v = fold(node.op, (value(node.expr),))
+        elif isinstance(node, BinaryExpression) and constant(node.lhs) and constant(node.rhs):
+            v = fold(node.op, (value(node.lhs), value(node.rhs)))
+        else:
+            return None
+        if v is not None:
+            return Literal('INT_LIT', v)
+    rewrite(f, fn)
+
+def constant_arguments(call):
+    "whether the arguments of call are all int or char literals"
+    return all(isinstance(a, Literal) and a.type != 'STRING_LIT' for a in call.args)
+
+def _call_graph(functions, defs):
+    """
+    (calls, impure, constant): the names of the functions each function
+    calls, the functions that use globals or pointers, make syscalls
+    or call what isn't a function in defs, and whether any call to a
+    function in defs has constant arguments
+    """
+    impure = set()
+    calls = {}
+    constant = []
+    for f in functions:
+        callees = calls[f.name] = set()
+        def fn(node, scope, f=f, callees=callees):
+            if (isinstance(node, (Dereference, Address)) or
+                    (isinstance(node, Literal) and node.type == 'STRING_LIT') or
+                    (isinstance(node, Identifier) and node.name not in scope) or
+                    (isinstance(node, ArrayAccess) and node.array not in scope)):
+                impure.add(f.name)
+            elif isinstance(node, FunctionCall):
+                if isinstance(defs.get(node.name), Function):
+                    callees.add(node.name)
+                    if not constant and constant_arguments(node):
+                        constant.append(node)
+                else:
+                    impure.add(f.name)
+        rewrite(f, fn)
+    return calls, impure, bool(constant)
+
+def pure_functions(functions, defs, graph=None):
+    """
+    names of the functions whose result only depends on their
+    arguments: they don't use globals (constant ones are literals by
+    now) or pointers, make syscalls or call anything but each other
+
+    defs are the declarations by name that calls can refer to
+    """
+    calls, impure, _ = graph or _call_graph(functions, defs)
+    pure = set(calls) - impure
+    changed = True
+    while changed:
+        changed = False
+        for name in list(pure):
+            if not calls[name] <= pure:
+                pure.discard(name)
+                changed = True
+    return pure
+
+def evaluate_calls(functions, defs, steps=FOLD_STEPS):
+    """
+    Replace calls in the functions to pure functions with constant
+    arguments by their result, worked out with canadavm's Walker. Each
+    function and arguments is only tried once, and given up on after
+    steps steps or if it faults.
+    """
+    graph = _call_graph(functions, defs)
+    if not graph[2]:
+        return
+    pure = {name for name in pure_functions(functions, defs, graph) if not isinstance(defs[name].type, Void)}
+    if not pure:
+        return
+    program = Program()
+    for name in pure:
+        program.append(defs[name])
+    walker = []
+    results = {}
+    def fn(node, scope):
+        if (not isinstance(node, FunctionCall) or node.name not in pure or
+                len(node.args) != len(defs[node.name].par_list) or not constant_arguments(node)):
+            return None
+        key = (node.name, tuple(wrap(a.value) if a.type == 'INT_LIT' else ord(a.value) for a in node.args))
+        if key not in results:
+            if not walker:
+                import canadavm
+                walker.append(canadavm.Walker(program, canadavm.Machine()))
+            results[key] = walker[0].evaluate(node.name, list(key[1]), steps)
+        if results[key] is not None:
+            return Literal('INT_LIT', results[key])
+    for f in functions:
+        rewrite(f, fn)
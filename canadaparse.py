@@ -1,6 +1,7 @@
 import ply.lex
 import ply.yacc
 
+import functools
 import sys
 
 import canadalex
@@ -23,28 +24,39 @@ precedence = (
 )
 
 class FakeTuple:
-    def __init__(self, elements):
-        if isinstance(elements, FakeTuple):
-            elements = elements._tuple_elements
-        self._tuple_elements = elements
+    """
+    Base class for AST nodes. Fields are stored in __slots__ only;
+    the old ('tag', [children...]) form is built on demand by _tuple()
+    for the dot printer and anything else that indexes nodes.
+    """
+    __slots__ = ()
+    def _tuple(self):
+        raise NotImplementedError()
+    @property
+    def _tuple_elements(self):
+        return self._tuple()
     def __getitem__(self, key):
-        return self._tuple_elements.__getitem__(key)
+        return self._tuple().__getitem__(key)
     def __repr__(self):
-        return type(self).__name__ + ': ' + str(self._tuple_elements)
+        return type(self).__name__ + ': ' + str(self._tuple())
 
 class Program(FakeTuple):
+    __slots__ = ('decls',)
     def __init__(self):
         self.decls = []
-        FakeTuple.__init__(self, ('program', self.decls))
+    def _tuple(self):
+        return ('program', self.decls)
     def append(self, decl):
         self.decls.append(decl)
         return self
     def __repr__(self):
         return '\n'.join(map(repr, self.decls))
 
-class GlobalDeclaration(FakeTuple): pass
+class GlobalDeclaration(FakeTuple):
+    __slots__ = ()
 
 class GlobalVariable(GlobalDeclaration):
+    __slots__ = ('var_type', 'name', 'value')
     def __init__(self, decl, value):
         """
         :type decl: VariableDeclaration
@@ -53,20 +65,23 @@ class GlobalVariable(GlobalDeclaration):
         self.var_type = decl.type
         self.name = decl.name
         self.value = value
-        FakeTuple.__init__(self, ('global_var',
-                           [self.var_type, self.name, value]))
+    def _tuple(self):
+        return ('global_var', [self.var_type, self.name, self.value])
     def __repr__(self):
         return repr(self.var_type) + ' ' + self.name + ' = ' + repr(self.value) + ';'
 
 class VariableType(FakeTuple):
+    __slots__ = ()
     def size(self):
         raise NotImplementedError()
 
 class PrimitiveType(VariableType):
+    __slots__ = ('type',)
     def __init__(self, type):
         ":type type: str"
         self.type = type
-        FakeTuple.__init__(self, ('PRIM_TYPE', [type]))
+    def _tuple(self):
+        return ('PRIM_TYPE', [self.type])
     def __repr__(self):
         return self.type
     def size(self):
@@ -81,12 +96,12 @@ class PrimitiveType(VariableType):
             raise ValueError()
 
 class Void():
-    def __init__(self):
-        FakeTuple.__init__(self, ('VOID', ['void']))
+    __slots__ = ()
     def __repr__(self):
         return 'void'
 
 class ArrayDeclaration(VariableType):
+    __slots__ = ('prim_type', 'length')
     def __init__(self, prim_type, length):
         """
         :type prim_type: str
@@ -94,8 +109,8 @@ class ArrayDeclaration(VariableType):
         """
         self.prim_type = prim_type
         self.length = length
-        FakeTuple.__init__(self, ('array_decl',
-                                 [prim_type, length]))
+    def _tuple(self):
+        return ('array_decl', [self.prim_type, self.length])
     def __repr__(self):
         return self.prim_type + '[' + (str(self.length) if self.length else '') + ']'
     def size(self):
@@ -105,22 +120,25 @@ class ArrayDeclaration(VariableType):
         return r
 
 class ArrayLiteral(FakeTuple):
+    __slots__ = ('elements',)
     def __init__(self, elements):
         """
         :type elements: list
         """
         self.elements = elements
-        FakeTuple.__init__(self, ('array_lit', self.elements))
+    def _tuple(self):
+        return ('array_lit', self.elements)
     def __repr__(self):
         return '{' + ', '.join(map(repr, self.elements)) + '}'
 
 class Function(FakeTuple):
+    __slots__ = ('type', 'name', 'par_list', 'statement')
     def __init__(self, name_or_vardecl, header_and_body, par_list = None, statement = None):
         """
         :type name_or_vardecl: str or VariableDeclaration
         :type header_and_body: tuple
         """
-        if par_list:
+        if par_list is not None:
             self.type = name_or_vardecl
             self.name = header_and_body
             self.par_list = par_list
@@ -133,7 +151,8 @@ class Function(FakeTuple):
                 self.type = Void()
                 self.name = name_or_vardecl
             self.par_list, self.statement = header_and_body
-        FakeTuple.__init__(self, ('function', [self.type, self.name, ('par_list', self.par_list), self.statement]))
+    def _tuple(self):
+        return ('function', [self.type, self.name, ('par_list', self.par_list), self.statement])
     def __repr__(self):
         return repr(self.type) + ' ' + self.name + '(' + ', '.join(self.parameters()) + ') ' + repr(self.statement)
     def parameters(self):
@@ -141,55 +160,98 @@ class Function(FakeTuple):
     def prototype(self):
         return repr(self.type) + ' ' + self.name + '(' + ', '.join(self.parameters()) + ')'
 
-class BlockStatement(FakeTuple): pass
-class Statement(BlockStatement): pass
+class BlockStatement(FakeTuple):
+    __slots__ = ()
+class Statement(BlockStatement):
+    __slots__ = ()
 
 class EmptyStatement(Statement):
-    def __init__(self):
-        FakeTuple.__init__(self, None)
+    __slots__ = ()
+    def _tuple(self):
+        return None
     def __repr__(self):
         return ';'
 
 class IfStatement(Statement):
+    __slots__ = ('condition', 'statement', 'else_clause')
     def __init__(self, cond, stmt, else_c = None):
         self.condition = cond
         self.statement = stmt
         self.else_clause = else_c
-        FakeTuple.__init__(self, ('if_stmt', [cond, stmt] + ([else_c] if else_c else [])))
+    def _tuple(self):
+        return ('if_stmt', [self.condition, self.statement] + ([self.else_clause] if self.else_clause else []))
     def __repr__(self):
         return 'if (' + repr(self.condition) + ') ' + repr(self.statement) + (' else ' + repr(self.else_clause) if self.else_clause else '')
 
 class WhileLoop(Statement):
+    __slots__ = ('condition', 'statement')
     def __init__(self, cond, stmt):
         self.condition = cond
         self.statement = stmt
-        FakeTuple.__init__(self, ('if_stmt', [cond, stmt]))
+    def _tuple(self):
+        return ('if_stmt', [self.condition, self.statement])
     def __repr__(self):
         return 'while (' + repr(self.condition) + ') ' + repr(self.statement)
 
+class SwitchStatement(Statement):
+    __slots__ = ('expr', 'cases')
+    def __init__(self, expr, cases):
+        """
+        :type expr: Expression
+        :type cases: list
+        """
+        self.expr = expr
+        self.cases = cases
+    def _tuple(self):
+        return ('switch', [self.expr] + self.cases)
+    def __repr__(self):
+        return 'switch (' + repr(self.expr) + ') {\n' + '\n'.join(map(repr, self.cases)) + '\n}'
+
+class Case(FakeTuple):
+    "a case label (or default if value is None) and the statements after it"
+    __slots__ = ('value', 'statements')
+    def __init__(self, value, statements):
+        """
+        :type value: Literal
+        :type statements: list
+        """
+        self.value = value
+        self.statements = statements
+    def _tuple(self):
+        if self.value is None:
+            return ('default', self.statements)
+        return ('case', [self.value] + self.statements)
+    def __repr__(self):
+        return ('default:' if self.value is None else 'case ' + repr(self.value) + ':') + ''.join('\n' + _indent(s) for s in self.statements)
+
 class BreakStatement(Statement):
-    def __init__(self):
-        FakeTuple.__init__(self, ('break_stmt', []))
+    __slots__ = ()
+    def _tuple(self):
+        return ('break_stmt', [])
     def __repr__(self):
         return 'break;'
 class ContinueStatement(Statement):
-    def __init__(self):
-        FakeTuple.__init__(self, ('continue_stmt', []))
+    __slots__ = ()
+    def _tuple(self):
+        return ('continue_stmt', [])
     def __repr__(self):
         return 'continue;'
 class ReturnStatement(Statement):
+    __slots__ = ('expr',)
     def __init__(self, expr = None):
         """
         :type expr: Expression
         :type array: bool
         """
         self.expr = expr
-        FakeTuple.__init__(self, ('return', [expr] if expr else []))
+    def _tuple(self):
+        return ('return', [self.expr] if self.expr else [])
     def __repr__(self):
         if not self.expr: return 'return;'
         return 'return ' + repr(self.expr) + ';'
 
 class VariableDeclaration(BlockStatement):
+    __slots__ = ('type', 'name')
     def __init__(self, type, name):
         """
         :type type: VariableType
@@ -197,7 +259,8 @@ class VariableDeclaration(BlockStatement):
         """
         self.type = type
         self.name = name
-        FakeTuple.__init__(self, ('var_decl', [type, name]))
+    def _tuple(self):
+        return ('var_decl', [self.type, self.name])
     def __repr__(self):
         return repr(self.type) + ' ' + self.name
 
@@ -210,27 +273,33 @@ def _indent(s):
     return '\n'.join('    ' + l for l in s.splitlines())
 
 class Block(Statement):
+    __slots__ = ('statements',)
     def __init__(self, statements):
         """
         :type statements: list
         """
         self.statements = statements
-        FakeTuple.__init__(self, ('block', statements))
+    def _tuple(self):
+        return ('block', self.statements)
     def __repr__(self):
         return '{\n' + '\n'.join(map(_indent, self.statements)) + '\n}'
 
-class Expression(FakeTuple): pass
+class Expression(FakeTuple):
+    __slots__ = ()
 class ExpressionStatement(Statement):
+    __slots__ = ('expr',)
     def __init__(self, expr):
         """
         :type expr: Expression
         """
         self.expr = expr
-        FakeTuple.__init__(self, expr)
+    def _tuple(self):
+        return self.expr._tuple()
     def __repr__(self):
         return repr(self.expr) + ';'
 
 class Unary(Expression):
+    __slots__ = ('op', 'expr')
     def __init__(self, op, expr):
         """
         :type op: str
@@ -238,11 +307,13 @@ class Unary(Expression):
         """
         self.op = op
         self.expr = expr
-        FakeTuple.__init__(self, ('unary', [op, expr]))
+    def _tuple(self):
+        return ('unary', [self.op, self.expr])
     def __repr__(self):
         return self.op + '(' + repr(self.expr) + ')'
 
 class Literal(Expression):
+    __slots__ = ('type', 'value')
     def __init__(self, type, value):
         """
         :type type: str
@@ -250,7 +321,8 @@ class Literal(Expression):
         """
         self.type = type
         self.value = value
-        FakeTuple.__init__(self, (type, [value]))
+    def _tuple(self):
+        return (self.type, [self.value])
     def __repr__(self):
         if self.type == 'INT_LIT':
             return str(self.value)
@@ -260,6 +332,7 @@ class Literal(Expression):
             return '"' + self.value + '"'
 
 class BinaryExpression(Expression):
+    __slots__ = ('op', 'lhs', 'rhs')
     def __init__(self, op, lhs, rhs):
         """
         :type op: str
@@ -269,11 +342,13 @@ class BinaryExpression(Expression):
         self.op = op
         self.lhs = lhs
         self.rhs = rhs
-        FakeTuple.__init__(self, ('bin_expr', [op, lhs, rhs]))
+    def _tuple(self):
+        return ('bin_expr', [self.op, self.lhs, self.rhs])
     def __repr__(self):
         return ('(' + repr(self.lhs) + ') ' if self.op != '=' else repr(self.lhs) + ' ') + self.op + ' (' + repr(self.rhs) + ')'
 
 class FunctionCall(Expression):
+    __slots__ = ('name', 'args')
     def __init__(self, name, args):
         """
         :type name: str
@@ -281,24 +356,30 @@ class FunctionCall(Expression):
         """
         self.name = name
         self.args = args
-        FakeTuple.__init__(self, ('function_call', [name, ('arg_list', args)]))
+    def _tuple(self):
+        return ('function_call', [self.name, ('arg_list', self.args)])
     def __repr__(self):
         return self.name + '(' + ', '.join(map(repr, self.args)) + ')'
 
-class LValue(Expression): pass
-class SimpleLValue(LValue): pass
+class LValue(Expression):
+    __slots__ = ()
+class SimpleLValue(LValue):
+    __slots__ = ()
 
 class Identifier(SimpleLValue):
+    __slots__ = ('name',)
     def __init__(self, name):
         """
         :type name: str
         """
         self.name = name
-        FakeTuple.__init__(self, ('IDENT', [name]))
+    def _tuple(self):
+        return ('IDENT', [self.name])
     def __repr__(self):
         return self.name
 
 class Dereference(LValue):
+    __slots__ = ('expr', 'char')
     def __init__(self, expr, char = False):
         """
         :type expr: Expression
@@ -306,21 +387,25 @@ class Dereference(LValue):
         """
         self.expr = expr
         self.char = char
-        FakeTuple.__init__(self, ('deref', ['#' if char else '*', expr]))
+    def _tuple(self):
+        return ('deref', ['#' if self.char else '*', self.expr])
     def __repr__(self):
         return ('#' if self.char else '*') + '(' + repr(self.expr) + ')'
 
 class Address(Expression):
+    __slots__ = ('lvalue',)
     def __init__(self, lvalue):
         """
         :type lvalue: SimpleLValue
         """
         self.lvalue = lvalue
-        FakeTuple.__init__(self, ('address', [lvalue]))
+    def _tuple(self):
+        return ('address', [self.lvalue])
     def __repr__(self):
         return '&' + repr(self.lvalue)
 
 class ArrayAccess(SimpleLValue):
+    __slots__ = ('array', 'index')
     def __init__(self, array, index):
         """
         :type array: str
@@ -328,11 +413,47 @@ class ArrayAccess(SimpleLValue):
         """
         self.array = array
         self.index = index
-        FakeTuple.__init__(self, ('array_acc', [array, index]))
+    def _tuple(self):
+        return ('array_acc', [self.array, self.index])
     def __repr__(self):
         return self.array + '[' + repr(self.index) + ']'
 
+def expr_text(expr):
+    "repr(expr), built with a work stack so any depth of nesting works"
+    out = []
+    work = [expr]
+    while work:
+        node = work.pop()
+        if isinstance(node, str):
+            out.append(node)
+            continue
+        if isinstance(node, Unary):
+            parts = [node.op + '(', node.expr, ')']
+        elif isinstance(node, BinaryExpression):
+            if node.op == '=':
+                parts = [node.lhs, ' = (', node.rhs, ')']
+            else:
+                parts = ['(', node.lhs, ') ' + node.op + ' (', node.rhs, ')']
+        elif isinstance(node, FunctionCall):
+            parts = [node.name + '(']
+            for i, arg in enumerate(node.args):
+                if i:
+                    parts.append(', ')
+                parts.append(arg)
+            parts.append(')')
+        elif isinstance(node, Dereference):
+            parts = [('#' if node.char else '*') + '(', node.expr, ')']
+        elif isinstance(node, Address):
+            parts = ['&', node.lvalue]
+        elif isinstance(node, ArrayAccess):
+            parts = [node.array + '[', node.index, ']']
+        else:
+            parts = [repr(node)]
+        work.extend(reversed(parts))
+    return ''.join(out)
+
 class Export(GlobalDeclaration):
+    __slots__ = ('name', 'function')
     def __init__(self, name, function = False):
         """
         :type name: str
@@ -340,11 +461,13 @@ class Export(GlobalDeclaration):
         """
         self.name = name
         self.function = function
-        FakeTuple.__init__(self, ('export_func' if function else 'export', [name]))
+    def _tuple(self):
+        return ('export_func' if self.function else 'export', [self.name])
     def __repr__(self):
         return 'export ' + self.name + ('();' if self.function else ';')
 
 class Extern(GlobalDeclaration):
+    __slots__ = ('name', 'type', 'par_list', 'is_var', 'varargs', 'c')
     def __init__(self, decl, c = None):
         """
         :type decl: VariableDeclaration or (VariableDeclaration or str, tuple)
@@ -366,9 +489,10 @@ class Extern(GlobalDeclaration):
                 self.type = Void()
             self.varargs, self.par_list = decl[1]
         self.c = c
-        FakeTuple.__init__(self, ('extern' + ('_c' if self.c else '') + ('_var' if self.is_var else ''), [self.type, self.name] if self.is_var else [self.type, self.name, self.par_list]))
+    def _tuple(self):
+        return ('extern' + ('_c' if self.c else '') + ('_var' if self.is_var else ''), [self.type, self.name] if self.is_var else [self.type, self.name, self.par_list])
     def __repr__(self):
-        return 'extern ' + ('"C" ' if self.c else '') + repr(self.type) + ' ' + self.name + ('(' + ', '.join(map(repr, self.par_list + ([Ellipsis] if self.varargs else []))) + ')' if not self.is_var else '') + ';'
+        return 'extern ' + ('"C" ' if self.c else '') + repr(self.type) + ' ' + self.name + ('(' + ', '.join(self.par_list + (['...'] if self.varargs else [])) + ')' if not self.is_var else '') + ';'
 
 # return ('program', [*global_decl...])
 def p_program(p):
@@ -445,7 +569,8 @@ def p_array_list(p):
     if len(p) <= 2:
         p[0] = p[1:]
     else:
-        p[0] = p[1] + [p[3]]
+        p[1].append(p[3])
+        p[0] = p[1]
 
 # return ('function', [('VOID', [VOID]) or var_type, IDENT, par_list, statement])
 def p_function(p):
@@ -472,7 +597,8 @@ def p_par_list(p):
     if len(p) <= 2:
         p[0] = p[1:]
     else:
-        p[0] = p[1] + p[3:]
+        p[1].append(p[3])
+        p[0] = p[1]
 
 # return ('var_decl', [var_type, IDENT])
 def p_var_decl(p):
@@ -494,6 +620,7 @@ def p_simple_stmt(p):
     '''
     simple_stmt : if_stmt
                 | while_loop
+                | switch_stmt
                 | break_stmt
                 | continue_stmt
                 | return_stmt
@@ -519,6 +646,50 @@ def p_while_loop(p):
     '''
     p[0] = WhileLoop(p[2], p[3])
 
+def p_switch_stmt(p):
+    '''
+    switch_stmt : SWITCH condition '{' case_list '}'
+    '''
+    p[0] = SwitchStatement(p[2], p[4])
+
+# returns [Case...]
+def p_case_list(p):
+    '''
+    case_list : case_list case
+              |
+    '''
+    if len(p) == 1:
+        p[0] = []
+    else:
+        p[1].append(p[2])
+        p[0] = p[1]
+
+def p_case(p):
+    '''
+    case : CASE INT_LIT ':' stmt_list
+         | CASE '-' INT_LIT ':' stmt_list
+         | CASE CHAR_LIT ':' stmt_list
+         | DEFAULT ':' stmt_list
+    '''
+    if len(p) == 4:
+        p[0] = Case(None, p[3])
+    elif len(p) == 6:
+        p[0] = Case(Literal('INT_LIT', -p[3]), p[5])
+    else:
+        p[0] = Case(Literal(p.slice[2].type, p[2]), p[4])
+
+# returns [statement...]
+def p_stmt_list(p):
+    '''
+    stmt_list : stmt_list statement
+              |
+    '''
+    if len(p) == 1:
+        p[0] = []
+    else:
+        p[1].append(p[2])
+        p[0] = p[1]
+
 # forwards expr
 def p_condition(p):
     '''
@@ -575,7 +746,8 @@ def p_block_stmt_list(p):
     if len(p) == 1:
         p[0] = []
     else:
-        p[0] = p[1] + p[2:]
+        p[1].append(p[2])
+        p[0] = p[1]
 
 # forwards
 def p_block_stmt(p):
@@ -652,7 +824,8 @@ def p_arg_list(p):
     if len(p) <= 2:
         p[0] = p[1:]
     else:
-        p[0] = p[1] + [p[3]]
+        p[1].append(p[3])
+        p[0] = p[1]
 
 # forwards or returns ('IDENT', [IDENT])
 def p_lvalue(p):
@@ -742,38 +915,22 @@ def p_error(p):
 lexer = canadalex.lexer
 parser = ply.yacc.yacc()
 
-def parse(code):
+def tokenize(code):
+    "the tokens of code, as parse reads them"
+    lexer.input(code)
+    return list(iter(lexer.token, None))
+
+def parse(code, tokens=None):
+    "tokens, if given, are tokenize(code) and are parsed instead of lexing again"
+    if tokens is not None:
+        return parser.parse(lexer=lexer, tokenfunc=functools.partial(next, iter(tokens), None))
     return parser.parse(code, lexer=lexer)
 
 if __name__ == '__main__':
-    import fileinput
     import sys
-    import os
-    code = ''.join(fileinput.input())
-    result = parse(code)
-    # print(result)
-    # print graphviz
-    # lazy, so redirect stdout
     if len(sys.argv) >= 2:
-        sys.stdout = open(os.path.splitext(sys.argv[1])[0] + '.dot', 'w')
-        print("digraph parse_tree {")
-        print("    node [shape = box];")
-        node_c = 0
-        def node(*args):
-            global node_c
-            node_c += 1
-            return "node" + str(node_c)
-        def walk(n, i):
-            if not isinstance(n, tuple) and not (isinstance(n, FakeTuple) and n._tuple_elements):
-                print("    " + i + " [label = \"" + str(n).replace('\\', '\\\\') + "\", shape = \"diamond\"]")
-                return
-            print("    " + i + " [label = \"" + n[0] + "\"]")
-            nodes = list(map(node, n[1]))
-            for nn in nodes:
-                print("    " + i + " -> " + nn)
-            for j, nn in enumerate(n[1]):
-                walk(nn, nodes[j])
-        walk(result, "node0")
-        print("}")
+        # canadadot imports this module again, so let it do the parsing
+        import canadadot
+        canadadot.main(sys.argv[1:])
     else:
-        print(repr(result))
+        print(repr(parse(sys.stdin.read())))
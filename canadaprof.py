@@ -0,0 +1,90 @@
+"""
+Reports the counts a program compiled with --profile writes to
+canada.prof when main returns.
+
+Layout, little endian:
+    header   u32 number of sites
+    counts   u32 per site
+    sites    a line per site: function, kind and source, tab separated
+
+A site is a function (counted per call), a while loop (per iteration
+of its body), or an arm of an if, else, switch case or default (per
+time it is taken). The source is the prototype of a function and the
+condition of the others, as canadaparse prints it.
+"""
+import struct
+
+class ProfileError(Exception):
+    pass
+
+def read(fn):
+    """
+    returns [(function, kind, source, count)...] in the order the sites
+    are in the program
+    """
+    with open(fn, 'rb') as f:
+        data = f.read()
+    if len(data) < 4:
+        raise ProfileError(fn + ': not a profile')
+    n, = struct.unpack_from('<I', data)
+    if len(data) < 4 + 4 * n:
+        raise ProfileError(fn + ': truncated')
+    counts = struct.unpack_from('<%dI' % n, data, 4)
+    lines = data[4 + 4 * n:].decode(errors='replace').split('\n')
+    if len(lines) != n + 1 or lines[-1]:
+        raise ProfileError(fn + ': bad site names')
+    sites = []
+    for line, count in zip(lines, counts):
+        function, kind, source = line.split('\t')
+        sites.append((function, kind, source, count))
+    return sites
+
+def merge(profiles):
+    "adds up the counts of several runs of the same program"
+    total = list(profiles[0])
+    for sites in profiles[1:]:
+        if [s[:3] for s in sites] != [s[:3] for s in total]:
+            raise ProfileError('profiles are of different programs')
+        total = [s[:3] + (s[3] + t[3],) for s, t in zip(sites, total)]
+    return total
+
+def report(sites, out, top=None):
+    """
+    Writes the functions, most called first, each followed by its
+    loops and arms in source order
+    """
+    functions = {}
+    for site in sites:
+        functions.setdefault(site[0], []).append(site)
+    def calls(f):
+        return sum(s[3] for s in functions[f] if s[1] == 'function')
+    order = sorted(functions, key=lambda f: -calls(f))
+    if top is not None:
+        order = order[:top]
+    width = max([len(str(s[3])) for s in sites] + [5])
+    for f in order:
+        for _, kind, source, count in functions[f]:
+            if kind == 'function':
+                line = source
+            elif kind == 'case':
+                line = '    ' + ('default:' if source == 'default' else 'case ' + source + ':')
+            elif kind == 'else':
+                line = '    else' + (' // if (' + source + ')' if source else '')
+            else:
+                line = '    ' + kind + ' (' + source + ')'
+            out.write(str(count).rjust(width) + '  ' + line + '\n')
+
+if __name__ == '__main__':
+    import sys
+    import argparse
+    ap = argparse.ArgumentParser(description='Show the counts of a program compiled with --profile')
+    ap.add_argument('files', nargs='*', default=['canada.prof'],
+                    help='profiles to add up (default: canada.prof)')
+    ap.add_argument('--top', type=int, help='only show the N most called functions')
+    args = ap.parse_args()
+    try:
+        sites = merge([read(fn) for fn in args.files])
+    except (OSError, ProfileError) as err:
+        sys.stdout.write("ERROR: " + str(err) + '\n')
+        sys.exit(1)
+    report(sites, sys.stdout, args.top)
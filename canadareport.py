@@ -0,0 +1,181 @@
+"""
+Static counts of the code generated for each function, and for each
+while loop in it (inner loops count towards the outer ones too):
+
+    instructions, pushes, pops
+    loads, stores   instructions reading or writing memory other than
+                    with push and pop (one that does both counts twice)
+    branches        jumps, conditional or not
+    calls           to functions, not syscalls
+    divides         div and idiv
+    syscalls        int 80h, syscall or call [?vsyscall]
+    frame           bytes of locals (functions only)
+
+canadacodegen.py --asm-report writes them to a .asm.json file per
+source. This shows one, or the differences between two:
+
+    python3 canadareport.py print.asm.json
+    python3 canadareport.py before.asm.json after.asm.json
+"""
+import json
+
+COUNTERS = ('instructions', 'pushes', 'pops', 'loads', 'stores', 'branches', 'calls', 'divides', 'syscalls')
+
+def classify(inst, code):
+    "the counters one instruction adds to, as {counter: n}"
+    code = code or ''
+    dst, _, src = code.partition(',')
+    counts = {'instructions': 1}
+    def add(counter):
+        counts[counter] = counts.get(counter, 0) + 1
+    if inst == 'push':
+        add('pushes')
+        if '[' in code:
+            add('loads')
+    elif inst == 'pop':
+        add('pops')
+        if '[' in code:
+            add('stores')
+    elif inst in ('rep', 'repe', 'repne'):
+        if not code.startswith('stos'):
+            add('loads')
+        if not code.startswith('cmps'):
+            add('stores')
+    elif inst == 'syscall' or (inst == 'int' and code == '80h'):
+        add('syscalls')
+    elif inst == 'call':
+        if code == '[?vsyscall]':
+            add('syscalls')
+        else:
+            add('calls')
+            if '[' in code:
+                add('loads')
+    elif inst.startswith('j'):
+        add('branches')
+        if '[' in code:
+            add('loads')
+    elif inst == 'lea':
+        pass
+    elif inst in ('mov', 'movzx', 'movsx'):
+        if '[' in dst:
+            add('stores')
+        if '[' in src:
+            add('loads')
+    elif inst in ('cmp', 'test'):
+        if '[' in code:
+            add('loads')
+    else:
+        if inst in ('div', 'idiv'):
+            add('divides')
+        # read, modify and write
+        if '[' in dst:
+            add('loads')
+            if inst not in ('div', 'idiv', 'mul', 'imul') or src:
+                add('stores')
+        if '[' in src:
+            add('loads')
+    return counts
+
+class Report:
+    """
+    Collects the counts while a CodeGenerator writes code. The
+    generator calls function and loop when it starts one, leave when
+    it is done with it, frame for each block's locals and instruction
+    for everything it writes.
+    """
+    def __init__(self, fn=None):
+        self.fn = fn
+        self.functions = [] # {name, frame, counts, loops: [{name, source, depth, counts}]}
+        self.active = [] # counts being added to, outermost first
+    def function(self, name):
+        f = {'name': name, 'frame': 0, 'counts': dict.fromkeys(COUNTERS, 0), 'loops': []}
+        self.functions.append(f)
+        self.active = [f['counts']]
+    def loop(self, source):
+        f = self.functions[-1]
+        name = source
+        same = sum(1 for l in f['loops'] if l['source'] == source)
+        if same:
+            name += ' #' + str(same + 1)
+        l = {'name': name, 'source': source, 'depth': len(self.active), 'counts': dict.fromkeys(COUNTERS, 0)}
+        f['loops'].append(l)
+        self.active.append(l['counts'])
+    def leave(self):
+        self.active.pop()
+    def frame(self, size):
+        if self.functions:
+            f = self.functions[-1]
+            f['frame'] = max(f['frame'], size)
+    def instruction(self, inst, code):
+        if not self.active:
+            return
+        for counter, n in classify(inst, code).items():
+            for counts in self.active:
+                counts[counter] += n
+    def to_dict(self):
+        return {'file': self.fn, 'functions': self.functions}
+
+def load(fn):
+    with open(fn) as f:
+        return json.load(f)
+
+def rows(report):
+    "[(function, loop or None, depth, counts)] of a loaded report"
+    out = []
+    for f in report['functions']:
+        out.append((f['name'], None, 0, dict(f['counts'], frame=f['frame'])))
+        for l in f['loops']:
+            out.append((f['name'], l['name'], l['depth'], l['counts']))
+    return out
+
+COLUMNS = COUNTERS + ('frame',)
+HEADINGS = ('instrs', 'push', 'pop', 'load', 'store', 'branch', 'call', 'div', 'sys', 'frame')
+
+def _line(name, cells):
+    if len(name) > 40:
+        name = name[:37] + '...'
+    return '%-40s' % name + ''.join('%8s' % c for c in cells) + '\n'
+
+def format_report(report, out):
+    out.write(_line('', HEADINGS))
+    for function, loop, depth, counts in rows(report):
+        name = function if loop is None else '  ' * depth + loop
+        out.write(_line(name, [counts.get(c, '') for c in COLUMNS]))
+
+def diff(old, new, out):
+    """
+    Writes the functions and loops whose counts changed, with the
+    change, and those only in one of the reports
+    """
+    before = {(f, l): c for f, l, _, c in rows(old)}
+    out.write(_line('', HEADINGS))
+    seen = set()
+    for function, loop, depth, counts in rows(new):
+        key = (function, loop)
+        seen.add(key)
+        name = function if loop is None else '  ' * depth + loop
+        if key not in before:
+            out.write(_line('+ ' + name, [counts.get(c, '') for c in COLUMNS]))
+            continue
+        old_counts = before[key]
+        changes = [counts.get(c, 0) - old_counts.get(c, 0) if c in counts else '' for c in COLUMNS]
+        if any(changes):
+            out.write(_line(name, ['%+d' % d if d else '' for d in changes]))
+    for function, loop, depth, counts in rows(old):
+        if (function, loop) not in seen:
+            name = function if loop is None else '  ' * depth + loop
+            out.write(_line('- ' + name, [counts.get(c, '') for c in COLUMNS]))
+
+if __name__ == '__main__':
+    import sys
+    import argparse
+    ap = argparse.ArgumentParser(description='Show an --asm-report file, or what changed between two')
+    ap.add_argument('files', nargs='+', help='a report, or the old and new ones')
+    args = ap.parse_args()
+    if len(args.files) > 2:
+        ap.error('at most two reports')
+    reports = [load(fn) for fn in args.files]
+    if len(reports) == 1:
+        format_report(reports[0], sys.stdout)
+    else:
+        diff(reports[0], reports[1], sys.stdout)
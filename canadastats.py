@@ -0,0 +1,94 @@
+"""
+Where compile time goes: canadacodegen.generate(fn, stats=Stats())
+times each phase (and measures what it allocates, with tracemalloc)
+and counts what went through it. report() is a dict ready for JSON:
+
+    file              the source
+    phases            name: {seconds, allocated, peak} in the order
+                      they ran: read, lex, parse, then the code
+                      generator's classify, constants, exports,
+                      externs, text and data, and write (the output
+                      file, and encoding it for --elf). allocated is
+                      what the phase left allocated and peak the most
+                      it had at once, in bytes; both are missing
+                      without trace_memory
+    tokens            number of tokens
+    ast_nodes         declarations, statements and expressions
+    instructions      number emitted, and per function in functions
+    string_literals   number of different ones put in .rodata
+    string_bytes_saved
+                      bytes of string literals not in .rodata because
+                      they are the same as, or the end of, another one
+
+canadacodegen.py --stats prints one report per file, a line of JSON
+each.
+"""
+import contextlib
+import time
+import tracemalloc
+
+class Stats:
+    def __init__(self, fn=None, trace_memory=True):
+        """
+        :type fn: str
+        """
+        self.fn = fn
+        self.trace_memory = trace_memory
+        self.phases = {}
+        self.tokens = 0
+        self.ast_nodes = 0
+        self.functions = {} # name -> instructions
+        self.string_literals = 0
+        self.string_bytes_saved = 0
+    @contextlib.contextmanager
+    def phase(self, name):
+        "times (and traces) the code in the with block as phase name"
+        tracing = self.trace_memory and not tracemalloc.is_tracing()
+        if tracing:
+            tracemalloc.start()
+        if self.trace_memory:
+            tracemalloc.reset_peak()
+            before = tracemalloc.get_traced_memory()[0]
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            p = self.phases.setdefault(name, {'seconds': 0.0})
+            p['seconds'] += time.perf_counter() - start
+            if self.trace_memory:
+                current, peak = tracemalloc.get_traced_memory()
+                p['allocated'] = p.get('allocated', 0) + current - before
+                p['peak'] = max(p.get('peak', 0), peak - before)
+            if tracing:
+                tracemalloc.stop()
+    def count_ast(self, ast):
+        ":type ast: Program"
+        import canadaopt
+        from canadaparse import Function
+        n = 0
+        for d in ast.decls:
+            n += 1
+            if isinstance(d, Function):
+                n += sum(1 for _ in canadaopt.nodes(d.statement))
+        self.ast_nodes = n
+    def report(self):
+        return {
+            'file': self.fn,
+            'phases': self.phases,
+            'tokens': self.tokens,
+            'ast_nodes': self.ast_nodes,
+            'instructions': sum(self.functions.values()),
+            'functions': self.functions,
+            'string_literals': self.string_literals,
+            'string_bytes_saved': self.string_bytes_saved,
+        }
+
+@contextlib.contextmanager
+def _nothing():
+    yield
+
+def phase(stats, name):
+    "stats.phase(name), or nothing if stats is None"
+    if stats is None:
+        return _nothing()
+    return stats.phase(name)
@@ -0,0 +1,990 @@
+"""
+Runs Canada programs in Python, without nasm or a linker:
+
+    python3 canadavm.py bench/fib.ca print.ca
+    python3 canadavm.py cat.ca io.ca -- arguments for main < input
+
+The files are linked with canadalink (not optimized) and checked by the
+code generator, so the VM runs what the compiler would accept. Then each
+function becomes a Python function: expressions become Python
+expressions, if and while become Python if and while, and a switch or
+anything nested deeper than MAX_NESTING becomes a closure inside it.
+Scalars whose address isn't taken are Python variables; arrays and the
+rest live in the program's memory. --source shows the Python.
+
+Walker is the naive interpreter to measure that against: it evaluates
+the tree directly, with every variable in memory. --bench runs a program
+both ways, checks they print the same and reports how many expressions
+and statements each evaluates per minute.
+
+What the x86 code does, the VM does: ints wrap at 32 bits, char loads
+(and #) sign extend, / and % truncate and fault on 0 (\\ and @ are the
+unsigned ones), shifts count mod 32, and arguments are evaluated right
+to left. Memory is one bytearray: a null page, the globals and string
+literals, a STACK_SIZE stack, argv, then what $brk and $mmap add.
+Addresses past the end fault; below the null page nothing is protected.
+Syscalls are linux's, against in-memory files: fds 0, 1 and 2 are the
+stdin, stdout and stderr given to Machine, and $open opens (or with
+O_CREAT makes) a file in Machine.files. Extern "C" functions can't be
+called.
+"""
+import contextlib
+import io
+import os
+import re
+import struct
+import sys
+import time
+
+import canadalink
+from canadacodegen import CodeGenerator, CompilationError, builtins
+from canadaopt import Fault, wrap, BINARY, COMPARE, UNARY, HELPERS, BINARY_OPERATORS, UNARY_OPERATORS
+from canadaparse import PrimitiveType, ArrayDeclaration, ArrayLiteral, GlobalVariable, Function, Statement, IfStatement, WhileLoop, SwitchStatement, BreakStatement, ContinueStatement, ReturnStatement, VariableDeclaration, Block, EmptyStatement, ExpressionStatement, Literal, BinaryExpression, FunctionCall, LValue, Identifier, Dereference, Address, ArrayAccess, Unary
+
+NULL_PAGE = 4096
+PAGE = 4096
+STACK_SIZE = 8 << 20
+MAX_MEMORY = 1 << 30
+# how deep statements and expressions nest in one Python function
+MAX_NESTING = 16
+MAX_EXPRESSION = 24
+# Python frames, for compiling deeply nested code and running deep recursion
+RECURSION_LIMIT = 100000
+
+# the linux flags and errnos the syscalls use
+O_ACCMODE = 3
+O_WRONLY = 1
+O_RDWR = 2
+O_CREAT = 0o100
+O_TRUNC = 0o1000
+O_APPEND = 0o2000
+MAP_ANONYMOUS = 0x20
+ENOENT = 2
+EBADF = 9
+ENOMEM = 12
+EFAULT = 14
+ENODEV = 19
+EINVAL = 22
+
+# what a statement run by a closure (or Walker) can end with
+BREAK = 1
+CONTINUE = 2
+RETURN = 3
+
+INT = struct.Struct('<i')
+
+class VMError(Fault):
+    "the program did what would kill it with a signal"
+    pass
+
+class Exit(Exception):
+    def __init__(self, status):
+        super().__init__(status)
+        self.status = status
+
+# the same, unwrapped
+MODULAR = {
+    '+': '({0} + {1})',
+    '-': '({0} - {1})',
+    '*': '({0} * {1})',
+    '#': '({0} * {1})',
+    '<<': '({0} << ({1} & 31))',
+}
+SEXT8 = '(({0} & 255 ^ 128) - 128)'
+LOAD_CHAR = '((_m[{0}] ^ 128) - 128)'
+LOAD_INT = '_I(_m, {0})[0]'
+
+ESCAPES = {'n': 10, 't': 9, 'r': 13, '0': 0, 'a': 7, 'b': 8, 'f': 12, 'v': 11, 'e': 27}
+
+def unescape(s):
+    "the bytes of a string literal, escapes as nasm reads them in backquotes"
+    out = bytearray()
+    i = 0
+    while i < len(s):
+        c = s[i]
+        if c == '\\' and i + 1 < len(s):
+            i += 1
+            c = s[i]
+            out.append(ESCAPES.get(c, ord(c) & 0xff))
+        else:
+            out.append(ord(c) & 0xff)
+        i += 1
+    return bytes(out)
+
+@contextlib.contextmanager
+def _deep():
+    "with room for RECURSION_LIMIT Python frames"
+    limit = sys.getrecursionlimit()
+    sys.setrecursionlimit(max(limit, RECURSION_LIMIT))
+    try:
+        yield
+    finally:
+        sys.setrecursionlimit(limit)
+
+def _align(n, a):
+    return (n + a - 1) & ~(a - 1)
+
+def _prim(t):
+    "int or char, for a variable's type"
+    return t.type if isinstance(t, PrimitiveType) else t.prim_type
+
+class File:
+    "an open in-memory file; its bytes are shared with every other open of it"
+    def __init__(self, data, readable=True, writable=True, append=False):
+        self.data = data
+        self.readable = readable
+        self.writable = writable
+        self.append = append
+        self.pos = 0
+    def read1(self, n):
+        if not self.readable:
+            raise io.UnsupportedOperation()
+        out = bytes(self.data[self.pos:self.pos + n])
+        self.pos += len(out)
+        return out
+    def write(self, b):
+        if not self.writable:
+            raise io.UnsupportedOperation()
+        if self.append:
+            self.pos = len(self.data)
+        if self.pos > len(self.data):
+            self.data.extend(bytes(self.pos - len(self.data)))
+        self.data[self.pos:self.pos + len(b)] = b
+        self.pos += len(b)
+        return len(b)
+
+class Machine:
+    """
+    The memory and the syscalls of a program. stdin, stdout and stderr
+    are binary files (BytesIO by default), files is {name: bytearray}.
+    """
+    def __init__(self, stdin=None, stdout=None, stderr=None, files=None):
+        self.memory = bytearray(NULL_PAGE)
+        self.files = {} if files is None else files
+        self.fds = {
+            0: stdin if stdin is not None else io.BytesIO(),
+            1: stdout if stdout is not None else io.BytesIO(),
+            2: stderr if stderr is not None else io.BytesIO(),
+        }
+        self.literals = {} # Literal -> address
+        self.sp = self.stack_limit = 0
+        self.brk_start = self.brk = 0
+        self.brk_limit = MAX_MEMORY
+        self.unmapped = {} # size -> [address]
+    def allocate(self, data, align=4):
+        "puts data after the globals so far, returns its address"
+        addr = _align(len(self.memory), align)
+        self.memory += bytes(addr - len(self.memory)) + data
+        return addr
+    def constant(self, t, v):
+        """
+        the value of the literal v in a variable of prim type t, string
+        literals are put in memory
+
+        :type v: Literal
+        """
+        if v.type == 'INT_LIT':
+            return wrap(v.value) if t == 'int' else v.value & 0xff
+        elif v.type == 'CHAR_LIT':
+            return ord(v.value)
+        addr = self.literals.get(v)
+        if addr is None:
+            addr = self.literals[v] = self.allocate(unescape(v.value), 1)
+        return addr
+    def define(self, v):
+        """
+        puts the global v in memory, returns its address
+
+        :type v: GlobalVariable
+        """
+        t = _prim(v.var_type)
+        if isinstance(v.value, ArrayLiteral):
+            values = [self.constant(t, e) for e in v.value.elements]
+            values += [0] * (v.var_type.length - len(values))
+        elif isinstance(v.var_type, ArrayDeclaration):
+            return self.allocate(unescape(v.value.value), 1)
+        else:
+            values = [self.constant(t, v.value)]
+        if t == 'char':
+            return self.allocate(bytes(x & 0xff for x in values), 1)
+        return self.allocate(struct.pack('<%di' % len(values), *values))
+    def start(self, argv):
+        """
+        makes the stack and puts argv after it, returns main's arguments
+
+        :type argv: list
+        """
+        self.stack_limit = self.allocate(bytes(STACK_SIZE), PAGE)
+        self.sp = len(self.memory)
+        strings = [self.allocate(a.encode() + b'\0', 1) for a in argv]
+        args = self.allocate(struct.pack('<%di' % (len(strings) + 1), *(strings + [0])))
+        self.brk_start = self.brk = self.allocate(b'', PAGE)
+        return len(argv), args
+    def run(self, main, argv, flush=None):
+        """
+        calls main(argc, argv) and then flush, like canada.s, and returns
+        the exit status
+        """
+        argc, args = self.start(argv)
+        try:
+            with _deep():
+                main(argc, args)
+                if flush is not None:
+                    flush()
+            return 0
+        except Exit as e:
+            return e.status
+        except RecursionError:
+            raise VMError('stack overflow')
+        except (IndexError, struct.error):
+            raise VMError('segmentation fault')
+    def overflow(self):
+        raise VMError('stack overflow')
+    def load_int(self, addr):
+        return INT.unpack_from(self.memory, addr)[0]
+    def load_char(self, addr):
+        return (self.memory[addr] ^ 128) - 128
+    def store_int(self, v, addr):
+        "stores v at addr and returns it (value first, it's evaluated first)"
+        INT.pack_into(self.memory, addr, v)
+        return v
+    def store_char(self, v, addr):
+        self.memory[addr] = v & 0xff
+        return (v & 0xff ^ 0x80) - 0x80
+    def _range(self, addr, n):
+        if n < 0 or addr < 0 or addr + n > len(self.memory):
+            raise VMError('segmentation fault')
+    def memset(self, dst, c, n):
+        self._range(dst, n)
+        self.memory[dst:dst + n] = bytes((c & 0xff,)) * n
+        return dst
+    def memcpy(self, dst, src, n):
+        self._range(dst, n)
+        self._range(src, n)
+        self.memory[dst:dst + n] = self.memory[src:src + n]
+        return dst
+    def memcmp(self, a, b, n):
+        self._range(a, n)
+        self._range(b, n)
+        x, y = self.memory[a:a + n], self.memory[b:b + n]
+        if x == y:
+            return 0
+        i = next(i for i in range(n) if x[i] != y[i])
+        return x[i] - y[i]
+    def sys_exit(self, status):
+        raise Exit(status & 0xff)
+    def sys_write(self, fd, buf, n):
+        f = self.fds.get(fd)
+        if f is None:
+            return -EBADF
+        if n < 0 or buf < 0 or buf + n > len(self.memory):
+            return -EFAULT
+        try:
+            return f.write(bytes(self.memory[buf:buf + n])) or n
+        except io.UnsupportedOperation:
+            return -EBADF
+    def sys_read(self, fd, buf, n):
+        f = self.fds.get(fd)
+        if f is None:
+            return -EBADF
+        if n < 0 or buf < 0 or buf + n > len(self.memory):
+            return -EFAULT
+        try:
+            data = f.read1(n) if hasattr(f, 'read1') else f.read(n)
+        except io.UnsupportedOperation:
+            return -EBADF
+        self.memory[buf:buf + len(data)] = data
+        return len(data)
+    def sys_open(self, name, flags, mode):
+        try:
+            end = self.memory.index(0, name)
+        except ValueError:
+            return -EFAULT
+        fn = self.memory[name:end].decode('latin-1')
+        if fn not in self.files:
+            if not flags & O_CREAT:
+                return -ENOENT
+            self.files[fn] = bytearray()
+        access = flags & O_ACCMODE
+        if flags & O_TRUNC and access:
+            del self.files[fn][:]
+        fd = min(set(range(len(self.fds) + 1)) - set(self.fds))
+        self.fds[fd] = File(self.files[fn], access != O_WRONLY, access != 0, bool(flags & O_APPEND))
+        return fd
+    def sys_close(self, fd):
+        if self.fds.pop(fd, None) is None:
+            return -EBADF
+        return 0
+    def sys_brk(self, addr):
+        if self.brk_start <= addr <= self.brk_limit:
+            if addr > len(self.memory):
+                self.memory += bytes(_align(addr, PAGE) - len(self.memory))
+            self.brk = addr
+        return self.brk
+    def sys_mmap(self, addr, length, prot, flags, fd, offset):
+        if not flags & MAP_ANONYMOUS:
+            return -ENODEV
+        if length <= 0:
+            return -EINVAL
+        size = _align(length, PAGE)
+        if self.unmapped.get(size):
+            addr = self.unmapped[size].pop()
+            self.memory[addr:addr + size] = bytes(size)
+            return addr
+        addr = _align(max(len(self.memory), self.brk), PAGE)
+        if addr + size > MAX_MEMORY:
+            return -ENOMEM
+        self.memory += bytes(addr + size - len(self.memory))
+        # the heap can't grow into it
+        self.brk_limit = min(self.brk_limit, addr)
+        return addr
+    def sys_munmap(self, addr, length):
+        if addr & (PAGE - 1) or length <= 0:
+            return -EINVAL
+        self.unmapped.setdefault(_align(length, PAGE), []).append(addr)
+        return 0
+
+def load(filenames):
+    "links the files into one Program and checks it with the code generator"
+    program = canadalink.WholeProgram(canadalink.load(filenames)).program()
+    CodeGenerator(io.StringIO(), linux=True, c_prefix='').generate(program)
+    if not any(isinstance(d, Function) and d.name == 'main' for d in program.decls):
+        raise CompilationError('There is no main', None)
+    return program
+
+class _Var:
+    """
+    A variable as the generated code sees it: a Python variable, or
+    memory at addr (a Python expression)
+    """
+    __slots__ = ('py', 'addr', 'type')
+    def __init__(self, type, py=None, addr=None):
+        ":type type: VariableType"
+        self.py = py
+        self.addr = addr
+        self.type = _prim(type)
+
+class _Def:
+    "a Python function being generated"
+    def __init__(self, name, top=False):
+        self.name = name
+        self.top = top
+        self.lines = []
+        # the Python variables it assigns: globals of the module, and
+        # locals of the function (nonlocal in a closure)
+        self.globals = set()
+        self.locals = set()
+        self.signals = set() # what it can return, if it is a closure
+    def add(self, indent, line):
+        self.lines.append('    ' * indent + line)
+
+class Compiler:
+    """
+    Turns a checked Program into Python functions running on machine.
+    functions is {name: Python function}.
+    """
+    def __init__(self, program, machine):
+        """
+        :type program: Program
+        :type machine: Machine
+        """
+        self.vm = machine
+        self.source = []
+        self.env = dict(HELPERS)
+        self.env.update({
+            '_m': machine.memory,
+            '_vm': machine,
+            '_I': INT.unpack_from,
+            '_P': INT.pack_into,
+            '_sti': machine.store_int,
+            '_stc': machine.store_char,
+            '_overflow': machine.overflow,
+        })
+        for name in builtins:
+            self.env['_' + name] = getattr(machine, name)
+        for name in ('open', 'close', 'read', 'write', 'exit', 'brk', 'mmap', 'munmap'):
+            self.env['_sys_' + name] = getattr(machine, 'sys_' + name)
+        self.names = 0
+        decls = program.decls
+        self.defs = {d.name: d for d in decls if isinstance(d, Function)}
+        self.pyname = {name: self.unique('f', name) for name in self.defs}
+        # globals indexed or with their address taken anywhere go in memory
+        in_memory = set()
+        for f in self.defs.values():
+            in_memory |= self.memory_names(f)
+        self.globals = {}
+        for d in decls:
+            if not isinstance(d, GlobalVariable):
+                continue
+            if d.name in in_memory or isinstance(d.var_type, ArrayDeclaration):
+                self.globals[d.name] = _Var(d.var_type, addr=str(machine.define(d)))
+            else:
+                var = self.globals[d.name] = _Var(d.var_type, py=self.unique('g', d.name))
+                v = machine.constant(var.type, d.value)
+                self.env[var.py] = (v ^ 0x80) - 0x80 if var.type == 'char' else v
+        with _deep():
+            for f in self.defs.values():
+                self.function(f)
+        self.functions = {name: self.env[py] for name, py in self.pyname.items()}
+    def unique(self, prefix, name):
+        self.names += 1
+        return prefix + str(self.names) + '_' + re.sub(r'\W', '_', name)
+    @staticmethod
+    def memory_names(f):
+        "names f indexes or takes the address of"
+        names = set()
+        for n in canadalink.nodes(f.statement):
+            if isinstance(n, ArrayAccess):
+                names.add(n.array)
+            elif isinstance(n, Address) and isinstance(n.lvalue, Identifier):
+                names.add(n.lvalue.name)
+        return names
+    def function(self, f):
+        ":type f: Function"
+        self.in_memory = self.memory_names(f)
+        self.locals = []
+        self.closures = []
+        self.frame = self.frame_size = 0
+        self.scopes = [{}]
+        params = [self.unique('v', p) for p in f.par_list]
+        mem_params = any(p in self.in_memory for p in f.par_list)
+        for i, p in enumerate(f.par_list):
+            if mem_params:
+                self.scopes[0][p] = _Var(PrimitiveType('int'), addr=self.offset(4 * i))
+            else:
+                self.scopes[0][p] = _Var(PrimitiveType('int'), py=params[i])
+        if mem_params:
+            self.frame = self.frame_size = 4 * len(params)
+        top = _Def(self.pyname[f.name], top=True)
+        self.block(f.statement, top, 0, (None, None))
+        lines = ['def ' + top.name + '(' + ', '.join(params) + '):']
+        if top.globals:
+            lines.append('    global ' + ', '.join(sorted(top.globals)))
+        if self.locals:
+            lines.append('    ' + ' = '.join(self.locals) + ' = 0')
+        if self.closures:
+            lines.append('    _ret = 0')
+        for c in self.closures:
+            lines.append('    def ' + c.name + '():')
+            if c.locals:
+                lines.append('        nonlocal ' + ', '.join(sorted(c.locals)))
+            if c.globals:
+                lines.append('        global ' + ', '.join(sorted(c.globals)))
+            lines += ['        ' + l for l in c.lines or ['pass']]
+        body = top.lines + ['return 0']
+        if self.frame_size:
+            size = _align(self.frame_size, 4)
+            lines += ['    _sp = _vm.sp - ' + str(size),
+                      '    if _sp < _vm.stack_limit:',
+                      '        _overflow()',
+                      '    _vm.sp = _sp']
+            lines += ['    _P(_m, _sp + %d, %s)' % (4 * i, p) for i, p in enumerate(params) if mem_params]
+            lines.append('    try:')
+            body = ['    ' + l for l in body] + ['finally:', '    _vm.sp = _sp + ' + str(size)]
+        lines += ['    ' + l for l in body]
+        src = '\n'.join(lines) + '\n'
+        self.source.append(src)
+        exec(compile(src, '<' + f.name + '>', 'exec'), self.env)
+    def offset(self, n):
+        return '_sp + ' + str(n) if n else '_sp'
+    def closure(self):
+        c = _Def(self.unique('c', ''))
+        self.closures.append(c)
+        return c
+    def lookup(self, name):
+        for scope in reversed(self.scopes):
+            if name in scope:
+                return scope[name]
+        if name not in self.globals:
+            raise CompilationError(name + ' is not defined in the program', None)
+        return self.globals[name]
+    def assigns(self, out, name, var):
+        "notes that out assigns var, what name refers to"
+        (out.globals if self.globals.get(name) is var else out.locals).add(var.py)
+    def declare(self, v):
+        ":type v: VariableDeclaration"
+        if v.name in self.in_memory or isinstance(v.type, ArrayDeclaration):
+            size = v.type.size()
+            var = _Var(v.type, addr=self.offset(self.frame))
+            self.frame += size
+            self.frame_size = max(self.frame_size, self.frame)
+        else:
+            var = _Var(v.type, py=self.unique('v', v.name))
+            self.locals.append(var.py)
+        self.scopes[-1][v.name] = var
+    # statements: added to out at indent; ctx is what break and
+    # continue do there: 'break' or 'continue' in a Python loop, 'return'
+    # (from a switch) or returning BREAK or CONTINUE from a closure
+    def block(self, b, out, indent, ctx):
+        ":type b: Block"
+        frame = self.frame
+        self.scopes.append({})
+        for s in b.statements:
+            if isinstance(s, VariableDeclaration):
+                self.declare(s)
+            else:
+                self.statement(s, out, indent, ctx)
+        self.scopes.pop()
+        self.frame = frame
+    def suite(self, s, out, indent, ctx):
+        "s as the body of a Python if or while"
+        n = len(out.lines)
+        self.statement(s, out, indent, ctx)
+        if len(out.lines) == n:
+            out.add(indent, 'pass')
+    def jump(self, out, indent, how):
+        if how in ('break', 'continue', 'return'):
+            out.add(indent, how)
+        else:
+            out.signals.add(how)
+            out.add(indent, 'return ' + str(how))
+    def call_closure(self, out, indent, c, ctx):
+        if not c.signals:
+            out.add(indent, c.name + '()')
+            return
+        out.add(indent, '_r = ' + c.name + '()')
+        for signal, how in ((BREAK, ctx[0]), (CONTINUE, ctx[1]), (RETURN, RETURN)):
+            if signal not in c.signals:
+                continue
+            out.add(indent, 'if _r == %d:' % signal)
+            if signal == RETURN and out.top:
+                out.add(indent + 1, 'return _ret')
+            else:
+                self.jump(out, indent + 1, how)
+    def inner_ctx(self, ctx):
+        "what break and continue do in a closure"
+        return (BREAK if ctx[0] is not None else None, CONTINUE if ctx[1] is not None else None)
+    def statement(self, s, out, indent, ctx):
+        if indent > MAX_NESTING and isinstance(s, (Block, IfStatement, WhileLoop)):
+            c = self.closure()
+            self.statement(s, c, 0, self.inner_ctx(ctx))
+            self.call_closure(out, indent, c, ctx)
+        elif isinstance(s, Block):
+            self.block(s, out, indent, ctx)
+        elif isinstance(s, IfStatement):
+            out.add(indent, 'if ' + self.condition(s.condition, out, 0) + ':')
+            self.suite(s.statement, out, indent + 1, ctx)
+            # else if chains stay flat
+            while isinstance(s.else_clause, IfStatement):
+                s = s.else_clause
+                out.add(indent, 'elif ' + self.condition(s.condition, out, 0) + ':')
+                self.suite(s.statement, out, indent + 1, ctx)
+            if s.else_clause:
+                out.add(indent, 'else:')
+                self.suite(s.else_clause, out, indent + 1, ctx)
+        elif isinstance(s, WhileLoop):
+            out.add(indent, 'while ' + self.condition(s.condition, out, 0) + ':')
+            self.suite(s.statement, out, indent + 1, ('break', 'continue'))
+        elif isinstance(s, SwitchStatement):
+            self.switch(s, out, indent, ctx)
+        elif isinstance(s, BreakStatement):
+            self.jump(out, indent, ctx[0])
+        elif isinstance(s, ContinueStatement):
+            self.jump(out, indent, ctx[1])
+        elif isinstance(s, ReturnStatement):
+            value = self.expr(s.expr, out, 0) if s.expr is not None else '0'
+            if out.top:
+                out.add(indent, 'return ' + value)
+            else:
+                out.locals.add('_ret')
+                out.add(indent, '_ret = ' + value)
+                self.jump(out, indent, RETURN)
+        elif isinstance(s, ExpressionStatement):
+            e = s.expr
+            if isinstance(e, BinaryExpression) and e.op == '=':
+                self.assign(e, out, indent)
+            else:
+                out.add(indent, self.expr(e, out, 0))
+        else:
+            assert isinstance(s, EmptyStatement)
+    def switch(self, s, out, indent, ctx):
+        """
+        a closure that finds the first arm to run and runs the arms
+        from there, so they fall through
+
+        :type s: SwitchStatement
+        """
+        c = self.closure()
+        table = {}
+        default = len(s.cases)
+        for i, case in enumerate(s.cases):
+            if case.value is None:
+                default = i
+            else:
+                table[self.vm.constant('int', case.value)] = i
+        name = self.unique('_switch', '')
+        self.env[name] = table
+        c.add(0, '_k = %s.get(%s, %d)' % (name, self.expr(s.expr, c, 0), default))
+        inner = ('return', CONTINUE if ctx[1] is not None else None)
+        for i, case in enumerate(s.cases):
+            c.add(0, 'if _k <= %d:' % i)
+            n = len(c.lines)
+            for st in case.statements:
+                self.statement(st, c, 1, inner)
+            if len(c.lines) == n:
+                c.add(1, 'pass')
+        self.call_closure(out, indent, c, ctx)
+    def assign(self, e, out, indent):
+        "e as a statement, its value unused"
+        lhs = e.lhs
+        name = None if isinstance(lhs, Dereference) else lhs.name if isinstance(lhs, Identifier) else lhs.array
+        var = None if name is None else self.lookup(name)
+        char = lhs.char if var is None else var.type == 'char'
+        value = self.expr(e.rhs, out, 0, not char)
+        if var is None:
+            addr = self.expr(lhs.expr, out, 0, False)
+        elif var.py is not None:
+            self.assigns(out, name, var)
+            out.add(indent, var.py + ' = ' + (SEXT8.format(value) if char else value))
+            return
+        else:
+            addr = self.element(var, lhs.index if isinstance(lhs, ArrayAccess) else None, out, 0)
+        if char:
+            # Python evaluates the value before the subscript
+            out.add(indent, '_m[' + addr + '] = ' + value + ' & 255')
+        elif canadalink.pure(e.rhs) or addr.isdigit():
+            out.add(indent, '_P(_m, ' + addr + ', ' + value + ')')
+        else:
+            out.add(indent, '_v = ' + value)
+            out.add(indent, '_P(_m, ' + addr + ', _v)')
+    # expressions: returns Python source, atomic or in parentheses
+    def element(self, var, index, out, depth):
+        "the address of element index of var (or of var itself if None)"
+        size = 4 if var.type == 'int' else 1
+        if index is None:
+            return var.addr
+        if isinstance(index, Literal):
+            offset = self.vm.constant('int', index) * size
+            if var.addr.isdigit():
+                return str(int(var.addr) + offset)
+            base = int(var.addr[len('_sp + '):]) if var.addr != '_sp' else 0
+            return self.offset(base + offset)
+        i = self.expr(index, out, depth + 1, False)
+        return '(' + var.addr + ' + ' + ('4 * ' if size == 4 else '') + i + ')'
+    def load(self, var, index, out, depth):
+        if var.py is not None:
+            return var.py
+        return (LOAD_INT if var.type == 'int' else LOAD_CHAR).format(self.element(var, index, out, depth))
+    def condition(self, e, out, depth):
+        "e as a Python condition, true or false rather than 1 or 0"
+        if isinstance(e, BinaryExpression) and e.op in COMPARE:
+            return COMPARE[e.op].format(self.expr(e.lhs, out, depth + 1), self.expr(e.rhs, out, depth + 1))
+        elif isinstance(e, BinaryExpression) and e.op in ('&&', '||'):
+            op = ' and ' if e.op == '&&' else ' or '
+            return '(' + self.condition(e.lhs, out, depth + 1) + op + self.condition(e.rhs, out, depth + 1) + ')'
+        elif isinstance(e, Unary) and e.op == '!':
+            return '(not ' + self.condition(e.expr, out, depth + 1) + ')'
+        return self.expr(e, out, depth)
+    def expr(self, e, out, depth, exact=True):
+        """
+        without exact, + - * and << can leave the result unwrapped for
+        a user that only needs it mod 2**32 (the operators around it, a
+        char store, or an address: one that wrapped would be out of
+        memory anyway, and faults this way)
+        """
+        if depth > MAX_EXPRESSION:
+            c = self.closure()
+            c.add(0, 'return ' + self.expr(e, c, 0))
+            return c.name + '()'
+        if isinstance(e, Literal):
+            v = self.vm.constant('int', e)
+            return str(v) if v >= 0 else '(' + str(v) + ')'
+        elif isinstance(e, Identifier):
+            return self.load(self.lookup(e.name), None, out, depth)
+        elif isinstance(e, ArrayAccess):
+            return self.load(self.lookup(e.array), e.index, out, depth)
+        elif isinstance(e, Dereference):
+            return (LOAD_CHAR if e.char else LOAD_INT).format(self.expr(e.expr, out, depth + 1, False))
+        elif isinstance(e, Address):
+            lv = e.lvalue
+            if isinstance(lv, Dereference):
+                return self.expr(lv.expr, out, depth + 1)
+            var = self.lookup(lv.name if isinstance(lv, Identifier) else lv.array)
+            return self.element(var, lv.index if isinstance(lv, ArrayAccess) else None, out, depth)
+        elif isinstance(e, Unary):
+            if e.op == '!':
+                return '(0 if ' + self.condition(e.expr, out, depth + 1) + ' else 1)'
+            if e.op == '-':
+                operand = self.expr(e.expr, out, depth + 1, False)
+                return UNARY['-'].format(operand) if exact else '(-' + operand + ')'
+            return UNARY[e.op].format(self.expr(e.expr, out, depth + 1))
+        elif isinstance(e, BinaryExpression):
+            if e.op in COMPARE or e.op in ('&&', '||'):
+                return '(1 if ' + self.condition(e, out, depth) + ' else 0)'
+            elif e.op == '=':
+                return self.assign_value(e, out, depth)
+            if e.op in MODULAR:
+                lhs = self.expr(e.lhs, out, depth + 1, False)
+                rhs = self.expr(e.rhs, out, depth + 1, False)
+                return (BINARY if exact else MODULAR)[e.op].format(lhs, rhs)
+            lhs = self.expr(e.lhs, out, depth + 1, e.op != '>>>')
+            rhs = self.expr(e.rhs, out, depth + 1, e.op not in ('>>', '>>>'))
+            if (e.op in '/%' and isinstance(e.rhs, Literal) and rhs.isdigit() and int(rhs) > 0 and
+                    re.match(r'\w+$', lhs)):
+                # truncating with a positive constant, without the call
+                op = '//' if e.op == '/' else '%'
+                return '({0} {1} {2} if {0} >= 0 else -(-{0} {1} {2}))'.format(lhs, op, rhs)
+            return BINARY[e.op].format(lhs, rhs)
+        assert isinstance(e, FunctionCall)
+        return self.call(e, out, depth)
+    def assign_value(self, e, out, depth):
+        "e where its value is used"
+        lhs = e.lhs
+        name = None if isinstance(lhs, Dereference) else lhs.name if isinstance(lhs, Identifier) else lhs.array
+        var = None if name is None else self.lookup(name)
+        char = lhs.char if var is None else var.type == 'char'
+        value = self.expr(e.rhs, out, depth + 1, not char)
+        if var is None:
+            addr = self.expr(lhs.expr, out, depth + 1, False)
+        elif var.py is not None:
+            self.assigns(out, name, var)
+            return '(' + var.py + ' := ' + (SEXT8.format(value) if char else value) + ')'
+        else:
+            addr = self.element(var, lhs.index if isinstance(lhs, ArrayAccess) else None, out, depth)
+        return ('_stc(' if char else '_sti(') + value + ', ' + addr + ')'
+    def call(self, e, out, depth):
+        ":type e: FunctionCall"
+        if e.name.startswith('$'):
+            fn = '_sys_' + e.name[1:]
+        elif e.name in self.defs:
+            fn = self.pyname[e.name]
+        elif e.name in builtins:
+            fn = '_' + e.name
+        else:
+            raise CompilationError(e.name + ' is not defined in the program', e)
+        args = [self.expr(a, out, depth + 1) for a in e.args]
+        if len(args) > 1 and not all(canadalink.pure(a) for a in e.args):
+            # right to left, like the pushes
+            return fn + '(*(' + ', '.join(reversed(args)) + ',)[::-1])'
+        return fn + '(' + ', '.join(args) + ')'
+    def run(self, argv):
+        "runs main, returns the exit status"
+        return self.vm.run(self.functions['main'], argv, self.functions.get('flush'))
+
+class Walker:
+    """
+    The naive interpreter: walks the tree for every expression, with
+    every variable in memory found by name. ops counts the expressions
+    and statements it evaluates; reaching limit is a fault.
+    """
+    def __init__(self, program, machine):
+        """
+        :type program: Program
+        :type machine: Machine
+        """
+        self.vm = machine
+        self.functions = {d.name: d for d in program.decls if isinstance(d, Function)}
+        self.globals = {d.name: (machine.define(d), d.var_type)
+                        for d in program.decls if isinstance(d, GlobalVariable)}
+        self.binary = BINARY_OPERATORS
+        self.unary = UNARY_OPERATORS
+        self.ops = 0
+        self.limit = None
+        self.retval = 0
+    def run(self, argv):
+        flush = self.functions.get('flush')
+        return self.vm.run(lambda argc, args: self.call(self.functions['main'], [argc, args]), argv,
+                           flush and (lambda: self.call(flush, [])))
+    def evaluate(self, name, args, steps):
+        """
+        the value of name(args), or None if it faults or takes more than
+        steps expressions and statements
+        """
+        if not self.vm.stack_limit:
+            self.vm.start([])
+        self.ops = 0
+        self.limit = steps
+        try:
+            with _deep():
+                return self.call(self.functions[name], args)
+        except (Fault, Exit, RecursionError, IndexError, struct.error):
+            return None
+        finally:
+            self.limit = None
+    def call(self, f, args):
+        vm = self.vm
+        sp = vm.sp
+        vm.sp -= 4 * len(args)
+        if vm.sp < vm.stack_limit:
+            vm.overflow()
+        scope = {}
+        for i, (p, a) in enumerate(zip(f.par_list, args)):
+            vm.store_int(a, vm.sp + 4 * i)
+            scope[p] = (vm.sp + 4 * i, PrimitiveType('int'))
+        try:
+            if self.statement(f.statement, [scope]) == RETURN:
+                return self.retval
+            return 0
+        finally:
+            vm.sp = sp
+    def lookup(self, name, scopes):
+        for scope in reversed(scopes):
+            if name in scope:
+                return scope[name]
+        return self.globals[name]
+    def statement(self, s, scopes):
+        "runs s, returns BREAK, CONTINUE, RETURN or None"
+        self.ops += 1
+        # expressions count too, so ops can step over limit
+        if self.limit is not None and self.ops >= self.limit:
+            raise VMError('too many steps')
+        vm = self.vm
+        if isinstance(s, Block):
+            sp = vm.sp
+            scope = {}
+            try:
+                for d in s.statements:
+                    if isinstance(d, VariableDeclaration):
+                        vm.sp -= d.type.size()
+                        if vm.sp < vm.stack_limit:
+                            vm.overflow()
+                        scope[d.name] = (vm.sp, d.type)
+                inner = scopes + [scope]
+                for st in s.statements:
+                    if isinstance(st, Statement):
+                        r = self.statement(st, inner)
+                        if r is not None:
+                            return r
+            finally:
+                vm.sp = sp
+        elif isinstance(s, IfStatement):
+            if self.expr(s.condition, scopes):
+                return self.statement(s.statement, scopes)
+            elif s.else_clause:
+                return self.statement(s.else_clause, scopes)
+        elif isinstance(s, WhileLoop):
+            while self.expr(s.condition, scopes):
+                r = self.statement(s.statement, scopes)
+                if r == BREAK:
+                    break
+                elif r == RETURN:
+                    return r
+        elif isinstance(s, SwitchStatement):
+            v = self.expr(s.expr, scopes)
+            start = None
+            for i, case in enumerate(s.cases):
+                if case.value is None:
+                    if start is None:
+                        start = i
+                elif vm.constant('int', case.value) == v:
+                    start = i
+                    break
+            if start is None:
+                return None
+            for case in s.cases[start:]:
+                for st in case.statements:
+                    r = self.statement(st, scopes)
+                    if r == BREAK:
+                        return None
+                    elif r is not None:
+                        return r
+        elif isinstance(s, BreakStatement):
+            return BREAK
+        elif isinstance(s, ContinueStatement):
+            return CONTINUE
+        elif isinstance(s, ReturnStatement):
+            self.retval = self.expr(s.expr, scopes) if s.expr is not None else 0
+            return RETURN
+        elif isinstance(s, ExpressionStatement):
+            self.expr(s.expr, scopes)
+        return None
+    def lvalue(self, lv, scopes):
+        "(address, 'int' or 'char') of lv"
+        if isinstance(lv, Dereference):
+            return self.expr(lv.expr, scopes), 'char' if lv.char else 'int'
+        if isinstance(lv, Identifier):
+            addr, t = self.lookup(lv.name, scopes)
+            return addr, _prim(t)
+        addr, t = self.lookup(lv.array, scopes)
+        t = _prim(t)
+        return addr + self.expr(lv.index, scopes) * (4 if t == 'int' else 1), t
+    def expr(self, e, scopes):
+        self.ops += 1
+        vm = self.vm
+        if isinstance(e, Literal):
+            return vm.constant('int', e)
+        elif isinstance(e, LValue):
+            addr, t = self.lvalue(e, scopes)
+            return vm.load_int(addr) if t == 'int' else vm.load_char(addr)
+        elif isinstance(e, Address):
+            if isinstance(e.lvalue, Dereference):
+                return self.expr(e.lvalue.expr, scopes)
+            return self.lvalue(e.lvalue, scopes)[0]
+        elif isinstance(e, Unary):
+            return self.unary[e.op](self.expr(e.expr, scopes))
+        elif isinstance(e, BinaryExpression):
+            if e.op == '=':
+                v = self.expr(e.rhs, scopes)
+                addr, t = self.lvalue(e.lhs, scopes)
+                return vm.store_int(v, addr) if t == 'int' else vm.store_char(v, addr)
+            elif e.op == '&&':
+                return 1 if self.expr(e.lhs, scopes) and self.expr(e.rhs, scopes) else 0
+            elif e.op == '||':
+                return 1 if self.expr(e.lhs, scopes) or self.expr(e.rhs, scopes) else 0
+            lhs = self.expr(e.lhs, scopes)
+            return self.binary[e.op](lhs, self.expr(e.rhs, scopes))
+        assert isinstance(e, FunctionCall)
+        args = [self.expr(a, scopes) for a in reversed(e.args)][::-1]
+        if e.name.startswith('$'):
+            return getattr(vm, 'sys_' + e.name[1:])(*args)
+        if e.name in self.functions:
+            return self.call(self.functions[e.name], args)
+        if e.name in builtins:
+            return getattr(vm, e.name)(*args)
+        raise CompilationError(e.name + ' is not defined in the program', e)
+
+def _bench(filenames, argv, stdin, out):
+    "runs the program with Walker and with the VM, returns an exit status"
+    results = {}
+    for kind in (Walker, Compiler):
+        stdout = io.BytesIO()
+        machine = Machine(io.BytesIO(stdin), stdout, stdout)
+        start = time.perf_counter()
+        interpreter = kind(load(filenames), machine)
+        compiled = time.perf_counter()
+        status = interpreter.run(argv)
+        results[kind] = (compiled - start, time.perf_counter() - compiled, status, stdout.getvalue())
+        if kind is Walker:
+            ops = interpreter.ops
+    if results[Walker][2:] != results[Compiler][2:]:
+        out.write('ERROR: the VM and the walker disagree\n')
+        return 1
+    walk = results[Walker][1]
+    build, vm = results[Compiler][:2]
+    out.write('%d expressions and statements evaluated\n' % ops)
+    out.write('walker  %8.3fs  %8.1fM/minute\n' % (walk, ops * 60 / walk / 1e6))
+    out.write('vm      %8.3fs  %8.1fM/minute  %.1fx faster, %.3fs to compile\n' % (vm, ops * 60 / vm / 1e6, walk / vm, build))
+    return 0
+
+if __name__ == '__main__':
+    import argparse
+    ap = argparse.ArgumentParser(description='Run Canada programs without assembling them',
+                                 epilog='arguments after -- are passed to main')
+    ap.add_argument('files', nargs='+', help='the modules of the program')
+    ap.add_argument('--walker', action='store_true', help='run it with the naive tree walker')
+    ap.add_argument('--bench', action='store_true', help='time it with the walker and with the VM')
+    ap.add_argument('--source', action='store_true', help='print the Python the VM runs instead of running it')
+    argv = sys.argv[1:]
+    args_ = []
+    if '--' in argv:
+        args_ = argv[argv.index('--') + 1:]
+        argv = argv[:argv.index('--')]
+    args = ap.parse_args(argv)
+    if args.source and (args.walker or args.bench):
+        ap.error('--source is only for the VM')
+    argv = [os.path.splitext(args.files[0])[0]] + args_
+    try:
+        if args.bench:
+            sys.exit(_bench(args.files, argv, sys.stdin.buffer.read(), sys.stdout))
+        machine = Machine(sys.stdin.buffer, sys.stdout.buffer, sys.stderr.buffer)
+        interpreter = (Walker if args.walker else Compiler)(load(args.files), machine)
+        if args.source:
+            sys.stdout.write('\n'.join(interpreter.source))
+            sys.exit(0)
+        status = interpreter.run(argv)
+    except (CompilationError, Fault) as err:
+        sys.stdout.flush()
+        sys.stdout.write("ERROR: " + str(err) + '\n')
+        sys.exit(1)
+    sys.stdout.flush()
+    sys.exit(status)
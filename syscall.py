@@ -1,7 +1,37 @@
+# linux x86, made through ?vsyscall (see canada.s) or with int 80h
 syscalls = {
     '$open': 5,
     '$close': 6,
     '$read': 3,
     '$write': 4,
     '$exit': 1,
+    '$brk': 45,
+    # mmap2, canadacodegen turns the offset into pages
+    '$mmap': 192,
+    '$munmap': 91,
+}
+
+# the BSDs agree with linux on the first few (arguments go on the stack)
+syscalls_freebsd = dict(syscalls, **{
+    '$brk': 17, # break, returns 0 instead of the new break
+    '$mmap': 477,
+    '$munmap': 73,
+})
+
+syscalls_darwin = dict(syscalls, **{
+    '$mmap': 197,
+    '$munmap': 73,
+})
+del syscalls_darwin['$brk']
+
+# linux x86-64, made with the syscall instruction
+syscalls_x86_64 = {
+    '$open': 2,
+    '$close': 3,
+    '$read': 0,
+    '$write': 1,
+    '$exit': 60,
+    '$brk': 12,
+    '$mmap': 9,
+    '$munmap': 11,
 }
@@ -0,0 +1,60 @@
+"""
+Deeply nested programs compile without hitting the recursion limit
+and in time linear in their size: the parser and the code generator
+walk trees with work stacks instead of recursing.
+
+    python3 -m pytest test_deep.py
+"""
+import io
+import time
+import unittest
+
+import canadaparse
+
+from canadacodegen import CodeGenerator
+
+# terms or levels in each deep program
+DEPTH = 100000
+# seconds each may take to parse and compile
+BUDGET = 60
+
+def compile(code, **kwargs):
+    "parses and compiles code, returns the assembly"
+    out = io.StringIO()
+    CodeGenerator(out, linux=True, c_prefix='', **kwargs).generate(canadaparse.parse(code))
+    return out.getvalue()
+
+def condition(n, op):
+    "main with an if whose condition is n terms joined by op"
+    return ('void main(argc, argv) {\n    if (' + (' ' + op + ' ').join(['argc'] * n) +
+            ')\n        argc = 0;\n}\n')
+
+def assignment(expr):
+    "main assigning expr to argc"
+    return 'void main(argc, argv) {\n    argc = ' + expr + ';\n}\n'
+
+class DeepTest(unittest.TestCase):
+    def compiles(self, code, **kwargs):
+        start = time.perf_counter()
+        asm = compile(code, **kwargs)
+        self.assertLess(time.perf_counter() - start, BUDGET)
+        return asm
+    def test_and_condition(self):
+        self.compiles(condition(DEPTH, '&&'))
+    def test_or_condition(self):
+        self.compiles(condition(DEPTH, '||'))
+    def test_chain(self):
+        self.compiles(assignment(' + '.join(['argc'] * DEPTH)))
+    def test_parentheses(self):
+        self.compiles(assignment('(' * DEPTH + 'argc' + ')' * DEPTH))
+    def test_unary(self):
+        self.compiles(assignment('-(' * DEPTH + 'argc' + ')' * DEPTH))
+    def test_and_condition_profiled(self):
+        self.compiles(condition(DEPTH, '&&'), profile=True)
+    def test_expr_text(self):
+        ast = canadaparse.parse('void main(argc, argv) { if (-f(argc, *&x[1 + #y]) < (z = 2) || !argc) ; }')
+        cond = ast.decls[0].statement.statements[0].condition
+        self.assertEqual(canadaparse.expr_text(cond), repr(cond))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,99 @@
+"""
+Programs built with --elf (canadaelf.py writing the objects, then ld)
+print the same as they do built from NASM source: each program in
+bench/ is built both ways and its output compared with bench/NAME.out.
+The NASM side is skipped where nasm isn't installed.
+
+    python3 -m pytest test_elf.py
+"""
+import io
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+import canadacodegen
+import canadaelf
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+CORPUS = os.path.join(HERE, 'bench')
+
+def programs():
+    return sorted(fn[:-3] for fn in os.listdir(CORPUS) if fn.endswith('.ca'))
+
+@unittest.skipUnless(sys.platform.startswith('linux') and shutil.which('ld'), 'needs linux and ld')
+class ElfTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.tmp = tempfile.mkdtemp()
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.tmp)
+    def path(self, name, way):
+        return os.path.join(self.tmp, way, name)
+    def elf(self, name, src):
+        "writes the object of src directly"
+        out = self.path(name, 'elf') + '.o'
+        if src.endswith('.s'):
+            with open(src) as f, open(out, 'wb') as o:
+                canadaelf.assemble(f, o)
+        else:
+            canadacodegen.generate(src, out, elf=True)
+        return out
+    def nasm(self, name, src):
+        "assembles src (or the assembly of it) with nasm"
+        asm = src
+        if src.endswith('.ca'):
+            asm = self.path(name, 'nasm') + '.s'
+            canadacodegen.generate(src, asm)
+        out = self.path(name, 'nasm') + '.o'
+        subprocess.check_call(['nasm', '-f', 'elf', '-o', out, asm])
+        return out
+    def build(self, name, way):
+        "links bench/name with print.ca and the runtime, returns the executable"
+        os.makedirs(os.path.join(self.tmp, way), exist_ok=True)
+        obj = getattr(self, way)
+        objects = [obj(name, os.path.join(CORPUS, name + '.ca'))]
+        for lib, src in (('print', 'print.ca'), ('canada', 'canada.s')):
+            if not os.path.exists(self.path(lib, way) + '.o'):
+                obj(lib, os.path.join(HERE, src))
+            objects.append(self.path(lib, way) + '.o')
+        exe = self.path(name, way)
+        subprocess.check_call(['ld', '-m', 'elf_i386', '-e', '_start'] + objects + ['-o', exe])
+        return exe
+    def output(self, exe):
+        proc = subprocess.run([exe], stdin=subprocess.DEVNULL, stdout=subprocess.PIPE)
+        self.assertEqual(proc.returncode, 0)
+        return proc.stdout
+    def test_corpus(self):
+        for name in programs():
+            with self.subTest(name):
+                with open(os.path.join(CORPUS, name + '.out'), 'rb') as f:
+                    expected = f.read()
+                self.assertEqual(self.output(self.build(name, 'elf')), expected)
+    @unittest.skipUnless(shutil.which('nasm'), 'needs nasm')
+    def test_corpus_nasm(self):
+        for name in programs():
+            with self.subTest(name):
+                elf = self.output(self.build(name, 'elf'))
+                self.assertEqual(self.output(self.build(name, 'nasm')), elf)
+
+class DirectiveTest(unittest.TestCase):
+    def assemble(self, code):
+        out = io.BytesIO()
+        canadaelf.assemble(code.splitlines(), out)
+        return out.getvalue()
+    def test_ifidn(self):
+        nop = self.assemble('SECTION .text\nnop\n')
+        self.assertEqual(self.assemble('SECTION .text\n%ifidn __OUTPUT_FORMAT__, elf32\nnop\n%endif\n'), nop)
+        self.assertEqual(self.assemble('SECTION .text\n%ifidn __OUTPUT_FORMAT__, macho\nEXTERN x:weak\n%else\nnop\n%endif\n'), nop)
+    def test_unsupported(self):
+        for code in ('%define A 1', '%ifidn a, a', '%endif', '%else'):
+            with self.subTest(code):
+                with self.assertRaises(canadaelf.AssemblyError):
+                    self.assemble(code)
+
+if __name__ == '__main__':
+    unittest.main()
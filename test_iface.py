@@ -0,0 +1,58 @@
+"""
+Interface files round trip, and a truncated or corrupt one is an
+InterfaceError rather than whatever struct or indexing raises.
+
+    python3 -m pytest test_iface.py
+"""
+import random
+import unittest
+
+import canadaiface
+import canadaparse
+
+from canadaiface import InterfaceError
+
+SOURCE = '''
+int[16] table = {};
+char last = 'a';
+int add(a, b) { return a + b; }
+void reset() { last = 'a'; }
+export table;
+export last;
+export add;
+export reset;
+'''
+
+class InterfaceTest(unittest.TestCase):
+    def setUp(self):
+        self.data = canadaiface.dumps(canadaiface.exports(canadaparse.parse(SOURCE)))
+    def test_round_trip(self):
+        symbols = canadaiface.loads(self.data)
+        self.assertEqual(sorted(repr(s) for s in symbols.values()),
+                         ['char last', 'int add(a0, a1)', 'int[16] table', 'void reset()'])
+    def test_truncated(self):
+        for n in range(len(self.data)):
+            with self.subTest(n):
+                with self.assertRaises(InterfaceError):
+                    canadaiface.loads(self.data[:n])
+    def test_corrupt(self):
+        rng = random.Random(1)
+        for _ in range(2000):
+            data = bytearray(self.data)
+            for _ in range(rng.randint(1, 4)):
+                data[rng.randrange(len(data))] = rng.randrange(256)
+            try:
+                canadaiface.loads(bytes(data))
+            except InterfaceError:
+                pass
+    def test_bad_indexes(self):
+        header = canadaiface.HEADER.pack(canadaiface.MAGIC, canadaiface.VERSION, 0, 1)
+        for record in ((100, canadaiface.FUNCTION, 1, 0, 0),
+                       (0, canadaiface.FUNCTION, 7, 0, 0),
+                       (0, 9, 1, 0, 0)):
+            with self.subTest(record):
+                with self.assertRaises(InterfaceError):
+                    canadaiface.loads(header + canadaiface.RECORD.pack(*record) + b'f\0')
+
+if __name__ == '__main__':
+    unittest.main()
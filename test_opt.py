@@ -0,0 +1,56 @@
+"""
+Calls to pure functions with constant arguments are worked out at
+compile time by the code generator too, within canadaopt.FOLD_STEPS.
+
+    python3 -m pytest test_opt.py
+"""
+import io
+import sys
+import unittest
+
+import canadaparse
+
+from canadacodegen import CodeGenerator
+
+FIB = '''
+extern void print_int(n);
+int fib(n) {
+    if (n < 2)
+        return n;
+    return fib(n - 1) + fib(n - 2);
+}
+void main(argc, argv) {
+    print_int(fib(%d));
+}
+'''
+
+def compile(code):
+    "parses and compiles code, returns the assembly"
+    out = io.StringIO()
+    CodeGenerator(out, linux=True, c_prefix='').generate(canadaparse.parse(code))
+    return out.getvalue()
+
+def main_calls(asm):
+    "the functions main calls"
+    body = asm[asm.index('?@main:'):]
+    return [line.split()[-1] for line in body.splitlines() if 'call' in line.split()]
+
+class EvaluateCallsTest(unittest.TestCase):
+    def test_module(self):
+        asm = compile(FIB % 15)
+        self.assertEqual(main_calls(asm), ['?@print_int'])
+        self.assertIn('push    610', asm)
+    def test_too_many_steps(self):
+        asm = compile(FIB % 32)
+        self.assertEqual(main_calls(asm), ['?@fib', '?@print_int'])
+    def test_impure(self):
+        asm = compile(FIB.replace('return n;', 'print_int(n);') % 20)
+        self.assertIn('?@fib', main_calls(asm))
+    def test_no_vm(self):
+        # nothing to work out, so canadavm isn't needed
+        sys.modules.pop('canadavm', None)
+        compile(FIB.replace('fib(%d)', 'fib(argc)'))
+        self.assertNotIn('canadavm', sys.modules)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,43 @@
+"""
+Compile time grows linearly with the size of the program: each
+canadabench program is compiled at two sizes and every phase may take
+at most SLACK times longer than the growth in size. The sizes go from
+a few hundred statements up to an array literal of a million elements.
+
+    python3 -m pytest test_scaling.py
+"""
+import unittest
+
+import canadabench
+
+# the larger program is FACTOR times the smaller
+FACTOR = 8
+# allowed time ratio over FACTOR (timing noise, caches), quadratic
+# growth would be FACTOR times over
+SLACK = 2.5
+
+class ScalingTest(unittest.TestCase):
+    def linear(self, gen, n, repeat=3):
+        "compiles gen(n) and gen(FACTOR * n), checks each phase"
+        small = canadabench.measure(gen(n), repeat)
+        large = canadabench.measure(gen(FACTOR * n), repeat)
+        for phase in canadabench.PHASES:
+            ratio = large[phase] / max(small[phase], 1e-6)
+            self.assertLess(ratio, FACTOR * SLACK,
+                            '%s of %s grew %.1fx from %d to %d' % (phase, gen.__name__, ratio, n, FACTOR * n))
+    def test_functions(self):
+        self.linear(canadabench.functions, 250)
+    def test_nesting(self):
+        self.linear(canadabench.nesting, 500)
+    def test_blocks(self):
+        self.linear(canadabench.blocks, 1000)
+    def test_expressions(self):
+        self.linear(canadabench.expressions, 1250)
+    def test_arrays(self):
+        # a second or more per phase, one run is steady enough
+        self.linear(canadabench.arrays, 125000, repeat=1)
+    def test_strings(self):
+        self.linear(canadabench.strings, 500)
+
+if __name__ == '__main__':
+    unittest.main()
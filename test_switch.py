@@ -0,0 +1,158 @@
+"""
+switch statements: each way of dispatching (compares one by one, a
+jump table, a binary search), fallthrough, default anywhere, negative
+labels, break and continue inside a switch, and the errors. Programs
+run in canadavm, and natively (ELF objects from canadaelf.py linked
+with ld) where that is possible.
+
+    python3 -m pytest test_switch.py
+"""
+import io
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+import canadacodegen
+import canadaelf
+import canadaparse
+import canadavm
+
+from canadacodegen import CodeGenerator, CompilationError
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# f(x) is r after a switch on x
+PROGRAM = '''extern void print_int(n);
+int f(x) {
+    int r;
+    r = 0;
+    switch (x) {
+%s
+    }
+    return r;
+}
+void main(argc, argv) {
+%s}
+'''
+
+def program(body, inputs):
+    return PROGRAM % (body, ''.join('    print_int(f(%d));\n' % x for x in inputs))
+
+def expected(model, inputs):
+    return ''.join('%d\n' % model(x) for x in inputs).encode()
+
+def compile(code):
+    "parses and compiles code, returns the assembly"
+    out = io.StringIO()
+    CodeGenerator(out, linux=True, c_prefix='').generate(canadaparse.parse(code))
+    return out.getvalue()
+
+NATIVE = sys.platform.startswith('linux') and shutil.which('ld')
+
+class SwitchTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.tmp = tempfile.mkdtemp()
+        cls.runtime = []
+        if NATIVE:
+            print_o = os.path.join(cls.tmp, 'print.o')
+            canadacodegen.generate(os.path.join(HERE, 'print.ca'), print_o, elf=True)
+            canada_o = os.path.join(cls.tmp, 'canada.o')
+            with open(os.path.join(HERE, 'canada.s')) as f, open(canada_o, 'wb') as out:
+                canadaelf.assemble(f, out)
+            cls.runtime = [print_o, canada_o]
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.tmp)
+    def runs(self, code, output):
+        "checks that code prints output, in the VM and natively"
+        src = os.path.join(self.tmp, 'switch.ca')
+        with open(src, 'w') as f:
+            f.write(code)
+        stdout = io.BytesIO()
+        program = canadavm.load([src, os.path.join(HERE, 'print.ca')])
+        self.assertEqual(canadavm.Compiler(program, canadavm.Machine(stdout=stdout)).run(['switch']), 0)
+        self.assertEqual(stdout.getvalue(), output)
+        if NATIVE:
+            obj = os.path.join(self.tmp, 'switch.o')
+            exe = os.path.join(self.tmp, 'switch')
+            canadacodegen.generate(src, obj, elf=True)
+            subprocess.check_call(['ld', '-m', 'elf_i386', '-e', '_start', obj] + self.runtime + ['-o', exe])
+            proc = subprocess.run([exe], stdin=subprocess.DEVNULL, stdout=subprocess.PIPE)
+            self.assertEqual(proc.returncode, 0)
+            self.assertEqual(proc.stdout, output)
+    def switch(self, body, inputs, model):
+        "runs f on inputs, checks against model, returns the assembly"
+        code = program(body, inputs)
+        self.runs(code, expected(model, inputs))
+        return compile(code)
+    def test_jump_table(self):
+        body = ''.join('    case %d: r = %d; break;\n' % (v, 10 + v) for v in range(8)) + '    default: r = -1;'
+        asm = self.switch(body, range(-2, 10), lambda x: 10 + x if 0 <= x < 8 else -1)
+        self.assertIn('??jt', asm)
+    def test_binary_search(self):
+        values = [-1000, -1, 7, 100, 1000, 50000]
+        body = ''.join('    case %d: r = %d; break;\n' % (v, i + 1) for i, v in enumerate(values)) + '    default: r = -1;'
+        inputs = [v + d for v in values for d in (-1, 0, 1)]
+        asm = self.switch(body, inputs, lambda x: values.index(x) + 1 if x in values else -1)
+        self.assertNotIn('??jt', asm)
+    def test_compares(self):
+        body = "    case 1: r = 3; break;\n    case 'a': r = 4; break;"
+        asm = self.switch(body, [0, 1, 2, 96, 97, 98], lambda x: {1: 3, 97: 4}.get(x, 0))
+        self.assertNotIn('??jt', asm)
+    def test_fallthrough(self):
+        body = '    case 1: r = r + 1;\n    case 2: r = r + 10; break;\n    case 3: r = r + 100;'
+        self.switch(body, range(5), lambda x: {1: 11, 2: 10, 3: 100}.get(x, 0))
+    def test_default_in_the_middle(self):
+        body = ('    case 1: r = 1; break;\n    default: r = 5;\n'
+                '    case 2: r = r + 1; break;\n    case 3: r = 3;')
+        self.switch(body, range(6), lambda x: {1: 1, 2: 1, 3: 3}.get(x, 6))
+    def test_no_default(self):
+        self.switch('    case 2: r = 1;', range(4), lambda x: 1 if x == 2 else 0)
+    def test_negative(self):
+        body = '    case -1: r = 7; break;\n    case -2: r = 8; break;\n    case 0: r = 9;'
+        self.switch(body, range(-3, 2), lambda x: {-1: 7, -2: 8, 0: 9}.get(x, 0))
+    def test_negative_table(self):
+        body = ''.join('    case %d: r = %d; break;\n' % (v, v * 3) for v in range(-6, 2)) + '    default: r = 100;'
+        asm = self.switch(body, range(-8, 4), lambda x: x * 3 if -6 <= x < 2 else 100)
+        self.assertIn('??jt', asm)
+    def test_break_and_continue(self):
+        # break leaves the switch, continue goes on with the loop around it
+        code = '''extern void print_int(n);
+void main(argc, argv) {
+    int i;
+    int s;
+    i = 0;
+    s = 0;
+    while (i < 6) {
+        i = i + 1;
+        switch (i) {
+        case 2:
+            continue;
+        case 4:
+            break;
+        case 5:
+            s = s + 100;
+            continue;
+        }
+        s = s + i;
+    }
+    print_int(s);
+}
+'''
+        self.runs(code, b'114\n')
+    def test_duplicate(self):
+        with self.assertRaises(CompilationError):
+            compile(program('    case 1: r = 1;\n    case 1: r = 2;', []))
+    def test_two_defaults(self):
+        with self.assertRaises(CompilationError):
+            compile(program('    default: r = 1;\n    default: r = 2;', []))
+    def test_continue_outside_loop(self):
+        with self.assertRaises(CompilationError):
+            compile(program('    case 1: continue;', []))
+
+if __name__ == '__main__':
+    unittest.main()
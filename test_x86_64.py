@@ -0,0 +1,96 @@
+"""
+The x86-64 target: widen() rewrites the operands that hold addresses
+to 64-bit registers, every program in bench/ and the library modules
+compile with it, and where nasm is installed the corpus is assembled,
+linked against canada64.s and checked against bench/NAME.out.
+
+    python3 -m pytest test_x86_64.py
+"""
+import io
+import os
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+import canadaparse
+
+from canadacodegen import CodeGenerator64, widen
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+CORPUS = os.path.join(HERE, 'bench')
+LIBRARIES = ('print.ca', 'io.ca', 'alloc.ca')
+
+REG32 = r'\b(?:e[abcd]x|e[sd]i|e[sb]p|r[0-9]+d)\b'
+# a 32-bit register in a memory operand, or pushed, popped or jumped to
+ADDRESS32 = re.compile(r'\[[^\]]*' + REG32 + r'|\b(?:push|pop|jmp|call)\s+' + REG32)
+
+def programs():
+    return sorted(fn[:-3] for fn in os.listdir(CORPUS) if fn.endswith('.ca'))
+
+def compile(fn):
+    "the x86-64 assembly of the file fn"
+    with open(fn) as f:
+        ast = canadaparse.parse(f.read())
+    out = io.StringIO()
+    CodeGenerator64(out).generate(ast)
+    return out.getvalue()
+
+class WidenTest(unittest.TestCase):
+    def test_stack(self):
+        self.assertEqual(widen('push', 'eax'), 'rax')
+        self.assertEqual(widen('pop', 'ebx'), 'rbx')
+        self.assertEqual(widen('add', 'esp,16'), 'rsp,16')
+        self.assertEqual(widen('mov', 'ebp,esp'), 'rbp,rsp')
+        self.assertEqual(widen('jmp', 'ebx'), 'rbx')
+    def test_memory(self):
+        self.assertEqual(widen('mov', 'eax,dword[ebx+4*ecx]'), 'eax,dword[rbx+4*rcx]')
+        self.assertEqual(widen('mov', 'dword[ebp-8],r9d'), 'dword[rbp-8],r9d')
+        self.assertEqual(widen('lea', 'eax,[ebp+16]'), 'eax,[rbp+16]')
+    def test_values(self):
+        self.assertEqual(widen('add', 'eax,ebx'), 'eax,ebx')
+        self.assertEqual(widen('imul', 'r8d,r10d'), 'r8d,r10d')
+        self.assertEqual(widen('mov', ''), '')
+
+class CompileTest(unittest.TestCase):
+    def test_corpus(self):
+        for fn in [os.path.join(CORPUS, p + '.ca') for p in programs()] + [os.path.join(HERE, l) for l in LIBRARIES]:
+            with self.subTest(os.path.basename(fn)):
+                asm = compile(fn)
+                self.assertIn('?@', asm)
+                for line in asm.splitlines():
+                    code = line.split(';')[0]
+                    self.assertIsNone(ADDRESS32.search(code), line)
+
+@unittest.skipUnless(sys.platform.startswith('linux') and shutil.which('ld') and shutil.which('nasm'),
+                     'needs linux, ld and nasm')
+class RunTest(unittest.TestCase):
+    def assemble(self, tmp, name, asm):
+        src = os.path.join(tmp, name + '.s')
+        with open(src, 'w') as f:
+            f.write(asm)
+        obj = os.path.join(tmp, name + '.o')
+        subprocess.check_call(['nasm', '-f', 'elf64', '-o', obj, src])
+        return obj
+    def test_corpus(self):
+        tmp = tempfile.mkdtemp()
+        try:
+            with open(os.path.join(HERE, 'canada64.s')) as f:
+                runtime = [self.assemble(tmp, 'canada64', f.read()),
+                           self.assemble(tmp, 'print', compile(os.path.join(HERE, 'print.ca')))]
+            for name in programs():
+                with self.subTest(name):
+                    obj = self.assemble(tmp, name, compile(os.path.join(CORPUS, name + '.ca')))
+                    exe = os.path.join(tmp, name)
+                    subprocess.check_call(['ld', '-e', '_start', obj] + runtime + ['-o', exe])
+                    proc = subprocess.run([exe], stdin=subprocess.DEVNULL, stdout=subprocess.PIPE)
+                    self.assertEqual(proc.returncode, 0)
+                    with open(os.path.join(CORPUS, name + '.out'), 'rb') as f:
+                        self.assertEqual(proc.stdout, f.read())
+        finally:
+            shutil.rmtree(tmp)
+
+if __name__ == '__main__':
+    unittest.main()